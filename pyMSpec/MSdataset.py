@@ -1,49 +1,447 @@
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
 import numpy as np
-from pyMSpec.mass_spectrum import mass_spectrum
+from pyMSpec.mass_spectrum import MassSpectrum
 
 
-class MSdataset():
+def _grow(array, needed):
+    # amortised O(1) appends: at least double the capacity whenever it runs out
+    if needed <= len(array):
+        return array
+    grown = np.empty(max(needed, 2 * len(array), 16), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def window_images(mzs, intensities, pixels, n_pixels, targets, ppm=3., chunk_size=1024, n_jobs=1):
+    """
+    sum the intensities of the peaks within a ppm window of each target, per pixel
+    each window is a pair of binary searches into the sorted peaks; the hits of a block of targets are summed with a
+    single bincount over (target, pixel) pairs. blocks can be run on several threads.
+    :param mzs: numpy array of peak mzs, sorted ascending
+    :param intensities: numpy array of peak intensities, in the order of mzs
+    :param pixels: numpy array of the pixel (spectrum position) of each peak, in the order of mzs
+    :param n_pixels: int number of pixels
+    :param targets: numpy array of target mzs
+    :param ppm: float tolerance in ppm of each target
+    :param chunk_size: int number of targets per block, bounds the temporary memory
+    :param n_jobs: int number of threads
+    :return: numpy array (targets x pixels)
+    """
+    targets = np.asarray(targets, dtype=float)
+    tol = targets * ppm * 1e-6
+    lo = np.searchsorted(mzs, targets - tol, side='left')
+    hi = np.searchsorted(mzs, targets + tol, side='right')
+    images = np.zeros((len(targets), n_pixels))
+
+    def fill(start):
+        stop = min(start + chunk_size, len(targets))
+        counts = hi[start:stop] - lo[start:stop]
+        rows = np.repeat(np.arange(stop - start), counts)
+        peaks = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - lo[start:stop], counts)
+        images[start:stop] = np.bincount(rows * n_pixels + pixels[peaks], weights=intensities[peaks],
+                                         minlength=(stop - start) * n_pixels).reshape(stop - start, n_pixels)
+
+    starts = range(0, len(targets), chunk_size)
+    if n_jobs == 1:
+        for start in starts:
+            fill(start)
+    else:
+        with ThreadPoolExecutor(n_jobs) as executor:
+            list(executor.map(fill, starts))
+    return images
+
+
+_SOURCES = ('profile', 'centroids')
+
+# per worker process state of MSdataset.map, set once by the pool initializer
+_map_state = {}
+
+
+def _map_init(func, profile, centroids, dtype):
+    _map_state.update(func=func, profile=profile, centroids=centroids, dtype=dtype)
+
+
+def _map_range(bounds):
+    """
+    apply the mapped function to the spectra [start, stop)
+    :return: tuple of (lengths, mzs, intensities) for the profile and the centroids of the results
+    """
+    start, stop = bounds
+    results = ([], []), ([], [])
+    lengths = np.zeros((2, stop - start), dtype=np.int64)
+    for ii in range(start, stop):
+        spectrum = MassSpectrum(profile_spec=_map_state['profile'].get(ii),
+                                centroid_spec=_map_state['centroids'].get(ii), dtype=_map_state['dtype'])
+        spectrum = _map_state['func'](spectrum)
+        for jj, source in enumerate(('profile', 'centroids')):
+            mzs, intensities = spectrum.get_spectrum(source)
+            lengths[jj, ii - start] = len(mzs)
+            results[jj][0].append(mzs)
+            results[jj][1].append(intensities)
+    return tuple((lengths[jj], np.concatenate(results[jj][0]), np.concatenate(results[jj][1])) for jj in range(2))
+
+
+class _Summary(object):
+    """
+    statistics of the spectra in a dataset, updated with vectorised reductions as spectra are appended so that reading
+    them is O(1): mz range, per spectrum length and TIC, total and extreme lengths per source, and whether all profile
+    spectra with data share one mz axis
+    """
     def __init__(self):
+        self.n_spectra = 0
+        self.mz_min = np.inf
+        self.mz_max = -np.inf
+        self.lengths = dict((source, np.zeros(0, dtype=np.int64)) for source in _SOURCES)
+        self.tics = dict((source, np.zeros(0)) for source in _SOURCES)
+        self.n_peaks = dict((source, 0) for source in _SOURCES)
+        self.min_length = dict((source, None) for source in _SOURCES)
+        self.max_length = dict((source, None) for source in _SOURCES)
+        self.axis = None
+        self.consistent_mz = True
+
+    def update(self, arrays):
+        """
+        :param arrays: dict of source -> (lengths, mzs, intensities) of the appended spectra, mzs and intensities
+            concatenated
+        """
+        n_new = 0
+        for source in _SOURCES:
+            lengths, mzs, intensities = arrays[source]
+            lengths = np.asarray(lengths, dtype=np.int64)
+            n_new = len(lengths)
+            if n_new == 0:
+                return
+            end = self.n_spectra + n_new
+            tics = np.zeros(n_new)
+            if len(mzs) > 0:
+                filled = lengths > 0
+                tics[filled] = np.add.reduceat(intensities, (np.cumsum(lengths) - lengths)[filled])
+                self.mz_min = min(self.mz_min, float(np.min(mzs)))
+                self.mz_max = max(self.mz_max, float(np.max(mzs)))
+            self.lengths[source] = _grow(self.lengths[source], end)
+            self.lengths[source][self.n_spectra:end] = lengths
+            self.tics[source] = _grow(self.tics[source], end)
+            self.tics[source][self.n_spectra:end] = tics
+            self.n_peaks[source] += int(lengths.sum())
+            min_length, max_length = int(lengths.min()), int(lengths.max())
+            if self.min_length[source] is not None:
+                min_length = min(min_length, self.min_length[source])
+                max_length = max(max_length, self.max_length[source])
+            self.min_length[source], self.max_length[source] = min_length, max_length
+            if source == 'profile' and self.consistent_mz:
+                self.__check_axis(lengths, mzs)
+        self.n_spectra += n_new
+
+    def __check_axis(self, lengths, mzs):
+        # spectra without profile data are left out, the axis is taken from the first spectrum that has some
+        filled = lengths[lengths > 0]
+        if len(filled) == 0:
+            return
+        if self.axis is None:
+            self.axis = np.array(mzs[:filled[0]])
+        if np.any(filled != len(self.axis)):
+            self.consistent_mz = False
+        else:
+            self.consistent_mz = bool(np.all(np.reshape(mzs, (len(filled), len(self.axis))) == self.axis))
+
+
+class _ColumnStore(object):
+    """
+    spectra concatenated into single mz and intensity arrays, spectrum i is [offsets[i], offsets[i+1])
+    stored values are never modified so views handed out stay valid when the arrays are reallocated
+    """
+    def __init__(self, dtype=np.float64, n_spectra=0, n_peaks=0):
+        self.mzs = np.empty(n_peaks, dtype=dtype)
+        self.intensities = np.empty(n_peaks, dtype=dtype)
+        self.offsets = np.zeros(n_spectra + 1, dtype=np.int64)
+        self.n_spectra = 0
+
+    @property
+    def n_peaks(self):
+        return int(self.offsets[self.n_spectra])
+
+    def reserve(self, n_spectra, n_peaks):
+        self.offsets = _grow(self.offsets, n_spectra + 1)
+        self.mzs = _grow(self.mzs, n_peaks)
+        self.intensities = _grow(self.intensities, n_peaks)
+
+    def append(self, mzs, intensities):
+        start = self.n_peaks
+        stop = start + len(mzs)
+        self.reserve(self.n_spectra + 1, stop)
+        self.mzs[start:stop] = mzs
+        self.intensities[start:stop] = intensities
+        self.n_spectra += 1
+        self.offsets[self.n_spectra] = stop
+
+    def get(self, index):
+        if not -self.n_spectra <= index < self.n_spectra:
+            raise IndexError('spectrum index out of range')
+        index %= self.n_spectra
+        start, stop = self.offsets[index], self.offsets[index + 1]
+        mzs, intensities = self.mzs[start:stop], self.intensities[start:stop]
+        mzs.flags.writeable = intensities.flags.writeable = False
+        return mzs, intensities
+
+    def extend(self, lengths, mzs, intensities):
+        """
+        append len(lengths) spectra given as concatenated arrays
+        """
+        start = self.n_peaks
+        stop = start + len(mzs)
+        self.reserve(self.n_spectra + len(lengths), stop)
+        self.mzs[start:stop] = mzs
+        self.intensities[start:stop] = intensities
+        self.offsets[self.n_spectra + 1:self.n_spectra + len(lengths) + 1] = start + np.cumsum(lengths)
+        self.n_spectra += len(lengths)
+
+    def flat(self):
+        """
+        :return: tuple (mzs, intensities, offsets) of views of the filled part of the arrays
+        """
+        n_peaks = self.n_peaks
+        return self.mzs[:n_peaks], self.intensities[:n_peaks], self.offsets[:self.n_spectra + 1]
+
+    def close(self):
+        pass
+
+
+class MSdataset():
+    """
+    a collection of mass spectra held in columnar form
+    profile and centroid data are each stored as concatenated mz and intensity arrays with an offsets array, so a
+    dataset is a handful of allocations however many spectra it holds; get_spectrum returns views, not copies
+    """
+    def __init__(self, dtype=np.float64, n_spectra=0, n_peaks=0, n_centroids=0):
+        """
+        :param dtype: numpy dtype of the stored mzs and intensities (None keeps the types of data read from file)
+        :param n_spectra: int number of spectra to reserve space for
+        :param n_peaks: int total number of profile points to reserve space for
+        :param n_centroids: int total number of centroids to reserve space for
+        """
+        self.dtype = None if dtype is None else np.dtype(dtype)
         self.index_list = []
-        self.mz_min = float("inf")
-        self.mz_max = 0
-        self.spectra = []  # dict of mass_spectrum objects
+        self.coordinates = None  # (n_spectra x 3) pixel positions, if known
+        self._next_index = 0
+        self._summary = _Summary()  # None for file-backed data until data_summary scans it
+        self._peak_indices = {}  # source -> PeakIndex used by ion_images
+        self._profile = _ColumnStore(self.dtype, n_spectra, n_peaks)
+        self._centroids = _ColumnStore(self.dtype, n_spectra, n_centroids)
+
+    def __len__(self):
+        return len(self.index_list)
+
+    def reserve(self, n_spectra, n_peaks=0, n_centroids=0):
+        """
+        make room for n_spectra spectra in total so that appending up to that many does not reallocate
+        """
+        self._profile.reserve(n_spectra, n_peaks)
+        self._centroids.reserve(n_spectra, n_centroids)
+
+    def __get_summary(self):
+        if self._summary is None:
+            summary = _Summary()
+            for start in range(0, len(self), 1024):
+                stop = min(start + 1024, len(self))
+                arrays = {}
+                for source in _SOURCES:
+                    spectra = [self.get_arrays(ii, source) for ii in range(start, stop)]
+                    arrays[source] = ([len(mzs) for mzs, _ in spectra], np.concatenate([a[0] for a in spectra]),
+                                      np.concatenate([a[1] for a in spectra]))
+                summary.update(arrays)
+            self._summary = summary
+        return self._summary
 
     def data_summary(self):
-        # check if all spectra are the same length
-        spec_length = np.zeros(len(self.index_list))
-        for ii in self.index_list:
-            this_spectrum = self.get_spectrum(ii)
-            tmp_shape = this_spectrum.mzs.shape
-            spec_length[ii] = tmp_shape[0]
-            if this_spectrum.mzs[0] < self.mz_min:
-                self.mz_min = this_spectrum.mzs[0]
-            if this_spectrum.mzs[-1] > self.mz_max:
-                self.mz_max = this_spectrum.mzs[-1]
-        if np.all(spec_length == spec_length[1]):
-            self.consistent_mz = True
+        """
+        the statistics are kept up to date as spectra are added, so this is O(1); file-backed datasets are scanned
+        once on the first call
+        :return: dict with n_spectra, mz_min and mz_max (None if there are no peaks), n_peaks and n_centroids (totals),
+            min_length and max_length (of the profile spectra) and consistent_mz (all profile spectra with data share
+            one mz axis)
+        """
+        summary = self.__get_summary()
+        self.consistent_mz = summary.consistent_mz
+        has_peaks = summary.mz_min <= summary.mz_max
+        return {'n_spectra': summary.n_spectra,
+                'mz_min': summary.mz_min if has_peaks else None,
+                'mz_max': summary.mz_max if has_peaks else None,
+                'n_peaks': summary.n_peaks['profile'],
+                'n_centroids': summary.n_peaks['centroids'],
+                'min_length': summary.min_length['profile'],
+                'max_length': summary.max_length['profile'],
+                'consistent_mz': summary.consistent_mz}
+
+    @property
+    def mz_min(self):
+        return self.data_summary()['mz_min']
+
+    @property
+    def mz_max(self):
+        return self.data_summary()['mz_max']
+
+    def spectrum_lengths(self, source='profile'):
+        """
+        :return: numpy array of the number of points of every spectrum
+        """
+        return self.__get_summary().lengths[source][:len(self)]
+
+    def tic(self, source='profile'):
+        """
+        :return: numpy array of the total intensity of every spectrum
+        """
+        return self.__get_summary().tics[source][:len(self)]
+
+    def close(self):
+        # clean up afterwards, releases file-backed storage
+        self._profile.close()
+        self._centroids.close()
+
+    def __store(self, source):
+        if source == 'profile':
+            return self._profile
+        elif source == 'centroids':
+            return self._centroids
+        raise IOError('spectrum source should be profile or centroids')
+
+    def get_arrays(self, index, source='profile'):
+        """
+        :param index: int position of the spectrum in the dataset
+        :param source: 'profile' or 'centroids'
+        :return: tuple (mzs, intensities) of read-only views into the dataset arrays
+        """
+        return self.__store(source).get(index)
+
+    def get_peaks(self, source='centroids'):
+        """
+        :param source: 'profile' or 'centroids'
+        :return: tuple (mzs, intensities, pixels) of all peaks in spectrum order, pixels is the position of the
+            spectrum each peak belongs to
+        """
+        store = self.__store(source)
+        if isinstance(store, _ColumnStore):
+            mzs, intensities, offsets = store.flat()
+            lengths = np.diff(offsets)
         else:
-            self.consistent_mz = False
+            arrays = [store.get(ii) for ii in range(store.n_spectra)]
+            lengths = np.array([len(a[0]) for a in arrays], dtype=np.int64)
+            mzs = np.concatenate([a[0] for a in arrays]) if arrays else np.empty(0)
+            intensities = np.concatenate([a[1] for a in arrays]) if arrays else np.empty(0)
+        return mzs, intensities, np.repeat(np.arange(len(lengths)), lengths)
+
+    def map(self, func, n_jobs=1, chunksize=256, progress=None):
+        """
+        apply func to every spectrum, in worker processes if n_jobs > 1
+        workers receive the data once, as shared memory for in-memory datasets or by reopening the memory mapped file
+        for file-backed ones, and process ranges of chunksize spectra. results come back per range as concatenated
+        arrays and are appended in order to a new columnar dataset.
+        :param func: picklable callable taking a MassSpectrum and returning the processed MassSpectrum
+        :param n_jobs: int number of processes
+        :param chunksize: int number of consecutive spectra per task
+        :param progress: callable progress(n_done, n_total), called after each range
+        :return: MSdataset with the same indices and coordinates
+        """
+        n_spectra = len(self)
+        result = MSdataset(dtype=self.dtype, n_spectra=n_spectra)
+        result.coordinates = self.coordinates
+        ranges = [(start, min(start + chunksize, n_spectra)) for start in range(0, n_spectra, chunksize)]
+        shared = []
+        readers = []
+        for store in (self._profile, self._centroids):
+            if isinstance(store, _ColumnStore) and n_jobs > 1:
+                from pyMSpec.shared_spectra import SharedSpectra
+                shared.append(SharedSpectra.from_arrays(*store.flat()))
+                readers.append(shared[-1])
+            else:
+                readers.append(store)
+        pool = None
+        try:
+            if n_jobs > 1:
+                pool = Pool(n_jobs, initializer=_map_init, initargs=(func, readers[0], readers[1], self.dtype))
+                chunks = pool.imap(_map_range, ranges)
+            else:
+                _map_init(func, readers[0], readers[1], self.dtype)
+                chunks = (_map_range(bounds) for bounds in ranges)
+            for n_done, (profile, centroids) in enumerate(chunks):
+                result._profile.extend(*profile)
+                result._centroids.extend(*centroids)
+                result._summary.update({'profile': profile, 'centroids': centroids})
+                if progress is not None:
+                    progress(ranges[n_done][1], n_spectra)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            _map_state.clear()
+            for block in shared:
+                block.close()
+                block.unlink()
+        result.index_list = list(self.index_list)
+        result._next_index = self._next_index
+        return result
+
+    def set_peak_index(self, index):
+        """
+        let ion_images use a PeakIndex (see pyMSpec.peak_index) of this dataset instead of sorting the peaks each call
+        the index is dropped once spectra are added, as it no longer covers every spectrum
+        :param index: PeakIndex built from, or loaded for, this dataset
+        """
+        if index.n_pixels != len(self):
+            raise ValueError('peak index has {} spectra, the dataset {}'.format(index.n_pixels, len(self)))
+        self._peak_indices[index.source] = index
 
-    def _del_(self):
-        # clean up afterwards
-        self.hdf.close()
+    def ion_images(self, mzs, ppm=3., source='centroids', n_jobs=1, chunk_size=1024):
+        """
+        extract an ion image for every target mz in one pass over the dataset
+        all peaks are sorted by mz once, or taken from the PeakIndex set with set_peak_index, then each target is a
+        searchsorted window (see window_images)
+        :param mzs: numpy array of target mzs
+        :param ppm: float tolerance in ppm of each target
+        :param source: 'profile' or 'centroids'
+        :param n_jobs: int number of threads working on blocks of targets
+        :param chunk_size: int number of targets per block
+        :return: numpy array (len(mzs) x len(dataset)), summed intensity of each target in each spectrum
+        """
+        index = self._peak_indices.get(source)
+        if index is not None and index.n_pixels == len(self):
+            return index.ion_images(mzs, ppm, n_jobs, chunk_size)
+        peak_mzs, peak_intensities, pixels = self.get_peaks(source)
+        order = np.argsort(peak_mzs, kind='mergesort')
+        return window_images(peak_mzs[order], peak_intensities[order], pixels[order], len(self), mzs, ppm,
+                             chunk_size, n_jobs)
 
     def get_spectrum(self, index):
-        return self.spectra[index]
+        """
+        :param index: int position of the spectrum in the dataset
+        :return: MassSpectrum whose arrays are views into the dataset, processing it does not change the dataset
+        """
+        return MassSpectrum(profile_spec=self._profile.get(index), centroid_spec=self._centroids.get(index),
+                            dtype=self.dtype)
 
     def add_spectrum(self,
                      profile_mzs=[],
                      profile_intensities=[],
                      centroids_mz=[],
                      centroid_intensity=[],
-                     index=[]):
-        if profile_mzs == [] & centroids_mz == []:
+                     index=None):
+        if len(profile_mzs) == 0 and len(centroids_mz) == 0:
             raise ValueError(
                 'one of profile or centroids mzs should be non-empty')
-        new_spectrum = mass_spectrum()
-        new_spectrum.add_spectrum(profile_mzs, profile_intensities)
-        new_spectrum.add_centroids(centroids_mz, centroid_intensity)
-        if index == []:
-            self.index_list.append(max(self.index_list) + 1)
-        self.spectra.append(new_spectrum)
+        if len(profile_mzs) != len(profile_intensities) or len(centroids_mz) != len(centroid_intensity):
+            raise IOError("mz/intensities vector different lengths")
+        if index is None or (isinstance(index, list) and not index):
+            index = self._next_index
+        index = int(index)
+        # read-only (file-backed) stores raise on reserve, before either store has been changed
+        self._profile.reserve(self._profile.n_spectra + 1, self._profile.n_peaks + len(profile_mzs))
+        self._centroids.reserve(self._centroids.n_spectra + 1, self._centroids.n_peaks + len(centroids_mz))
+        self._next_index = max(self._next_index, index + 1)
+        self._profile.append(profile_mzs, profile_intensities)
+        self._centroids.append(centroids_mz, centroid_intensity)
+        self.index_list.append(index)
+        self._peak_indices.clear()
+        if self._summary is not None:
+            self._summary.update(dict((source, ([len(mzs)], mzs, intensities)) for source, (mzs, intensities)
+                                      in zip(_SOURCES, (self._profile.get(-1), self._centroids.get(-1)))))
@@ -14,75 +14,72 @@ def gradient_purePython(mzs, intensities, min_intensity, peak_width_bins):
     Output:
         mzs_c: list of apex mzs
         intensites_c: list of apex intensities
+    Kept for backwards compatibility: peaks are detected with gradient(grad_type='diff') using the pure Python
+    centroiding backend.
     """
     # Input Checks
     if not len(mzs) == len(intensities):
         raise ValueError("Length of mzs must match length of intensities")
-    # Calculate first and second differential
-    dmz = [intensities[ii] - intensities[ii - 1]
-           for ii in range(1, len(intensities))]
-    dmz2 = [dmz[ii] - dmz[ii - 1] for ii in range(1, len(dmz))]
-    # Find crossing points
-    cPoint = [dmz[ii] * dmz[ii - 1] <= 0 for ii in range(1, len(dmz))]
-    mPoint = [d2 < 0 for d2 in dmz2]
-
-    # Get indicies of crossing points
-    # Could check left/right of crossing point
-    indices_list_l = [ii for ii in range(
-        0, len(cPoint)) if all((cPoint[ii], mPoint[ii]))]
-    indices_list_r = [il + 1 for il in indices_list_l]
-    indices_list = [il if intensities[il] > intensities[ir]
-                    else ir for il, ir in zip(indices_list_l, indices_list_r)]
-    indices_list = list(set(indices_list))  # unique values
-    mzs_list = [mzs[ix] for ix in indices_list]
-    intensities_list = [intensities[ix] for ix in indices_list]
-    # Only keep peak above min intensity
-    mzs_list = [mzs_list[ii] for ii in range(len(mzs_list)) if intensities_list[
-        ii] > min_intensity]
-    intensities_list = [intensities_list[ii] for ii in range(
-        len(intensities_list)) if intensities_list[ii] > min_intensity]
-    # Quick and dirty approximation of centroids
-    mzs_c, intensities_c = estimate_centroid_simple_weighting(
-        mzs, intensities,  indices_list, peak_width_bins)
-    return mzs_c, intensities_c
-
-
-def estimate_centroid_simple_weighting(mzs, intensities, indices_list,
-                                       peak_width_bins):
-    """Simple averaging to estimate the peak centroid
-    Input:
-        mzs: profile spectrum mzs
-        intensities: profile spectrum intensities
-        indices_list: mz bin of local maxima
-    Output:
-        mzs_c: centroids mzs
-        intensities_c: centroid intensity (==peak maxima)
-    """
     if not peak_width_bins % 2 == 1:
         raise ValueError("peak width should be an odd number of bins")
-    weighted_bins = int(peak_width_bins) / 2  # note integer division
-    mzs_c = []
-    intensities_c = []
-    for ii in range(len(indices_list)):
-        s = w = 0.0
-        max_intensity_idx = 0
-        max_intensity = -1
-        for k in xrange(-weighted_bins, weighted_bins + 1):
-            idx = indices_list[ii] + k
-            mz = mzs[idx]
-            intensity = intensities[idx]
-            w += intensity
-            s += mz * intensity
-            if intensity > max_intensity:
-                max_intensity = intensity
-        mzs_c.append(s / w)
-        intensities_c.append(max_intensity)
-    return mzs_c, intensities_c
+    mzs_c, intensities_c, _ = gradient(mzs, intensities, min_intensity=min_intensity,
+                                       weighted_bins=int(peak_width_bins) // 2, grad_type='diff',
+                                       backend='python')
+    return list(mzs_c), list(intensities_c)
+
+
+def estimate_noise(mzs, intensities, window_mz=10.0, method='mad', percentile=50.):
+    """Estimate the local noise level along the m/z axis.
+    The axis is split into consecutive windows of width window_mz; a robust statistic of the intensities is
+    computed for all windows at once and linearly interpolated between the window centres.
+    Input
+        mzs: sorted numpy array of m/z values
+        intensities: numpy array of intensity values. must be same length as mzs
+        window_mz: width of the noise estimation window in m/z
+        method: 'mad' (scaled median absolute deviation) or 'percentile'
+        percentile: percentile of the window intensities used when method == 'percentile'
+    Output:
+        noise: numpy array with the noise level at each m/z value
+    """
+    mzs = np.asarray(mzs, dtype=float)
+    intensities = np.asarray(intensities, dtype=float)
+    if not len(mzs) == len(intensities):
+        raise ValueError("Length of mzs must match length of intensities")
+    if window_mz <= 0:
+        raise ValueError("window_mz must be greater than 0")
+    if len(mzs) == 0:
+        return np.zeros(0)
+    windows, window_ids = np.unique(np.floor((mzs - mzs[0]) / window_mz).astype(int), return_inverse=True)
+    if method == 'mad':
+        median = _window_quantile(window_ids, intensities, 0.5)
+        deviation = np.abs(intensities - median[window_ids])
+        window_noise = 1.4826 * _window_quantile(window_ids, deviation, 0.5)
+    elif method == 'percentile':
+        window_noise = _window_quantile(window_ids, intensities, percentile / 100.)
+    else:
+        raise ValueError('noise method {} not known'.format(method))
+    window_centres = mzs[0] + (windows + 0.5) * window_mz
+    return np.interp(mzs, window_centres, window_noise)
+
+
+def _window_quantile(window_ids, values, q):
+    # quantile of values within each window, vectorised over all windows with a single lexsort
+    order = np.lexsort((values, window_ids))
+    sorted_ids = window_ids[order]
+    sorted_values = values[order]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_ids[1:] != sorted_ids[:-1])))
+    counts = np.diff(np.concatenate((starts, [len(sorted_ids)])))
+    pos = starts + q * (counts - 1)
+    lo = np.floor(pos).astype(int)
+    hi = np.ceil(pos).astype(int)
+    return sorted_values[lo] + (pos - lo) * (sorted_values[hi] - sorted_values[lo])
 
 
 def gradient(mzs, intensities, **opt_args):
     function_args = {'max_output': -1, 'weighted_bins': 1,
-                     'min_intensity': 1e-5, 'grad_type': 'gradient'}
+                     'min_intensity': 1e-5, 'grad_type': 'gradient',
+                     'noise_factor': 0, 'noise_window': 10.0, 'noise_method': 'mad', 'noise_percentile': 50.,
+                     'backend': None}
     for key, val in iteritems(opt_args):
         if key in function_args.keys():
             function_args[key] = val
@@ -91,14 +88,14 @@ def gradient(mzs, intensities, **opt_args):
             for i in function_args.keys():
                 print(i)
             raise NameError('gradient does not take argument: %s' % key)
-    # TODO: temporary workaround to disable the parameter until it is fixed.
     mzs = np.asarray(mzs)
     intensities = np.asarray(intensities)
     mzMaxNum = function_args['max_output']
     weighted_bins = function_args['weighted_bins']
     min_intensity = function_args['min_intensity']
     gradient_type = function_args['grad_type']
-    assert mzMaxNum < len(mzs)
+    noise_factor = function_args['noise_factor']
+    _, pick_max = get_backend(function_args['backend'])
     assert len(mzs) == len(intensities)
     assert weighted_bins < len(mzs) / 2.
     # calc first&sectond differential
@@ -113,7 +110,6 @@ def gradient(mzs, intensities, **opt_args):
     # detect crossing points
     cPoint = MZgrad[0:-1] * MZgrad[1:] <= 0
     mPoint = MZgrad2 < 0
-    indices = cPoint & mPoint
     # bool->list of indices
     # Could check left/right of crossing point
     indices_list_l = np.where(cPoint & mPoint)[0]
@@ -125,26 +121,20 @@ def gradient(mzs, intensities, **opt_args):
 
     # Remove any 'peaks' that aren't real
     indices_list = indices_list[intensities[indices_list] > min_intensity]
+    if noise_factor > 0 and len(indices_list) > 0:
+        noise = estimate_noise(mzs, intensities, window_mz=function_args['noise_window'],
+                               method=function_args['noise_method'], percentile=function_args['noise_percentile'])
+        indices_list = indices_list[intensities[indices_list] > noise_factor * noise[indices_list]]
+
+    # Keep the mzMaxNum most intense peaks (linear time selection, output stays in m/z order)
+    if 0 < mzMaxNum < len(indices_list):
+        top_idx = np.argpartition(intensities[indices_list], -mzMaxNum)[-mzMaxNum:]
+        indices_list = np.sort(indices_list[top_idx])
 
     # Select the peaks
     intensities_list = intensities[indices_list]
     mzs_list = mzs[indices_list]
 
-    # Tidy up if required
-    if mzMaxNum > 0:
-        if len(mzs_list) > mzMaxNum:
-            sort_idx = np.argsort(intensities_list)
-            intensities_list = intensities_list[sort_idx[-mzMaxNum:]]
-            mzs_list = mzs_list[sort_idx[-mzMaxNum:]]
-            indices_list = indices_list[sort_idx[-mzMaxNum:]]
-        # elif len(mzs) < mzMaxNum:
-        #    # FIXME: for what purpose are we appending zeros here?
-        #    lengthDiff = mzMaxNum - len(indices_list)
-        #    pad = np.zeros((lengthDiff, 1))
-        #    mzs_list = np.concatenate((mzs_list, pad))
-        #    intensities_list = np.concatenate((intensities_list, pad))
-        #    indices_list = np.concatenate((indices_list, pad))
-
     if weighted_bins > 0:
         # check no peaks within bin width of spectrum edge
         good_idx = (indices_list > weighted_bins) & (
@@ -152,8 +142,8 @@ def gradient(mzs, intensities, **opt_args):
         mzs_list = mzs_list[good_idx]
         intensities_list = intensities_list[good_idx]
         indices_list = indices_list[good_idx]
-        r = pick_max_(mzs, intensities, mzs_list, intensities_list,
-                      indices_list, weighted_bins)
+        r = pick_max(mzs, intensities, mzs_list, intensities_list,
+                     indices_list, weighted_bins)
         mzs_list = r[0, :]
         intensities_list = r[1, :]
         indices_list = r[2, :].astype(int)
@@ -182,8 +172,97 @@ def pick_max_(mzs, intensities, mzs_list, intensities_list, indices_list,
     return result
 
 
+def pick_max_numpy(mzs, intensities, mzs_list, intensities_list, indices_list,
+                   weighted_bins):
+    """Vectorised equivalent of pick_max_: all peak windows are gathered into one (n_peaks x window) array"""
+    window_idx = np.asarray(indices_list, dtype=int)[:, np.newaxis] + np.arange(-weighted_bins, weighted_bins + 1)
+    window_ints = intensities[window_idx]
+    result = np.zeros((3, len(mzs_list)))
+    result[0] = np.sum(mzs[window_idx] * window_ints, axis=1) / np.sum(window_ints, axis=1)
+    apex = np.argmax(window_ints, axis=1)
+    result[1] = window_ints[np.arange(len(apex)), apex]
+    result[2] = window_idx[np.arange(len(apex)), apex]
+    return result
+
+
+def _pick_max_prange(mzs, intensities, mzs_list, intensities_list, indices_list,
+                     weighted_bins):
+    # same kernel as pick_max_ with the outer loop over peaks distributed across threads
+    result = np.zeros((3, len(mzs_list)))
+    for ii in prange(len(mzs_list)):
+        s = w = 0.0
+        max_intensity_idx = 0
+        max_intensity = -1.0
+        for k in range(-weighted_bins, weighted_bins + 1):
+            idx = indices_list[ii] + k
+            mz = mzs[idx]
+            intensity = intensities[idx]
+            w += intensity
+            s += mz * intensity
+            if intensity > max_intensity:
+                max_intensity = intensity
+                max_intensity_idx = idx
+        result[0][ii] = s / w
+        result[1][ii] = max_intensity
+        result[2][ii] = max_intensity_idx
+    return result
+
+
+# Registry of centroiding kernels: name -> function with the signature of pick_max_
+centroid_backends = {'python': pick_max_,
+                     'numpy': pick_max_numpy}
+# name -> reason, for backends that could not be loaded on this host
+unavailable_backends = {}
+
 try:
-    from numba import njit
-    pick_max_ = njit(pick_max_)
-except ImportError:
-    pass
+    from numba import njit, prange
+    centroid_backends['numba'] = njit(pick_max_)
+    centroid_backends['numba_parallel'] = njit(parallel=True)(_pick_max_prange)
+except ImportError as e:
+    unavailable_backends['numba'] = unavailable_backends['numba_parallel'] = str(e)
+
+_active_backend = 'numba' if 'numba' in centroid_backends else 'numpy'
+
+
+def register_backend(name, func):
+    """
+    add a centroiding kernel to the registry
+    :param name: backend name used with set_backend and gradient(backend=...)
+    :param func: function with the same signature and result as pick_max_
+    """
+    centroid_backends[name] = func
+    unavailable_backends.pop(name, None)
+
+
+def available_backends():
+    """
+    :return: list of the names of all centroiding backends usable on this host
+    """
+    return sorted(centroid_backends.keys())
+
+
+def get_backend(name=None):
+    """
+    resolve a centroiding backend
+    :param name: backend name, or None for the globally active backend
+    :return: tuple (name: str, kernel: function)
+    """
+    if name is None:
+        name = _active_backend
+    if name not in centroid_backends:
+        if name in unavailable_backends:
+            raise ValueError('centroiding backend {} is not available: {}'.format(name, unavailable_backends[name]))
+        raise ValueError('centroiding backend {} not in {}'.format(name, available_backends()))
+    return name, centroid_backends[name]
+
+
+def set_backend(name):
+    """
+    select the centroiding backend used by gradient when none is passed explicitly
+    :param name: backend name, see available_backends
+    :return: name of the previously active backend
+    """
+    global _active_backend
+    get_backend(name)
+    previous, _active_backend = _active_backend, name
+    return previous
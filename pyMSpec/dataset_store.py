@@ -0,0 +1,314 @@
+import json
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from pyMSpec.MSdataset import MSdataset
+
+# file layout: magic, zlib compressed blobs, json header, little-endian uint64 header length, magic
+# every chunk holds a run of consecutive spectra, split per source into mz bands (fixed edges across the dataset); each
+# band is a blob with the byte-shuffled per spectrum peak counts, mzs and intensities of the peaks in the band. the
+# header records where each blob is and the mz range it covers, so an mz slab only decompresses the bands it overlaps
+_MAGIC = b'PYMSDS\x00\x01'
+_SOURCES = ('profile', 'centroids')
+
+
+def _shuffle(values):
+    # grouping the n-th bytes of all values together makes floats compress much better
+    values = np.ascontiguousarray(values)
+    return np.frombuffer(values.tobytes(), dtype=np.uint8).reshape(-1, values.dtype.itemsize).T.tobytes()
+
+
+def _unshuffle(data, dtype):
+    dtype = np.dtype(dtype)
+    raw = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1).T
+    return np.ascontiguousarray(raw).view(dtype).ravel()
+
+
+def _source_dtypes(dataset, source):
+    for ii in range(len(dataset)):
+        mzs, intensities = dataset.get_arrays(ii, source)
+        if len(mzs) > 0:
+            return mzs.dtype.str, intensities.dtype.str
+    return '<f8', '<f8'
+
+
+def _split_bands(lengths, mzs, edges):
+    """
+    :return: tuple (order, counts) where order puts the peaks of a run of spectra band by band, each band in spectrum
+        order, and counts is the (n_bands x n_spectra) number of peaks of each spectrum in each band
+    """
+    n_spectra = len(lengths)
+    spectra = np.repeat(np.arange(n_spectra), lengths)
+    in_order = np.diff(mzs) >= 0
+    ends = np.cumsum(lengths)[:-1]
+    in_order[ends[(ends > 0) & (ends < len(mzs))] - 1] = True
+    if np.all(in_order):
+        bands = np.searchsorted(edges, mzs, side='right')
+    else:
+        # reading a chunk back puts a spectrum's peaks in band order, so unsorted spectra keep a single band
+        bands = np.zeros(len(mzs), dtype=np.int64)
+    counts = np.bincount(bands * n_spectra + spectra, minlength=(len(edges) + 1) * n_spectra)
+    return np.argsort(bands, kind='stable'), counts.reshape(len(edges) + 1, n_spectra)
+
+
+def write_dataset(dataset, filename, chunk_size=1024, level=6, metadata=None, mz_bands=32):
+    """
+    write an MSdataset to a chunked, zlib compressed file that DatasetFile reads with random access
+    :param dataset: MSdataset
+    :param filename: path of the output file
+    :param chunk_size: int number of consecutive spectra per chunk, the unit of decompression for get_arrays
+    :param level: int zlib compression level (0-9)
+    :param metadata: json serialisable dict stored with the data
+    :param mz_bands: int number of equal width mz bands each chunk is split into, the unit of decompression for
+        get_slab
+    """
+    n_spectra = len(dataset)
+    dtypes = dict((source, _source_dtypes(dataset, source)) for source in _SOURCES)
+    summary = dataset.data_summary()
+    if summary['mz_min'] is None or mz_bands <= 1:
+        edges = np.empty(0)
+    else:
+        edges = np.linspace(summary['mz_min'], summary['mz_max'], mz_bands + 1)[1:-1]
+    header = {'version': 2, 'n_spectra': n_spectra, 'chunk_size': chunk_size, 'metadata': metadata or {},
+              'dtypes': dtypes, 'mz_edges': edges.tolist(), 'chunks': [], 'arrays': {}}
+    with open(filename, 'wb') as f:
+        f.write(_MAGIC)
+
+        def write_blob(data):
+            offset = f.tell()
+            f.write(zlib.compress(data, level))
+            return [offset, f.tell() - offset]
+
+        for start in range(0, n_spectra, chunk_size):
+            stop = min(start + chunk_size, n_spectra)
+            chunk = {'start': start, 'stop': stop}
+            for source in _SOURCES:
+                arrays = [dataset.get_arrays(ii, source) for ii in range(start, stop)]
+                lengths = np.array([len(mzs) for mzs, _ in arrays], dtype='<i8')
+                mz_dtype, intensity_dtype = dtypes[source]
+                mzs = np.concatenate([a[0] for a in arrays]).astype(mz_dtype, copy=False)
+                intensities = np.concatenate([a[1] for a in arrays]).astype(intensity_dtype, copy=False)
+                order, counts = _split_bands(lengths, mzs, edges)
+                mzs, intensities = mzs[order], intensities[order]
+                bands, start_peak = [], 0
+                for band_counts in counts:
+                    stop_peak = start_peak + int(band_counts.sum())
+                    if stop_peak == start_peak:
+                        bands.append(None)
+                        continue
+                    band_mzs, band_intensities = mzs[start_peak:stop_peak], intensities[start_peak:stop_peak]
+                    bands.append({'blob': write_blob(_shuffle(band_counts) + _shuffle(band_mzs) +
+                                                     _shuffle(band_intensities)),
+                                  'n_peaks': stop_peak - start_peak,
+                                  'mz_min': float(band_mzs.min()),
+                                  'mz_max': float(band_mzs.max())})
+                    start_peak = stop_peak
+                chunk[source] = {'n_peaks': len(mzs), 'bands': bands}
+            header['chunks'].append(chunk)
+        header['arrays']['index'] = write_blob(np.asarray(dataset.index_list, dtype='<i8').tobytes())
+        if dataset.coordinates is not None:
+            header['arrays']['coordinates'] = write_blob(np.asarray(dataset.coordinates, dtype='<i8').tobytes())
+        header = json.dumps(header).encode('utf-8')
+        f.write(header)
+        f.write(np.uint64(len(header)).astype('<u8').tobytes())
+        f.write(_MAGIC)
+
+
+class DatasetFile(object):
+    """
+    random access reader for files written by write_dataset
+    the file is memory mapped read-only and decompressed a chunk at a time, with the most recently used chunks cached;
+    reads are safe from several threads, and several processes can open the same file.
+    """
+    def __init__(self, filename, cache_chunks=4):
+        self.filename = filename
+        self._file = np.memmap(filename, dtype=np.uint8, mode='r')
+        magic_length = len(_MAGIC)
+        if len(self._file) < 2 * magic_length + 8 or self._file[:magic_length].tobytes() != _MAGIC \
+                or self._file[-magic_length:].tobytes() != _MAGIC:
+            raise IOError('{} is not a pyMSpec dataset file'.format(filename))
+        header_end = len(self._file) - magic_length - 8
+        header_length = int(self._file[header_end:header_end + 8].view('<u8')[0])
+        header = json.loads(self._file[header_end - header_length:header_end].tobytes().decode('utf-8'))
+        self.n_spectra = header['n_spectra']
+        self.chunk_size = header['chunk_size']
+        self.metadata = header['metadata']
+        self.dtypes = header['dtypes']
+        self.mz_edges = np.array(header['mz_edges'])
+        self._chunks = header['chunks']
+        self._chunk_starts = np.array([chunk['start'] for chunk in self._chunks], dtype=np.int64)
+        self.index_list = np.frombuffer(self._read_blob(header['arrays']['index']), dtype='<i8')
+        self.coordinates = None
+        if 'coordinates' in header['arrays']:
+            self.coordinates = np.frombuffer(self._read_blob(header['arrays']['coordinates']),
+                                             dtype='<i8').reshape(self.n_spectra, -1)
+        self._cache = OrderedDict()
+        self._cache_chunks = cache_chunks
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.n_spectra
+
+    def __getstate__(self):
+        # pickles as the filename, other processes open the file themselves
+        return {'filename': self.filename, 'cache_chunks': self._cache_chunks}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'], state['cache_chunks'])
+
+    def _read_blob(self, blob):
+        offset, size = blob
+        return zlib.decompress(self._file[offset:offset + size])
+
+    def _decode_band(self, chunk_index, source, band):
+        chunk = self._chunks[chunk_index]
+        mz_dtype, intensity_dtype = np.dtype(self.dtypes[source][0]), np.dtype(self.dtypes[source][1])
+        n_spectra, n_peaks = chunk['stop'] - chunk['start'], chunk[source]['bands'][band]['n_peaks']
+        data = self._read_blob(chunk[source]['bands'][band]['blob'])
+        mz_start = n_spectra * 8
+        intensity_start = mz_start + n_peaks * mz_dtype.itemsize
+        offsets = np.zeros(n_spectra + 1, dtype=np.int64)
+        np.cumsum(_unshuffle(data[:mz_start], '<i8'), out=offsets[1:])
+        mzs = _unshuffle(data[mz_start:intensity_start], mz_dtype)
+        intensities = _unshuffle(data[intensity_start:], intensity_dtype)
+        return offsets, mzs, intensities
+
+    def _decode(self, chunk_index, source):
+        # the bands of the chunk put back together spectrum by spectrum
+        chunk = self._chunks[chunk_index]
+        n_spectra = chunk['stop'] - chunk['start']
+        bands = [self._decode_band(chunk_index, source, band)
+                 for band, info in enumerate(chunk[source]['bands']) if info is not None]
+        lengths = np.zeros(n_spectra, dtype=np.int64)
+        for band_offsets, _, _ in bands:
+            lengths += np.diff(band_offsets)
+        offsets = np.zeros(n_spectra + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        if bands:
+            spectra = np.concatenate([np.repeat(np.arange(n_spectra), np.diff(b[0])) for b in bands])
+            order = np.argsort(spectra, kind='stable')
+            mzs = np.concatenate([b[1] for b in bands])[order]
+            intensities = np.concatenate([b[2] for b in bands])[order]
+        else:
+            mzs = np.empty(0, self.dtypes[source][0])
+            intensities = np.empty(0, self.dtypes[source][1])
+        return offsets, mzs, intensities
+
+    def __cached(self, key, decode, *args):
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        decoded = decode(*args)
+        for values in decoded:
+            values.flags.writeable = False
+        with self._lock:
+            self._cache[key] = decoded
+            while len(self._cache) > self._cache_chunks:
+                self._cache.popitem(last=False)
+        return decoded
+
+    def get_chunk(self, chunk_index, source='profile'):
+        """
+        :return: tuple (offsets, mzs, intensities) of the decompressed chunk, offsets relative to the chunk
+        """
+        if source not in _SOURCES:
+            raise IOError('spectrum source should be profile or centroids')
+        return self.__cached((chunk_index, source), self._decode, chunk_index, source)
+
+    def get_band(self, chunk_index, band, source='centroids'):
+        """
+        :return: tuple (offsets, mzs, intensities) of the peaks of the chunk that are in mz band, offsets relative to
+            the chunk
+        """
+        if source not in _SOURCES:
+            raise IOError('spectrum source should be profile or centroids')
+        return self.__cached((chunk_index, source, band), self._decode_band, chunk_index, source, band)
+
+    def get_arrays(self, index, source='profile'):
+        """
+        :param index: int position of the spectrum
+        :return: tuple (mzs, intensities) of read-only arrays
+        """
+        if not -self.n_spectra <= index < self.n_spectra:
+            raise IndexError('spectrum index out of range')
+        index %= self.n_spectra
+        chunk_index = int(np.searchsorted(self._chunk_starts, index, side='right')) - 1
+        offsets, mzs, intensities = self.get_chunk(chunk_index, source)
+        local = index - self._chunks[chunk_index]['start']
+        return mzs[offsets[local]:offsets[local + 1]], intensities[offsets[local]:offsets[local + 1]]
+
+    def get_slab(self, mz_lo, mz_hi, source='centroids'):
+        """
+        all peaks with mz_lo <= mz <= mz_hi, only the mz bands that overlap the slab are decompressed
+        :return: tuple (mzs, intensities, spectrum indices) of numpy arrays in spectrum order
+        """
+        found = []
+        for chunk_index, chunk in enumerate(self._chunks):
+            for band, info in enumerate(chunk[source]['bands']):
+                if info is None or info['mz_max'] < mz_lo or info['mz_min'] > mz_hi:
+                    continue
+                offsets, mzs, intensities = self.get_band(chunk_index, band, source)
+                hits = np.flatnonzero((mzs >= mz_lo) & (mzs <= mz_hi))
+                spectra = chunk['start'] + np.searchsorted(offsets, hits, side='right') - 1
+                found.append((mzs[hits], intensities[hits], spectra))
+        if not found:
+            mz_dtype, intensity_dtype = self.dtypes[source]
+            return np.empty(0, mz_dtype), np.empty(0, intensity_dtype), np.empty(0, np.int64)
+        mzs, intensities, spectra = (np.concatenate(parts) for parts in zip(*found))
+        # a slab spanning several bands finds a chunk's peaks band by band
+        order = np.argsort(spectra, kind='stable')
+        return mzs[order], intensities[order], spectra[order]
+
+    def to_dataset(self):
+        """
+        :return: read-only MSdataset whose spectra are read from this file on demand
+        """
+        dataset = MSdataset(dtype=None)
+        dataset._profile = _ChunkedStore(self, 'profile')
+        dataset._centroids = _ChunkedStore(self, 'centroids')
+        dataset.index_list = self.index_list.tolist()
+        dataset._next_index = max(dataset.index_list) + 1 if self.n_spectra > 0 else 0
+        dataset.coordinates = self.coordinates
+        dataset._summary = None
+        return dataset
+
+    def close(self):
+        self._cache.clear()
+        self._file = None
+
+
+class _ChunkedStore(object):
+    """
+    one source of a DatasetFile in the store interface MSdataset uses
+    """
+    def __init__(self, dataset_file, source):
+        self._file = dataset_file
+        self._source = source
+        self.n_spectra = dataset_file.n_spectra
+
+    @property
+    def n_peaks(self):
+        return sum(chunk[self._source]['n_peaks'] for chunk in self._file._chunks)
+
+    def get(self, index):
+        return self._file.get_arrays(index, self._source)
+
+    def reserve(self, n_spectra, n_peaks):
+        raise IOError('dataset files are read-only')
+
+    def append(self, mzs, intensities):
+        raise IOError('dataset files are read-only')
+
+    def close(self):
+        self._file.close()
+
+
+def read_dataset(filename, cache_chunks=4):
+    """
+    open a file written by write_dataset as a read-only MSdataset
+    """
+    return DatasetFile(filename, cache_chunks).to_dataset()
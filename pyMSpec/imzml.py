@@ -0,0 +1,189 @@
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from pyMSpec.MSdataset import MSdataset, _ColumnStore
+
+# controlled vocabulary accessions used by imzML
+_MZ_ARRAY = 'MS:1000514'
+_INTENSITY_ARRAY = 'MS:1000515'
+_DATA_TYPES = {'MS:1000521': '<f4', 'MS:1000523': '<f8', 'MS:1000519': '<i4', 'MS:1000522': '<i8',
+               'IMS:1000141': '<i4', 'IMS:1000142': '<i8'}
+_ZLIB_COMPRESSION = 'MS:1000574'
+_CONTINUOUS = 'IMS:1000030'
+_PROCESSED = 'IMS:1000031'
+_CENTROID = 'MS:1000127'
+_EXTERNAL_OFFSET = 'IMS:1000102'
+_EXTERNAL_LENGTH = 'IMS:1000103'
+_POSITION = {'IMS:1000050': 0, 'IMS:1000051': 1, 'IMS:1000052': 2}
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+class ImzMLStore(object):
+    """
+    read-only spectrum store over a memory mapped .ibd file
+    each spectrum is an (offset, length) pair per array into the file; in continuous mode all spectra point at the same
+    mz array. get returns views of the mapping, nothing is read until the values are used.
+    """
+    def __init__(self, ibd_filename, mz_offsets, mz_lengths, intensity_offsets, intensity_lengths,
+                 mz_dtype, intensity_dtype, mode='processed'):
+        self.mode = mode
+        self.ibd_filename = ibd_filename
+        self._ibd = np.memmap(ibd_filename, dtype=np.uint8, mode='r')
+        self.mz_offsets = np.asarray(mz_offsets, dtype=np.int64)
+        self.mz_lengths = np.asarray(mz_lengths, dtype=np.int64)
+        self.intensity_offsets = np.asarray(intensity_offsets, dtype=np.int64)
+        self.intensity_lengths = np.asarray(intensity_lengths, dtype=np.int64)
+        self.mz_dtype = np.dtype(mz_dtype)
+        self.intensity_dtype = np.dtype(intensity_dtype)
+        self.n_spectra = len(self.mz_offsets)
+        if np.any(self.mz_lengths != self.intensity_lengths):
+            raise IOError("mz/intensities vector different lengths")
+        ends = np.concatenate([self.mz_offsets + self.mz_lengths * self.mz_dtype.itemsize,
+                               self.intensity_offsets + self.intensity_lengths * self.intensity_dtype.itemsize])
+        if len(ends) > 0 and ends.max() > len(self._ibd):
+            raise IOError('{} is shorter than the imzML offsets require'.format(ibd_filename))
+
+    @property
+    def n_peaks(self):
+        return int(self.intensity_lengths.sum())
+
+    def __getstate__(self):
+        # pickle the layout only, the .ibd is mapped again on unpickling
+        state = self.__dict__.copy()
+        del state['_ibd']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._ibd = np.memmap(self.ibd_filename, dtype=np.uint8, mode='r')
+
+    def get(self, index):
+        if not -self.n_spectra <= index < self.n_spectra:
+            raise IndexError('spectrum index out of range')
+        index %= self.n_spectra
+        mzs = np.ndarray(self.mz_lengths[index], dtype=self.mz_dtype, buffer=self._ibd,
+                         offset=int(self.mz_offsets[index]))
+        intensities = np.ndarray(self.intensity_lengths[index], dtype=self.intensity_dtype, buffer=self._ibd,
+                                 offset=int(self.intensity_offsets[index]))
+        return mzs, intensities
+
+    def reserve(self, n_spectra, n_peaks):
+        raise IOError('imzML data is read-only')
+
+    def append(self, mzs, intensities):
+        raise IOError('imzML data is read-only')
+
+    def close(self):
+        self._ibd = None
+
+
+def parse_imzml(imzml_filename):
+    """
+    read the spectrum layout from an imzML file without building its element tree
+    :param imzml_filename: path of the .imzML file
+    :return: dict with mode ('continuous' or 'processed'), centroided (bool), mz_dtype, intensity_dtype and numpy
+        arrays mz_offsets, mz_lengths, intensity_offsets, intensity_lengths, coordinates (n_spectra x 3)
+    """
+    groups = {}
+    mode, centroided = None, False
+    dtypes = {_MZ_ARRAY: set(), _INTENSITY_ARRAY: set()}
+    columns = {_MZ_ARRAY: ([], []), _INTENSITY_ARRAY: ([], [])}
+    coordinates = []
+    array_params, position, spectrum_list = None, None, None
+    for event, elem in ET.iterparse(imzml_filename, events=('start', 'end')):
+        tag = _local(elem.tag)
+        if event == 'start':
+            if tag == 'binaryDataArray':
+                array_params = {}
+            elif tag == 'spectrum':
+                position = [0, 0, 0]
+            elif tag == 'spectrumList':
+                spectrum_list = elem
+            continue
+        if tag == 'cvParam':
+            accession = elem.get('accession')
+            if array_params is not None:
+                array_params[accession] = elem.get('value')
+            elif accession in _POSITION and position is not None:
+                position[_POSITION[accession]] = int(elem.get('value'))
+            elif accession == _CONTINUOUS:
+                mode = 'continuous'
+            elif accession == _PROCESSED:
+                mode = 'processed'
+            elif accession == _CENTROID:
+                centroided = True
+        elif tag == 'referenceableParamGroup':
+            groups[elem.get('id')] = dict((p.get('accession'), p.get('value')) for p in elem
+                                          if _local(p.tag) == 'cvParam')
+        elif tag == 'referenceableParamGroupRef':
+            params = groups[elem.get('ref')]
+            if array_params is not None:
+                array_params.update(params)
+            elif _CENTROID in params:
+                centroided = True
+        elif tag == 'binaryDataArray':
+            if _ZLIB_COMPRESSION in array_params:
+                raise IOError('compressed imzML arrays are not supported')
+            for array_type in (_MZ_ARRAY, _INTENSITY_ARRAY):
+                if array_type in array_params:
+                    offsets, lengths = columns[array_type]
+                    offsets.append(int(array_params[_EXTERNAL_OFFSET]))
+                    lengths.append(int(array_params[_EXTERNAL_LENGTH]))
+                    dtypes[array_type].update(_DATA_TYPES[a] for a in array_params if a in _DATA_TYPES)
+            array_params = None
+        elif tag == 'spectrum':
+            coordinates.append(position)
+            position = None
+            # drop parsed spectra so memory use does not grow with the file
+            spectrum_list.clear()
+    if mode is None:
+        raise IOError('{} does not declare continuous or processed mode'.format(imzml_filename))
+    for array_type, found in dtypes.items():
+        if len(found) > 1:
+            raise IOError('{} mixes data types within one array type'.format(imzml_filename))
+    n_spectra = len(coordinates)
+    if any(len(offsets) != n_spectra for offsets, _ in columns.values()):
+        raise IOError('{} has spectra without an mz or intensity array'.format(imzml_filename))
+    layout = {'mode': mode, 'centroided': centroided,
+              'mz_dtype': dtypes[_MZ_ARRAY].pop() if dtypes[_MZ_ARRAY] else '<f4',
+              'intensity_dtype': dtypes[_INTENSITY_ARRAY].pop() if dtypes[_INTENSITY_ARRAY] else '<f4',
+              'coordinates': np.array(coordinates, dtype=np.int64).reshape(n_spectra, 3)}
+    for name, array_type in (('mz', _MZ_ARRAY), ('intensity', _INTENSITY_ARRAY)):
+        offsets, lengths = columns[array_type]
+        layout[name + '_offsets'] = np.array(offsets, dtype=np.int64)
+        layout[name + '_lengths'] = np.array(lengths, dtype=np.int64)
+    return layout
+
+
+def read_imzml(imzml_filename, ibd_filename=None):
+    """
+    open an imzML/ibd pair as a read-only MSdataset
+    only the layout is read up front: spectra are views of the memory mapped .ibd, so get_spectrum reads from disk on
+    use. centroided files fill the centroids, profile files the profile.
+    :param imzml_filename: path of the .imzML file
+    :param ibd_filename: path of the .ibd file, defaults to the imzML path with an .ibd extension
+    :return: MSdataset with coordinates set from the imzML pixel positions
+    """
+    if ibd_filename is None:
+        ibd_filename = os.path.splitext(imzml_filename)[0] + '.ibd'
+    layout = parse_imzml(imzml_filename)
+    store = ImzMLStore(ibd_filename, layout['mz_offsets'], layout['mz_lengths'], layout['intensity_offsets'],
+                       layout['intensity_lengths'], layout['mz_dtype'], layout['intensity_dtype'], layout['mode'])
+    empty = _ColumnStore()
+    empty.offsets = np.zeros(store.n_spectra + 1, dtype=np.int64)
+    empty.n_spectra = store.n_spectra
+    dataset = MSdataset(dtype=None)
+    if layout['centroided']:
+        dataset._profile, dataset._centroids = empty, store
+    else:
+        dataset._profile, dataset._centroids = store, empty
+    dataset.index_list = list(range(store.n_spectra))
+    dataset._next_index = store.n_spectra
+    dataset.coordinates = layout['coordinates']
+    dataset._summary = None
+    return dataset
@@ -1,61 +1,205 @@
+import json
+
 import numpy as np
 
 import pyMSpec
-class MassSpectrum:
+
+# binary file layout: magic, little-endian uint64 header length, json header, then the arrays each aligned to _ALIGN
+# bytes (offsets in the header are relative to the end of the padded header)
+_MAGIC = b'PYMSPEC\x01'
+_ALIGN = 64
+_ARRAYS = ('mzs', 'intensities', 'centroids', 'centroids_intensity')
+
+
+def _align(n):
+    return -(-n // _ALIGN) * _ALIGN
+
+
+def _delta_encode(values, resolution):
+    """
+    store sorted mzs as integer steps of resolution, in the smallest integer type that holds the largest step
+    :return: tuple (deltas, encoding info for the header)
+    """
+    origin = float(values[0])
+    ticks = np.rint((values - origin) / resolution).astype(np.int64)
+    deltas = np.diff(ticks, prepend=0)
+    int_type = np.result_type(np.min_scalar_type(int(deltas.min())), np.min_scalar_type(int(deltas.max())))
+    return deltas.astype(int_type), {'encoding': 'delta', 'origin': origin, 'resolution': resolution,
+                                     'stored_dtype': int_type.str}
+
+
+def _read_array(filename, offset, entry, mmap):
+    stored_dtype = np.dtype(entry.get('stored_dtype', entry['dtype']))
+    if entry['length'] == 0:
+        return np.empty(0, dtype=entry['dtype'])
+    if mmap:
+        values = np.memmap(filename, dtype=stored_dtype, mode='r', offset=offset, shape=(entry['length'],))
+    else:
+        values = np.fromfile(filename, dtype=stored_dtype, count=entry['length'], offset=offset)
+    if entry['encoding'] == 'delta':
+        ticks = np.cumsum(values, dtype=np.int64)
+        values = (entry['origin'] + ticks * entry['resolution']).astype(entry['dtype'])
+    return values
+
+
+class MassSpectrum(object):
     """
     a data container for a single mass spectrum
     includes methods for signal processing
+    spectra are held as contiguous numpy arrays (of dtype, if given) and returned by get_spectrum as read-only views
+    in lazy mode normalise_spectrum and smooth_spectrum only record the operation; get_spectrum applies the pending
+    operations to the requested source and keeps the result until the next operation is recorded. data passed to
+    add_spectrum/add_centroids counts as already processed.
     """
-    def __init__(self, profile_spec=[], centroid_spec=[]):
-        self._mzs = []
-        self._intensities = []
-        self._centroids = []
-        self._centroids_intensity = []
+    __slots__ = ('_mzs', '_intensities', '_centroids', '_centroids_intensity', '_processing', '_dtype',
+                 '_profile_sorted', '_centroids_sorted', '_lazy', '_pending', '_profile_applied',
+                 '_centroids_applied')
+
+    def __init__(self, profile_spec=None, centroid_spec=None, dtype=None, lazy=False):
+        self._dtype = dtype
         self._processing = []
-        if profile_spec != []:
-            self._mzs, self._intensities = profile_spec
-        if centroid_spec != []:
-            self._centroids, self._centroids_intensity = centroid_spec
+        self._lazy = lazy
+        self._pending = []
+        self._profile_applied = self._centroids_applied = 0
+        self.__add_mzs([])
+        self.__add_intensities([])
+        self.__add_centroids_mzs([])
+        self.__add_centroids_intensities([])
+        if profile_spec is not None and len(profile_spec) > 0:
+            self.add_spectrum(*profile_spec)
+        if centroid_spec is not None and len(centroid_spec) > 0:
+            self.add_centroids(*centroid_spec)
 
     # Private basic spectrum I/O
+    def __as_array(self, values):
+        return np.ascontiguousarray(values, dtype=self._dtype)
+
+    @staticmethod
+    def __read_only(values):
+        view = values.view()
+        view.flags.writeable = False
+        return view
+
+    @staticmethod
+    def __check_sorted(mzs):
+        return bool(np.all(mzs[1:] >= mzs[:-1]))
+
     def __add_mzs(self, mzs):
-        self._mzs = mzs
+        self._mzs = self.__as_array(mzs)
+        self._profile_sorted = self.__check_sorted(self._mzs)
 
     def __add_intensities(self, intensities):
-        self._intensities = intensities
+        self._intensities = self.__as_array(intensities)
 
     def __get_mzs(self):
-        return np.asarray(self._mzs)
+        return self.__read_only(self._mzs)
 
     def __get_intensities(self):
-        return np.asarray(self._intensities)
+        return self.__read_only(self._intensities)
 
     def __get_mzs_centroids(self):
-        return np.asarray(self._centroids)
+        return self.__read_only(self._centroids)
 
     def __get_intensities_centroids(self):
-        return np.asarray(self._centroids_intensity)
+        return self.__read_only(self._centroids_intensity)
 
     def __add_centroids_mzs(self, mz_list):
-        self._centroids = mz_list
+        self._centroids = self.__as_array(mz_list)
+        self._centroids_sorted = self.__check_sorted(self._centroids)
 
     def __add_centroids_intensities(self, intensity_list):
-        self._centroids_intensity = intensity_list
+        self._centroids_intensity = self.__as_array(intensity_list)
+
+    def __apply(self, operation, source):
+        kind, method, method_args = operation
+        if source == 'profile':
+            mzs, intensities = self._mzs, self._intensities
+        else:
+            mzs, intensities = self._centroids, self._centroids_intensity
+        if len(mzs) == 0 or (kind == 'smooth' and source == 'centroids'):
+            return
+        if kind == 'smooth':
+            from pyMSpec import smoothing
+            mzs, intensities = smoothing.apply_smoothing(mzs, intensities, method, method_args)
+            self.__add_mzs(mzs)
+            self.__add_intensities(intensities)
+        elif source == 'profile':
+            from pyMSpec import normalisation
+            self.__add_intensities(normalisation.apply_normalisation(mzs, intensities, method, method_args))
+        else:
+            from pyMSpec import normalisation
+            self.__add_centroids_intensities(normalisation.apply_normalisation(mzs, intensities, method, method_args))
+
+    def __materialise(self, source):
+        if source == 'profile':
+            for operation in self._pending[self._profile_applied:]:
+                self.__apply(operation, 'profile')
+            self._profile_applied = len(self._pending)
+        else:
+            for operation in self._pending[self._centroids_applied:]:
+                self.__apply(operation, 'centroids')
+            self._centroids_applied = len(self._pending)
+
+    def __process(self, kind, method, method_args):
+        operation = (kind, method, dict(method_args))
+        self._pending.append(operation)
+        self.add_processing(kind, method, method_args)
+        if not self._lazy:
+            self.__materialise('profile')
+            self.__materialise('centroids')
+        return self
 
     # Public methods
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def lazy(self):
+        return self._lazy
+
+    def add_processing(self, kind, method, method_args={}):
+        """
+        record a processing step applied to the spectrum, e.g. by a Pipeline
+        :param kind: str 'smooth', 'normalise' or 'centroid'
+        :param method: str name of the method
+        :param method_args: dict of the parameters passed to the method
+        """
+        self._processing.append({'kind': kind, 'method': method, 'args': dict(method_args)})
+
+    def get_processing(self):
+        """
+        :return: list of dicts (kind, method, args) of the processing steps applied, in order
+        """
+        return [dict(entry) for entry in self._processing]
+
+    def is_sorted(self, source='profile'):
+        """
+        :return: bool, True if the mzs of source are in ascending order (checked once when they are added)
+        """
+        if source == 'profile':
+            return self._profile_sorted
+        elif source == 'centroids':
+            return self._centroids_sorted
+        raise IOError('spectrum source should be profile or centroids')
+
     def add_spectrum(self, mzs, intensities):
         if len(mzs) != len(intensities):
             raise IOError("mz/intensities vector different lengths")
         self.__add_mzs(mzs)
         self.__add_intensities(intensities)
+        self._profile_applied = len(self._pending)
 
     def add_centroids(self, mz_list, intensity_list):
         if len(mz_list) != len(intensity_list):
             raise IOError("mz/intensities vector different lengths")
         self.__add_centroids_mzs(mz_list)
         self.__add_centroids_intensities(intensity_list)
+        self._centroids_applied = len(self._pending)
 
     def get_spectrum(self, source='profile'):
+        if source in ('profile', 'centroids'):
+            self.__materialise(source)
         if source == 'profile':
             mzs = self.__get_mzs()
             intensities = self.__get_intensities()
@@ -66,18 +210,116 @@ class MassSpectrum:
             raise IOError('spectrum source should be profile or centroids')
         return mzs, intensities
 
+    def slice(self, mz_lo, mz_hi, source='centroids'):
+        """
+        :param mz_lo: float lower mz bound (inclusive)
+        :param mz_hi: float upper mz bound (inclusive)
+        :param source: 'profile' or 'centroids', the mzs must be sorted
+        :return: tuple (mzs, intensities) of read-only views of the part of the spectrum within the bounds
+        """
+        mzs, intensities = self.__sorted_spectrum(source)
+        lo = np.searchsorted(mzs, mz_lo, side='left')
+        hi = np.searchsorted(mzs, mz_hi, side='right')
+        return mzs[lo:hi], intensities[lo:hi]
+
+    def query(self, mzs, ppm=3., source='centroids'):
+        """
+        find the nearest peak to each target mz within a ppm tolerance, O(k log n) for k targets
+        :param mzs: numpy array of target mz values
+        :param ppm: float tolerance in ppm of the target mz
+        :param source: 'profile' or 'centroids', the mzs must be sorted
+        :return: indices: numpy array, index of the best match for each target (-1 if nothing within tolerance)
+        :return: intensities: numpy array, intensity of the best match for each target (0 if nothing within tolerance)
+        """
+        targets = np.asarray(mzs, dtype=float)
+        spec_mzs, spec_intensities = self.__sorted_spectrum(source)
+        if len(spec_mzs) == 0:
+            return np.full(targets.shape, -1, dtype=int), np.zeros(targets.shape)
+        right = np.clip(np.searchsorted(spec_mzs, targets), 0, len(spec_mzs) - 1)
+        left = np.clip(right - 1, 0, len(spec_mzs) - 1)
+        nearest = np.where(np.abs(spec_mzs[left] - targets) <= np.abs(spec_mzs[right] - targets), left, right)
+        match = np.abs(spec_mzs[nearest] - targets) <= targets * ppm * 1e-6
+        return np.where(match, nearest, -1), np.where(match, spec_intensities[nearest], 0)
+
+    def __sorted_spectrum(self, source):
+        mzs, intensities = self.get_spectrum(source)
+        if not self.is_sorted(source):
+            raise ValueError('{} mzs are not sorted'.format(source))
+        return mzs, intensities
+
+    def save(self, filename, mz_resolution=None):
+        """
+        write the spectrum to a binary file that load can memory map without copying
+        pending lazy operations are applied first
+        :param filename: path of the output file
+        :param mz_resolution: float, if given mzs are delta encoded as integer steps of this size, which shrinks the
+            file but is lossy (to within mz_resolution/2) and needs a decoding pass on load
+        """
+        self.__materialise('profile')
+        self.__materialise('centroids')
+        entries, arrays, offset = [], [], 0
+        for name in _ARRAYS:
+            values = getattr(self, '_' + name)
+            entry = {'name': name, 'dtype': values.dtype.str, 'length': len(values), 'encoding': 'raw'}
+            if mz_resolution is not None and name in ('mzs', 'centroids') and len(values) > 0:
+                values, encoding = _delta_encode(values, mz_resolution)
+                entry.update(encoding)
+            entry['offset'] = offset
+            offset = _align(offset + values.nbytes)
+            entries.append(entry)
+            arrays.append(values)
+        header = {'version': 1,
+                  'dtype': None if self._dtype is None else np.dtype(self._dtype).str,
+                  'processing': list(self._processing),
+                  'sorted': {'profile': self._profile_sorted, 'centroids': self._centroids_sorted},
+                  'arrays': entries}
+        if isinstance(self, MSn_spectrum):
+            header['msn'] = {'ms_level': self.ms_level, 'ms_transitions': self.ms_transitions,
+                             'precursor_mz': None if self.precursor_mz is None else float(self.precursor_mz)}
+        header = json.dumps(header, default=repr).encode('utf-8')
+        data_start = _align(len(_MAGIC) + 8 + len(header))
+        with open(filename, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(np.uint64(len(header)).astype('<u8').tobytes())
+            f.write(header)
+            for entry, values in zip(entries, arrays):
+                f.write(b'\0' * (data_start + entry['offset'] - f.tell()))
+                values.tofile(f)
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        """
+        read a spectrum written by save
+        :param filename: path of the input file
+        :param mmap: bool, if True raw arrays are read-only memory maps of the file rather than copies in memory
+        :return: MassSpectrum, or MSn_spectrum if an MSn spectrum was saved
+        """
+        with open(filename, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise IOError('{} is not a pyMSpec spectrum file'.format(filename))
+            header_length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(header_length).decode('utf-8'))
+        data_start = _align(len(_MAGIC) + 8 + header_length)
+        if 'msn' in header:
+            if not issubclass(cls, MSn_spectrum):
+                cls = MSn_spectrum
+            spectrum = cls(dtype=header['dtype'], ms_level=header['msn']['ms_level'],
+                           precursor_mz=header['msn']['precursor_mz'])
+            spectrum.ms_transitions = [tuple(window) for window in header['msn']['ms_transitions']]
+        else:
+            spectrum = cls(dtype=header['dtype'])
+        for entry in header['arrays']:
+            setattr(spectrum, '_' + entry['name'], _read_array(filename, data_start + entry['offset'], entry, mmap))
+        spectrum._processing = header['processing']
+        spectrum._profile_sorted = header['sorted']['profile']
+        spectrum._centroids_sorted = header['sorted']['centroids']
+        return spectrum
+
     def normalise_spectrum(self, method="tic", method_args={}):
-        from pyMSpec import normalisation
-        self._centroids_intensity = normalisation.apply_normalisation(self._centroids, self._centroids_intensity, method, method_args)
-        self._intensities = normalisation.apply_normalisation(self._mzs, self._intensities, method, method_args)
-        self._processing.append(method)
-        return self
+        return self.__process('normalise', method, method_args)
 
     def smooth_spectrum(self, method="sg_smooth", method_args={}):
-        from pyMSpec import smoothing
-        self._mzs, self._intensities = smoothing.apply_smoothing(self._mzs, self._intensities, method, method_args)
-        self._processing.append(method)
-        return self
+        return self.__process('smooth', method, method_args)
 
 # for compatibility with andy-d-palmer/pyIMS
 mass_spectrum = MassSpectrum
@@ -86,11 +328,67 @@ class MSn_spectrum(MassSpectrum):
     """
     a data container for fragmentation spectrum
     """
-    def __init__(self, ms_level=""):
+    __slots__ = ('ms_transitions', 'ms_level', 'precursor_mz')
+
+    def __init__(self, ms_level="", precursor_mz=None, **kwargs):
+        super(MSn_spectrum, self).__init__(**kwargs)
         self.ms_transitions = []
         self.ms_level = ms_level
+        self.precursor_mz = precursor_mz
 
     def add_transition(self, transitions):
         # transitions is a list of ms fragmentation acceptance windows
-        self.transitions = transitions
-        self.mz_level = len(self.transitions) + 1
+        self.ms_transitions = transitions
+        self.ms_level = len(self.ms_transitions) + 1
+
+
+class MSnLibrary(object):
+    """
+    a collection of fragmentation spectra indexed by precursor mz
+    the precursor mzs are kept in a sorted array (rebuilt on the first query after an add) so a tolerance search is a
+    pair of binary searches
+    """
+    def __init__(self, spectra=()):
+        self._spectra = []
+        self._precursors = []
+        self._order = None
+        self._sorted_precursors = None
+        for spectrum in spectra:
+            self.add(spectrum)
+
+    def __len__(self):
+        return len(self._spectra)
+
+    def __getitem__(self, index):
+        return self._spectra[index]
+
+    def add(self, spectrum):
+        if spectrum.precursor_mz is None:
+            raise IOError("spectrum has no precursor mz")
+        self._spectra.append(spectrum)
+        self._precursors.append(float(spectrum.precursor_mz))
+        self._order = None
+
+    def __build_index(self):
+        precursors = np.asarray(self._precursors, dtype=float)
+        self._order = np.argsort(precursors, kind='mergesort')
+        self._sorted_precursors = precursors[self._order]
+
+    def query_indices(self, precursor_mz, ppm=10.):
+        """
+        :param precursor_mz: float precursor mz
+        :param ppm: float tolerance in ppm of precursor_mz
+        :return: numpy array of the library indices of spectra with a precursor within tolerance, by precursor mz
+        """
+        if self._order is None:
+            self.__build_index()
+        tol = precursor_mz * ppm * 1e-6
+        lo = np.searchsorted(self._sorted_precursors, precursor_mz - tol, side='left')
+        hi = np.searchsorted(self._sorted_precursors, precursor_mz + tol, side='right')
+        return self._order[lo:hi]
+
+    def query(self, precursor_mz, ppm=10.):
+        """
+        :return: list of MSn_spectrum with a precursor within ppm of precursor_mz, by precursor mz
+        """
+        return [self._spectra[i] for i in self.query_indices(precursor_mz, ppm)]
@@ -5,8 +5,11 @@ import numpy as np
 def apply_normalisation(mzs, counts, type_str="", norm_args={}):
     """
     helper function to apply a normalisation function (with some input testing etc)
-    :param counts: numpy array of values to normalise
+    :param counts: numpy array of values to normalise, either one spectrum or a (n_spectra x n_bins) stack
     :param type_str: normalisation type to apply (name)
+    :param norm_args: dict of arguments for the normalisation function, all accept axis (the m/z axis of counts,
+    default -1), inplace (write the result into counts if it is already a float array, default False) and
+    scale_only (return the scale factor of each spectrum instead of the normalised counts, default False)
     :return: numpy array of normalised counts
     """
     normToApply = {"none": none,
@@ -22,94 +25,251 @@ def apply_normalisation(mzs, counts, type_str="", norm_args={}):
     return normToApply[type_str](mzs, counts, **norm_args)
 
 
-def shift_and_scale(counts, scale=1.0, shift=0.0):
+def scale_spectra(counts, scale, axis=-1, inplace=False, scale_only=False):
     """
-    applys the generic scaling a shifting operation
-    :param counts: numpy array
-    :param scale: float
-    :param shift: float
-    :return: numpy array of scaled and shifted values
+    divides each spectrum by its scale factor, spectra that sum to zero are left as they are and a scale of zero
+    gives a zero spectrum
+    :param counts: numpy array, one spectrum or a stack of spectra
+    :param scale: numpy array of scale factors, with length 1 along axis
+    :param axis: int m/z axis of counts
+    :param inplace: bool overwrite counts with the result
+    :param scale_only: bool return the scale factors instead of the scaled counts
+    :return: numpy array of scaled counts, or of the scale factors (float for a single spectrum)
     """
-    scale = float(scale)
-    if scale == 0:
-        return np.zeros(np.shape(counts))
-    if shift > 0:
-        counts -= shift
-    return (counts) / scale
+    scale = np.where(check_zeros(counts, axis=axis, keepdims=True), 1., scale)
+    if scale_only:
+        scale = np.squeeze(scale, axis=axis)
+        return float(scale) if scale.ndim == 0 else scale
+    divisor = np.where(scale == 0, np.inf, scale)
+    if inplace:
+        counts /= divisor
+        return counts
+    return counts / divisor
 
 
-def check_zeros(counts):
+def check_zeros(counts, axis=None, keepdims=False):
     """
     helper function to check if vector is all zero
     :param counts:
-    :return: bool
+    :param axis: int check each spectrum along this axis separately (default: the whole array)
+    :return: bool, or numpy array of bool if axis is given
     """
-    if sum(counts) == 0:
-        return True
-    else:
-        return False
+    return np.sum(counts, axis=axis, keepdims=keepdims) == 0
 
 
-def none(mzs,counts):
+def none(mzs, counts, axis=-1, inplace=False, scale_only=False):
     """
     does nothing, just returns input. is a dummy for programmatic case where a function must be supplied
     :param counts:  numpy array
     :return: counts:
     """
+    if scale_only:
+        return scale_spectra(counts, np.ones(np.shape(np.sum(counts, axis=axis, keepdims=True))), axis,
+                             scale_only=True)
     return np.asarray(counts, dtype=float)
 
 
-def tic(mzs, counts):
+def tic(mzs, counts, axis=-1, inplace=False, scale_only=False):
     """
     normalisation function, divides each intensity by the sum of all intensities (each spectrum sums to 1)
     :param counts: numpy array
     :return:counts normalised: numpy array
     """
-    if check_zeros(counts):
-        return counts
-    return shift_and_scale(counts, scale=np.sum(counts))
+    return scale_spectra(counts, np.sum(counts, axis=axis, keepdims=True), axis, inplace, scale_only)
 
-def tic_range(mzs, counts, range):
+
+def tic_range(mzs, counts, range=None, exclude=None, bounds=None, axis=-1, inplace=False, scale_only=False):
     """
-    normalisation function, divides each intensity by the sum of all intensities (each spectrum sums to 1)
+    normalisation function, divides each intensity by the sum of the intensities within one or more mz ranges
+    (bounds are exclusive). the ranges are located on the sorted mz axis with searchsorted and each is summed as a
+    view, so no copy of counts is made; the bounds can be precomputed with range_bounds for spectra that share an mz
+    axis.
+    :param mzs: numpy array of sorted mz values
     :param counts: numpy array
+    :param range: (min, max) or list of (min, max) mz ranges to sum, default the whole spectrum
+    :param exclude: (min, max) or list of (min, max) mz ranges to leave out of the sum (e.g. matrix peaks)
+    :param bounds: numpy array of index bounds from range_bounds, replaces range and exclude
     :return:counts normalised: numpy array
     """
-    if check_zeros(counts):
-        return counts
-    vector_mask = np.all([mzs>range[0], mzs<range[1]], axis=0)
-    return shift_and_scale(counts, scale=np.sum(counts[vector_mask]))
+    if bounds is None:
+        bounds = range_bounds(mzs, range, exclude)
+    shape = list(np.shape(counts))
+    shape[axis] = 1
+    scale = np.zeros(shape)
+    index = [slice(None)] * np.ndim(counts)
+    for start, stop in bounds:
+        index[axis] = slice(start, stop)
+        scale += np.sum(counts[tuple(index)], axis=axis, keepdims=True)
+    return scale_spectra(counts, scale, axis, inplace, scale_only)
+
+
+def range_bounds(mzs, range=None, exclude=None):
+    """
+    index bounds of mz ranges on a sorted mz axis, for tic_range
+    :param mzs: numpy array of sorted mz values
+    :param range: (min, max) or list of (min, max) mz ranges, default the whole axis
+    :param exclude: (min, max) or list of (min, max) mz ranges to remove from range
+    :return: numpy array (n_ranges x 2) of start and stop indices of non-overlapping index ranges
+    """
+    mzs = np.asarray(mzs, dtype=float)
+    if range is None:
+        range = [(-np.inf, np.inf)]
+    ranges = np.atleast_2d(np.asarray(range, dtype=float))
+    # open ranges: first index above the lower bound up to the first index not below the upper bound
+    mask = _coverage(len(mzs), np.searchsorted(mzs, ranges[:, 0], side='right'),
+                     np.searchsorted(mzs, ranges[:, 1], side='left'))
+    if exclude is not None:
+        excluded = np.atleast_2d(np.asarray(exclude, dtype=float))
+        # closed ranges, the excluded bounds themselves are left out of the sum
+        mask &= ~_coverage(len(mzs), np.searchsorted(mzs, excluded[:, 0], side='left'),
+                           np.searchsorted(mzs, excluded[:, 1], side='right'))
+    changes = np.flatnonzero(np.diff(np.concatenate(([0], mask.astype(int), [0]))))
+    return changes.reshape(-1, 2)
+
 
-def rms(mzs, counts):
+def _coverage(n, starts, stops):
+    """
+    boolean mask of the indices covered by at least one [start, stop) range
+    """
+    valid = starts < stops
+    delta = np.zeros(n + 1, dtype=int)
+    np.add.at(delta, starts[valid], 1)
+    np.add.at(delta, stops[valid], -1)
+    return np.cumsum(delta[:-1]) > 0
+
+
+def rms(mzs, counts, axis=-1, inplace=False, scale_only=False):
     """
     normalisation function, divides each intensity by the root-mean-square of all intensities
     :param counts: numpy array
     :return:counts normalised: numpy array
     """
-    if check_zeros(counts):
-        return counts
-    return shift_and_scale(counts, scale=np.sqrt(np.mean(np.square(counts, dtype=float))))
+    spectra = np.moveaxis(counts, axis, -1)
+    sum_squares = np.expand_dims(np.einsum('...i,...i->...', spectra, spectra), axis)
+    return scale_spectra(counts, np.sqrt(sum_squares / np.shape(counts)[axis]), axis, inplace, scale_only)
 
 
-def mad(mzs, counts):
+def mad(mzs, counts, axis=-1, inplace=False, scale_only=False):
     """
     normalisation function, divides each intensity by the median-absolute-deviation of all intensities
     :param counts: numpy array
     :return:counts normalised: numpy array
     """
-    if check_zeros(counts):
-        return counts
-    return shift_and_scale(counts, scale=np.median(np.abs(counts - np.median(counts))))
+    deviation = np.abs(counts - np.median(counts, axis=axis, keepdims=True))
+    return scale_spectra(counts, np.median(deviation, axis=axis, keepdims=True), axis, inplace, scale_only)
 
 
-def sqrt(mzs, counts):
+def sqrt(mzs, counts, axis=-1, inplace=False, scale_only=False):
     """
     normalisation function, returns the square root of intensities
     :param counts: numpy array
     :return:counts normalised: numpy array
     """
-    if check_zeros(counts):
-        return counts
-    counts_norm = np.sqrt(counts)
-    counts_norm[counts == 0] = 0
+    if scale_only:
+        raise ValueError("sqrt normalisation is not a scaling")
+    transform = ~check_zeros(counts, axis=axis, keepdims=True) & (counts != 0)
+    counts_norm = counts if inplace else np.array(counts, dtype=float)
+    np.sqrt(counts_norm, out=counts_norm, where=transform)
     return counts_norm
+
+
+def apply_normalisation_csr(mzs, data, indices, indptr, type_str="", norm_args={}):
+    """
+    apply a normalisation function to every row of a sparse (CSR) stack of spectra without densifying it.
+    the result is the same as normalising the dense rows (implicit entries are zeros) but memory is proportional to
+    the number of stored peaks.
+    :param mzs: numpy array, mz value of each column (defines the number of columns)
+    :param data: numpy array of stored intensities
+    :param indices: numpy array of column indices of data
+    :param indptr: numpy array, data[indptr[i]:indptr[i + 1]] are the intensities of row i
+    :param type_str: normalisation type to apply (name)
+    :param norm_args: dict of arguments for the normalisation, inplace (overwrite data, if it is a float array),
+    scale_only (return the scale factor of each row) and, for tic_range, range/exclude/bounds
+    :return: numpy array of normalised data (same sparsity structure), or of the scale factors
+    """
+    normToApply = {"none": _csr_none,
+                   "tic": _csr_tic,
+                   "rms": _csr_rms,
+                   "mad": _csr_mad,
+                   "sqrt": None,
+                   "tic_range": _csr_tic_range}
+    if type_str not in normToApply.keys():
+        raise ValueError("{} not in {}".format(type_str, normToApply.keys()))
+    norm_args = dict(norm_args)
+    inplace = norm_args.pop('inplace', False)
+    scale_only = norm_args.pop('scale_only', False)
+    data = np.asarray(data, dtype=float)
+    indptr = np.asarray(indptr)
+    row_ids = _CsrRows(indptr)
+    row_sums = np.bincount(row_ids.ids, weights=data, minlength=len(row_ids.rows))
+    if type_str == "sqrt":
+        if scale_only:
+            raise ValueError("sqrt normalisation is not a scaling")
+        transform = (row_sums != 0)[row_ids.ids] & (data != 0)
+        data_norm = data if inplace else data.copy()
+        np.sqrt(data_norm, out=data_norm, where=transform)
+        return data_norm
+    scale = normToApply[type_str](data, row_ids, len(mzs), np.asarray(mzs, dtype=float), np.asarray(indices),
+                                  **norm_args)
+    scale = np.where(row_sums == 0, 1., scale)
+    if scale_only:
+        return scale
+    divisor = np.where(scale == 0, np.inf, scale)[row_ids.ids]
+    if inplace:
+        data /= divisor
+        return data
+    return data / divisor
+
+
+class _CsrRows(object):
+    """
+    row bookkeeping of a CSR matrix: the row of every stored entry and the range of rows
+    """
+    def __init__(self, indptr):
+        self.indptr = indptr
+        self.rows = np.arange(len(indptr) - 1)
+        self.lengths = np.diff(indptr)
+        self.ids = np.repeat(self.rows, self.lengths)
+
+
+def _csr_none(data, row_ids, n_cols, mzs, indices):
+    return np.ones(len(row_ids.rows))
+
+
+def _csr_tic(data, row_ids, n_cols, mzs, indices):
+    return np.bincount(row_ids.ids, weights=data, minlength=len(row_ids.rows))
+
+
+def _csr_rms(data, row_ids, n_cols, mzs, indices):
+    return np.sqrt(np.bincount(row_ids.ids, weights=data * data, minlength=len(row_ids.rows)) / n_cols)
+
+
+def _csr_tic_range(data, row_ids, n_cols, mzs, indices, range=None, exclude=None, bounds=None):
+    if bounds is None:
+        bounds = range_bounds(mzs, range, exclude)
+    in_range = _coverage(n_cols, bounds[:, 0], bounds[:, 1])[indices]
+    return np.bincount(row_ids.ids, weights=data * in_range, minlength=len(row_ids.rows))
+
+
+def _csr_mad(data, row_ids, n_cols, mzs, indices):
+    median = _csr_median(data, row_ids, n_cols, np.zeros(len(row_ids.rows)))
+    return _csr_median(np.abs(data - median[row_ids.ids]), row_ids, n_cols, np.abs(median))
+
+
+def _csr_median(data, row_ids, n_cols, fill):
+    """
+    median of each row of a CSR matrix whose implicit entries have the value fill (one value per row)
+    the stored values are sorted within their rows once; the order statistics are then picked for all rows at once
+    by counting how many stored values fall below the implicit value.
+    """
+    order = np.lexsort((data, row_ids.ids))
+    sorted_data = np.concatenate((data[order], [0.]))
+    n_below = np.bincount(row_ids.ids, weights=data < fill[row_ids.ids], minlength=len(row_ids.rows)).astype(int)
+    n_implicit = n_cols - row_ids.lengths
+
+    def kth(k):
+        stored = np.where(k < n_below, k, k - n_implicit)
+        stored = np.clip(row_ids.indptr[:-1] + stored, 0, len(sorted_data) - 1)
+        implicit = (k >= n_below) & (k < n_below + n_implicit)
+        return np.where(implicit, fill, sorted_data[stored])
+    return (kth((n_cols - 1) // 2) + kth(n_cols // 2)) / 2.
@@ -0,0 +1,148 @@
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from pyMSpec.MSdataset import window_images
+
+_RECORD = np.dtype([('mz', '<f8'), ('intensity', '<f8'), ('pixel', '<i8')])
+_ARRAYS = ('mzs', 'intensities', 'pixels')
+
+
+def _peak_chunks(dataset, source, max_peaks):
+    # consecutive runs of spectra with at most max_peaks peaks (or a single larger spectrum)
+    mzs, intensities, pixels, n = [], [], [], 0
+    for ii in range(len(dataset)):
+        spectrum_mzs, spectrum_intensities = dataset.get_arrays(ii, source)
+        if n > 0 and n + len(spectrum_mzs) > max_peaks:
+            yield np.concatenate(mzs), np.concatenate(intensities), np.concatenate(pixels)
+            mzs, intensities, pixels, n = [], [], [], 0
+        mzs.append(spectrum_mzs)
+        intensities.append(spectrum_intensities)
+        pixels.append(np.full(len(spectrum_mzs), ii, dtype=np.int64))
+        n += len(spectrum_mzs)
+    if n > 0:
+        yield np.concatenate(mzs), np.concatenate(intensities), np.concatenate(pixels)
+
+
+class PeakIndex(object):
+    """
+    every peak of a dataset sorted by mz, with the position of the spectrum (pixel) it came from
+    an mz window is then two binary searches and a contiguous slice, O(log N + hits), whatever the number of spectra.
+    the index can be saved as a directory of .npy files and loaded memory mapped, and passed to
+    MSdataset.set_peak_index so that MSdataset.ion_images uses it.
+    """
+    def __init__(self, mzs, intensities, pixels, n_pixels, source='centroids'):
+        self.mzs = mzs
+        self.intensities = intensities
+        self.pixels = pixels
+        self.n_pixels = n_pixels
+        self.source = source
+
+    def __len__(self):
+        return len(self.mzs)
+
+    @classmethod
+    def build(cls, dataset, source='centroids', directory=None, max_peaks=None, n_jobs=1):
+        """
+        :param dataset: MSdataset
+        :param source: 'profile' or 'centroids'
+        :param directory: path to persist the index to, required for an external sort
+        :param max_peaks: int number of peaks to hold in memory at once; if the dataset has more, peaks are
+            distributed into mz buckets on disk, each bucket sorted on its own and written in order into directory
+        :param n_jobs: int number of threads sorting buckets
+        :return: PeakIndex, memory mapped from directory if given
+        """
+        n_peaks = sum(len(dataset.get_arrays(ii, source)[0]) for ii in range(len(dataset)))
+        if max_peaks is None or n_peaks <= max_peaks:
+            mzs, intensities, pixels = dataset.get_peaks(source)
+            order = np.argsort(mzs, kind='mergesort')
+            index = cls(mzs[order], intensities[order].astype(np.float64), pixels[order], len(dataset), source)
+            if directory is None:
+                return index
+            index.save(directory)
+        else:
+            if directory is None:
+                raise ValueError('an external sort needs a directory to write the index to')
+            cls._external_sort(dataset, source, directory, n_peaks, max_peaks, n_jobs)
+        return cls.load(directory)
+
+    @staticmethod
+    def _external_sort(dataset, source, directory, n_peaks, max_peaks, n_jobs):
+        # bucket edges from a sample of the mzs, so buckets hold about max_peaks / 2 peaks each
+        n_buckets = int(np.ceil(2. * n_peaks / max_peaks))
+        step = max(1, n_peaks // (100 * n_buckets))
+        sample = np.concatenate([mzs[::step] for mzs, _, _ in _peak_chunks(dataset, source, max_peaks)])
+        edges = np.quantile(sample, np.linspace(0, 1, n_buckets + 1)[1:-1])
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_dir = tempfile.mkdtemp(dir=directory)
+        try:
+            bucket_files = [os.path.join(tmp_dir, 'bucket_{}.bin'.format(b)) for b in range(n_buckets)]
+            bucket_sizes = np.zeros(n_buckets, dtype=np.int64)
+            for mzs, intensities, pixels in _peak_chunks(dataset, source, max_peaks):
+                buckets = np.searchsorted(edges, mzs, side='right')
+                order = np.argsort(buckets, kind='mergesort')
+                records = np.empty(len(mzs), dtype=_RECORD)
+                records['mz'], records['intensity'], records['pixel'] = mzs[order], intensities[order], pixels[order]
+                bounds = np.searchsorted(buckets[order], np.arange(n_buckets + 1))
+                for b in np.flatnonzero(np.diff(bounds)):
+                    with open(bucket_files[b], 'ab') as f:
+                        records[bounds[b]:bounds[b + 1]].tofile(f)
+                bucket_sizes += np.diff(bounds)
+            outputs = [np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+', dtype=dtype,
+                                                 shape=(n_peaks,))
+                       for name, dtype in zip(_ARRAYS, ('<f8', '<f8', '<i8'))]
+            starts = np.concatenate([[0], np.cumsum(bucket_sizes)])
+
+            def sort_bucket(b):
+                if bucket_sizes[b] == 0:
+                    return
+                records = np.fromfile(bucket_files[b], dtype=_RECORD)
+                records = records[np.argsort(records['mz'], kind='mergesort')]
+                for output, field in zip(outputs, ('mz', 'intensity', 'pixel')):
+                    output[starts[b]:starts[b + 1]] = records[field]
+                os.remove(bucket_files[b])
+
+            with ThreadPoolExecutor(n_jobs) as executor:
+                list(executor.map(sort_bucket, range(n_buckets)))
+            for output in outputs:
+                output.flush()
+            del outputs
+        finally:
+            shutil.rmtree(tmp_dir)
+        with open(os.path.join(directory, 'index.json'), 'w') as f:
+            json.dump({'n_pixels': len(dataset), 'source': source, 'n_peaks': int(n_peaks)}, f)
+
+    def save(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in _ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+        with open(os.path.join(directory, 'index.json'), 'w') as f:
+            json.dump({'n_pixels': self.n_pixels, 'source': self.source, 'n_peaks': len(self)}, f)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        with open(os.path.join(directory, 'index.json')) as f:
+            info = json.load(f)
+        arrays = [np.load(os.path.join(directory, name + '.npy'), mmap_mode='r' if mmap else None)
+                  for name in _ARRAYS]
+        return cls(*arrays, n_pixels=info['n_pixels'], source=info['source'])
+
+    def query(self, mz_lo, mz_hi):
+        """
+        :return: tuple (mzs, intensities, pixels) of the peaks with mz_lo <= mz <= mz_hi, by mz
+        """
+        lo = np.searchsorted(self.mzs, mz_lo, side='left')
+        hi = np.searchsorted(self.mzs, mz_hi, side='right')
+        return self.mzs[lo:hi], self.intensities[lo:hi], self.pixels[lo:hi]
+
+    def ion_images(self, mzs, ppm=3., n_jobs=1, chunk_size=1024):
+        """
+        :return: numpy array (len(mzs) x n_pixels), as MSdataset.ion_images without sorting the peaks again
+        """
+        return window_images(self.mzs, self.intensities, self.pixels, self.n_pixels, mzs, ppm, chunk_size, n_jobs)
@@ -0,0 +1,132 @@
+import hashlib
+import json
+
+import numpy as np
+
+from pyMSpec import smoothing, normalisation, centroid_detection
+
+# centroiding functions usable as pipeline steps, same signature as centroid_detection.gradient
+centroidToApply = {"gradient": centroid_detection.gradient}
+
+
+class Pipeline(object):
+    """
+    declarative chain of processing steps (smoothing, normalisation, centroiding)
+    the input is copied once and every later step works on that buffer in place where the method allows it.
+    steps before a centroid step process the profile spectrum, steps after it process the centroids.
+    """
+    step_kinds = ("smooth", "normalise", "centroid")
+
+    def __init__(self, steps=()):
+        """
+        :param steps: iterable of (kind, method, method_args) tuples, kind is one of step_kinds
+        """
+        self.steps = []
+        for step in steps:
+            self.add_step(*step)
+
+    def add_step(self, kind, method, method_args=None):
+        if kind not in self.step_kinds:
+            raise ValueError("{} not in {}".format(kind, self.step_kinds))
+        if kind == "centroid":
+            if method not in centroidToApply:
+                raise ValueError("{} not in {}".format(method, centroidToApply.keys()))
+            if any(k == "centroid" for k, _, _ in self.steps):
+                raise ValueError("a pipeline can only centroid once")
+        self.steps.append((kind, method, dict(method_args or {})))
+        return self
+
+    def smooth(self, method="sg_smooth", **method_args):
+        return self.add_step("smooth", method, method_args)
+
+    def normalise(self, method="tic", **method_args):
+        return self.add_step("normalise", method, method_args)
+
+    def centroid(self, method="gradient", **method_args):
+        return self.add_step("centroid", method, method_args)
+
+    def provenance(self):
+        """
+        :return: list of dicts describing each step and its parameters
+        """
+        return [{"kind": kind, "method": method, "args": method_args} for kind, method, method_args in self.steps]
+
+    def cache_key(self):
+        """
+        :return: str hash of the steps and their parameters, identical pipelines have identical keys
+        """
+        description = json.dumps(self.provenance(), sort_keys=True, default=repr)
+        return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+    def apply(self, mzs, intensities):
+        """
+        run the pipeline on a profile spectrum, or on a (n_spectra x n_bins) stack sharing one mz axis
+        (stacks can only be smoothed and normalised, each step processes the whole stack in one call)
+        :param mzs: numpy array of mz values
+        :param intensities: numpy array of intensities
+        :return: tuple (mzs, intensities, centroid_mzs, centroid_intensities), centroids are None if the pipeline does
+        not centroid
+        """
+        mzs = np.array(mzs, dtype=float)
+        intensities = np.array(intensities, dtype=float)
+        centroids = None
+        for kind, method, method_args in self.steps:
+            if kind == "centroid":
+                if intensities.ndim != 1:
+                    raise ValueError("centroiding needs one spectrum at a time")
+                c_mzs, c_intensities, _ = centroidToApply[method](mzs, intensities, **method_args)
+                centroids = [np.asarray(c_mzs, dtype=float), np.asarray(c_intensities, dtype=float)]
+            elif centroids is None:
+                mzs, intensities = self._apply_step(kind, method, method_args, mzs, intensities)
+            else:
+                centroids = list(self._apply_step(kind, method, method_args, *centroids))
+        if centroids is None:
+            return mzs, intensities, None, None
+        return mzs, intensities, centroids[0], centroids[1]
+
+    def _apply_step(self, kind, method, method_args, mzs, intensities):
+        if kind == "smooth":
+            return smoothing.apply_smoothing(mzs, intensities, method, dict(method_args, inplace=True))
+        return mzs, normalisation.apply_normalisation(mzs, intensities, method, dict(method_args, inplace=True))
+
+    def _normalise_centroids(self, mzs, intensities):
+        mzs = np.array(mzs, dtype=float)
+        intensities = np.array(intensities, dtype=float)
+        for kind, method, method_args in self.steps:
+            if kind == "normalise":
+                mzs, intensities = self._apply_step(kind, method, method_args, mzs, intensities)
+        return mzs, intensities
+
+    def run(self, spectrum):
+        """
+        process a MassSpectrum in place: the profile is replaced by the processed profile and, if the pipeline
+        centroids, the centroids by the detected peaks. if it does not centroid, existing centroids are processed as
+        MassSpectrum.normalise_spectrum/smooth_spectrum would: normalised, but not smoothed.
+        :param spectrum: MassSpectrum
+        :return: spectrum
+        """
+        centroids = any(kind == "centroid" for kind, _, _ in self.steps)
+        mzs, intensities = spectrum.get_spectrum(source="profile")
+        if len(mzs) > 0:
+            mzs, intensities, c_mzs, c_intensities = self.apply(mzs, intensities)
+            spectrum.add_spectrum(mzs, intensities)
+            if c_mzs is not None:
+                spectrum.add_centroids(c_mzs, c_intensities)
+        elif centroids:
+            raise ValueError("spectrum has no profile data to centroid")
+        if not centroids:
+            mzs, intensities = spectrum.get_spectrum(source="centroids")
+            if len(mzs) > 0:
+                spectrum.add_centroids(*self._normalise_centroids(mzs, intensities))
+        for step in self.provenance():
+            spectrum.add_processing(step["kind"], step["method"], step["args"])
+        return spectrum
+
+    def run_dataset(self, dataset, n_jobs=1, chunksize=256, progress=None):
+        """
+        process every spectrum of an MSdataset, see MSdataset.map
+        the dataset's columnar arrays are not rewritten, the processed spectra are appended to a new dataset
+        :param dataset: MSdataset
+        :return: MSdataset with the same indices
+        """
+        return dataset.map(self.run, n_jobs=n_jobs, chunksize=chunksize, progress=progress)
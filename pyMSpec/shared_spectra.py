@@ -0,0 +1,191 @@
+import sys
+
+import numpy as np
+from multiprocessing import shared_memory
+
+from pyMSpec.mass_spectrum import MassSpectrum
+
+# block layout: header (n_spectra, n_peaks, mz dtype, intensity dtype), offsets, mzs, intensities, each aligned to
+# _ALIGN bytes
+_ALIGN = 64
+_HEADER = np.dtype([('n_spectra', '<i8'), ('n_peaks', '<i8'), ('mz_dtype', 'S16'), ('intensity_dtype', 'S16')])
+
+
+def _align(n):
+    return -(-n // _ALIGN) * _ALIGN
+
+
+def _layout(n_spectra, n_peaks, mz_dtype, intensity_dtype):
+    offsets_start = _align(_HEADER.itemsize)
+    mzs_start = _align(offsets_start + (n_spectra + 1) * 8)
+    intensities_start = _align(mzs_start + n_peaks * mz_dtype.itemsize)
+    size = intensities_start + n_peaks * intensity_dtype.itemsize
+    return offsets_start, mzs_start, intensities_start, max(size, 1)
+
+
+def _attach(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # before 3.13 attaching always registers the block with the resource tracker; that is harmless for workers started
+    # by multiprocessing, which share the creator's tracker, but an unrelated process would unlink it on exit
+    return shared_memory.SharedMemory(name=name)
+
+
+class SharedSpectra(object):
+    """
+    spectra concatenated into a single shared memory block (offsets, mzs, intensities)
+    worker processes attach by name, or receive the object itself which pickles as its name only, and read spectra as
+    read-only views without copying. the creating process owns the block and should call unlink when done; views
+    handed out must be released before close.
+    """
+    def __init__(self, name):
+        self._shm = _attach(name)
+        self._owner = False
+        self.__map()
+
+    def __map(self):
+        buf = self._shm.buf
+        header = np.ndarray((), dtype=_HEADER, buffer=buf)
+        self.n_spectra = int(header['n_spectra'])
+        self.n_peaks = int(header['n_peaks'])
+        self.mz_dtype = np.dtype(header['mz_dtype'].item().decode('ascii'))
+        self.intensity_dtype = np.dtype(header['intensity_dtype'].item().decode('ascii'))
+        offsets_start, mzs_start, intensities_start, _ = _layout(self.n_spectra, self.n_peaks, self.mz_dtype,
+                                                                 self.intensity_dtype)
+        self.offsets = np.ndarray(self.n_spectra + 1, dtype=np.int64, buffer=buf, offset=offsets_start)
+        self.mzs = np.ndarray(self.n_peaks, dtype=self.mz_dtype, buffer=buf, offset=mzs_start)
+        self.intensities = np.ndarray(self.n_peaks, dtype=self.intensity_dtype, buffer=buf, offset=intensities_start)
+        for values in (self.offsets, self.mzs, self.intensities):
+            values.flags.writeable = False
+
+    @classmethod
+    def __allocate(cls, offsets, mz_dtype, intensity_dtype, name, fill):
+        # fill(mzs, intensities) writes the peaks into the views of the new block
+        mz_dtype, intensity_dtype = np.dtype(mz_dtype), np.dtype(intensity_dtype)
+        n_spectra, n_peaks = len(offsets) - 1, int(offsets[-1])
+        offsets_start, mzs_start, intensities_start, size = _layout(n_spectra, n_peaks, mz_dtype, intensity_dtype)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        try:
+            buf = shm.buf
+            header = np.ndarray((), dtype=_HEADER, buffer=buf)
+            header['n_spectra'], header['n_peaks'] = n_spectra, n_peaks
+            header['mz_dtype'] = mz_dtype.str.encode('ascii')
+            header['intensity_dtype'] = intensity_dtype.str.encode('ascii')
+            np.ndarray(len(offsets), dtype=np.int64, buffer=buf, offset=offsets_start)[:] = offsets
+            fill(np.ndarray(n_peaks, dtype=mz_dtype, buffer=buf, offset=mzs_start),
+                 np.ndarray(n_peaks, dtype=intensity_dtype, buffer=buf, offset=intensities_start))
+        except BaseException:
+            shm.unlink()
+            raise
+        shared = cls.__new__(cls)
+        shared._shm = shm
+        shared._owner = True
+        shared.__map()
+        return shared
+
+    @classmethod
+    def create(cls, spectra, source='centroids', mz_dtype=np.float64, intensity_dtype=np.float64, name=None):
+        """
+        copy spectra into a new shared memory block
+        :param spectra: iterable of MassSpectrum or (mzs, intensities) tuples
+        :param source: 'profile' or 'centroids', which part of a MassSpectrum to share
+        :param mz_dtype: numpy dtype the mzs are stored as
+        :param intensity_dtype: numpy dtype the intensities are stored as
+        :param name: str name of the block, chosen by the system if None
+        :return: SharedSpectra that owns the block
+        """
+        arrays = [s.get_spectrum(source) if isinstance(s, MassSpectrum) else s for s in spectra]
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(mzs) for mzs, _ in arrays])
+
+        def fill(mzs, intensities):
+            for (spec_mzs, spec_intensities), start, stop in zip(arrays, offsets[:-1], offsets[1:]):
+                if len(spec_mzs) != len(spec_intensities):
+                    raise IOError("mz/intensities vector different lengths")
+                mzs[start:stop] = spec_mzs
+                intensities[start:stop] = spec_intensities
+
+        return cls.__allocate(offsets, mz_dtype, intensity_dtype, name, fill)
+
+    @classmethod
+    def from_arrays(cls, mzs, intensities, offsets, name=None):
+        """
+        copy spectra already concatenated (spectrum i is [offsets[i], offsets[i+1])) into a new shared memory block,
+        in one copy of each array
+        :param mzs: numpy array of the concatenated mzs, its dtype is kept
+        :param intensities: numpy array of the concatenated intensities, its dtype is kept
+        :param offsets: numpy array of n_spectra + 1 positions into mzs and intensities
+        :param name: str name of the block, chosen by the system if None
+        :return: SharedSpectra that owns the block
+        """
+        mzs, intensities = np.asarray(mzs), np.asarray(intensities)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if len(mzs) != len(intensities):
+            raise IOError("mz/intensities vector different lengths")
+        start, stop = int(offsets[0]), int(offsets[-1])
+
+        def fill(shared_mzs, shared_intensities):
+            shared_mzs[:] = mzs[start:stop]
+            shared_intensities[:] = intensities[start:stop]
+
+        return cls.__allocate(offsets - start, mzs.dtype, intensities.dtype, name, fill)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def __len__(self):
+        return self.n_spectra
+
+    def __getstate__(self):
+        return {'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(state['name'])
+
+    def get_arrays(self, index):
+        """
+        :return: tuple (mzs, intensities) of read-only views of spectrum index
+        """
+        start, stop = self.offsets[index], self.offsets[index + 1]
+        return self.mzs[start:stop], self.intensities[start:stop]
+
+    # the store interface used by MSdataset
+    get = get_arrays
+
+    def get_spectrum(self, index, source='centroids'):
+        """
+        :param source: 'profile' or 'centroids', where the shared arrays are placed in the MassSpectrum
+        :return: MassSpectrum whose arrays are views of the shared block (when its dtype matches)
+        """
+        spectrum = MassSpectrum()
+        if source == 'profile':
+            spectrum.add_spectrum(*self.get_arrays(index))
+        elif source == 'centroids':
+            spectrum.add_centroids(*self.get_arrays(index))
+        else:
+            raise IOError('spectrum source should be profile or centroids')
+        return spectrum
+
+    def close(self):
+        """
+        detach this process from the block
+        """
+        self.offsets = self.mzs = self.intensities = None
+        self._shm.close()
+
+    def unlink(self):
+        """
+        free the block, only allowed for the process that created it
+        """
+        if not self._owner:
+            raise IOError('only the creating process can unlink shared spectra')
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if self._owner:
+            self.unlink()
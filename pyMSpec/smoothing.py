@@ -3,8 +3,10 @@ import numpy as np
 def apply_smoothing(mzs, counts, type_str="", method_args={}):
     """
     helper function to apply a smoothing function (with some input testing etc)
-    :param counts: numpy array of values to smooth
+    :param counts: numpy array of values to smooth, either one spectrum or a (n_spectra x n_bins) stack
     :param type_str: smooting type to apply (name)
+    :param method_args: dict of arguments for the smoothing function, all accept axis (the m/z axis of counts,
+    default -1) and inplace (write the result into counts if it is already a float array, default False)
     :return: tuple (mzs: numpy array, counts: numpy array)
     """
     smoothToApply = {"none": nosmooth,
@@ -12,18 +14,39 @@ def apply_smoothing(mzs, counts, type_str="", method_args={}):
                    "apodization": apodization,
                    "rebin": rebin,
                    "fast_change": fast_change,
-                   "median":median
+                   "median":median,
+                   "moving_average": moving_average,
+                   "baseline_tophat": baseline_tophat,
+                   "baseline_als": baseline_als
                    }
     if type_str not in smoothToApply.keys():
         raise ValueError("{} not in {}".format(type_str, smoothToApply.keys()))
-    np.testing.assert_array_almost_equal(len(mzs), len(counts))
     mzs = np.asarray(mzs, dtype=float)
     counts = np.asarray(counts, dtype=float)
+    np.testing.assert_array_almost_equal(len(mzs), np.shape(counts)[method_args.get('axis', -1)])
     return smoothToApply[type_str](mzs,counts, **method_args)
 
 
+def _along_axis(ndim, axis, n):
+    """
+    shape that is n along axis and 1 along all other dimensions (for broadcasting windows and filter sizes)
+    """
+    shape = [1] * ndim
+    shape[axis] = n
+    return tuple(shape)
+
+
+def _output(intensities, result, inplace):
+    """
+    copy result into intensities when smoothing in place
+    """
+    if inplace:
+        intensities[...] = result
+        return intensities
+    return result
 
-def nosmooth(mzs, intensities):
+
+def nosmooth(mzs, intensities, axis=-1, inplace=False):
     """
     does nothing, just returns input. is a dummy for programmatic case where a function must be supplied
     :param counts:  numpy array
@@ -33,82 +56,322 @@ def nosmooth(mzs, intensities):
     return mzs, intensities
 
 
-def sg_smooth(mzs, intensities, n_smooth=1, w_size=5):
+def sg_smooth(mzs, intensities, n_smooth=1, w_size=5, axis=-1, inplace=False, mode='interp'):
     """
     sav gol
+    with mode='mirror' the n_smooth passes are applied as a single convolution with the equivalent (cached) kernel
     :param mzs:  numpy array numpy array of mz values
     :param counts:  numpy array numpy array of values to smooth
     :param n_smooth:  int number of times to apply smoothing
     :param w_size:  int window size
+    :param axis:  int m/z axis of counts
+    :param inplace:  bool overwrite counts with the result
+    :param mode:  str edge handling, 'interp' (polynomial fit to the edge windows, one savgol_filter call per pass)
+    or 'mirror' (fused passes, differs from 'interp' within w_size of the edges)
     :return: mzs: numpy array
     :return: counts: numpy array
     """
     import scipy.signal as signal
-    for n in range(0, n_smooth):
-        intensities = signal.savgol_filter(intensities, w_size, 2)
-    intensities[intensities < 0] = 0
-    return mzs, intensities
+    import scipy.ndimage as ndimage
+    if mode == 'interp':
+        smoothed = intensities
+        for n in range(0, n_smooth):
+            smoothed = signal.savgol_filter(smoothed, w_size, 2, axis=axis)
+        if smoothed is intensities:
+            smoothed = intensities.copy()
+        smoothed = _output(intensities, smoothed, inplace)
+    else:
+        kernel = _cached_filter(('savgol', w_size, 2, n_smooth), _savgol_kernel)
+        smoothed = ndimage.convolve1d(intensities, kernel, axis=axis, mode=mode,
+                                      output=intensities if inplace else None)
+    np.maximum(smoothed, 0, out=smoothed)
+    return mzs, smoothed
 
 
-def apodization(mzs, intensities, w_size=10):
+def apodization(mzs, intensities, w_size=10, axis=-1, inplace=False):
     """
     apodization with slepian window
     :param mzs:  numpy array numpy array of mz values
     :param counts:  numpy array numpy array of values to smooth
     :param w_size:  int window size
+    :param axis:  int m/z axis of counts
+    :param inplace:  bool overwrite counts with the result
     :return: mzs: numpy array
     :return: counts: numpy array
     """
     import scipy.signal as signal
-    win = signal.hann(w_size)
-    win = signal.slepian(w_size, 0.3)
-    intensities = signal.fftconvolve(intensities, win, mode='same') / sum(win)
-    intensities[intensities < 1e-6] = 0
-    return mzs, intensities
+    win = _cached_filter(('slepian', w_size, 0.3), _slepian_window)
+    win = win.reshape(_along_axis(np.ndim(intensities), axis, w_size))
+    smoothed = signal.fftconvolve(intensities, win, mode='same', axes=axis)
+    smoothed[smoothed < 1e-6] = 0
+    return mzs, _output(intensities, smoothed, inplace)
+
+
+# filter coefficients and windows, keyed by (filter name, parameters...)
+_filter_cache = {}
+
+
+def _cached_filter(key, factory):
+    """
+    return the filter for key, building it with factory(*key[1:]) on first use
+    """
+    if key not in _filter_cache:
+        coeffs = factory(*key[1:])
+        coeffs.flags.writeable = False
+        _filter_cache[key] = coeffs
+    return _filter_cache[key]
 
 
-def rebin(mzs, intensities, delta_mz=0.1):
+def _savgol_kernel(w_size, polyorder, n_smooth):
+    """
+    convolution kernel equivalent to n_smooth passes of a savitzky-golay filter
+    """
+    import scipy.signal as signal
+    coeffs = signal.savgol_coeffs(w_size, polyorder)
+    kernel = np.ones(1)
+    for n in range(0, n_smooth):
+        kernel = np.convolve(kernel, coeffs)
+    return kernel
+
+
+def _slepian_window(w_size, width):
+    """
+    slepian window normalised to unit sum
+    (scipy.signal.slepian was removed from scipy, the same banded eigenvalue problem is solved here when missing)
+    """
+    import scipy.signal as signal
+    if hasattr(signal, 'slepian'):
+        win = signal.slepian(w_size, width)
+    elif w_size <= 1:
+        win = np.ones(w_size)
+    else:
+        import scipy.linalg as linalg
+        m = np.arange(w_size, dtype=float)
+        h = np.zeros((2, w_size))
+        h[0, 1:] = m[1:] * (w_size - m[1:]) / 2
+        h[1, :] = ((w_size - 1 - 2 * m) / 2) ** 2 * np.cos(2 * np.pi * width / 4)
+        _, win = linalg.eig_banded(h, select='i', select_range=(w_size - 1, w_size - 1))
+        win = win.ravel()
+    return win / np.sum(win)
+
+
+def rebin(mzs, intensities, delta_mz=0.1, ppm=None, axis=-1, inplace=False):
     """
     rebin spectrum
+    to rebin many spectra that share an mz axis build a RebinOperator once and apply it to each of them
     :param mzs:  numpy array numpy array of mz values
     :param counts:  numpy array numpy array of values to smooth
     :param delta_mz:  float, new mz bin width (constant across mz axis)
+    :param ppm:  float, if given new bins have a constant relative width of ppm instead of delta_mz
+    :param axis:  int m/z axis of counts
+    :param inplace:  ignored, the number of bins changes so a new array is always returned
     :return: mzs: numpy array
     :return: counts: numpy array
     """
-    import numpy as np
-    n_bins = np.round((mzs[-1] - mzs[0]) / delta_mz)
-    new_mzs = np.linspace(mzs[0], mzs[-1] + delta_mz, n_bins)
-    mz_idx = np.digitize(mzs, new_mzs[0:-1])
-    new_intensities = np.bincount(mz_idx, weights=intensities, minlength=len(new_mzs))
-    return new_mzs, new_intensities
+    rebin_operator = RebinOperator(mzs, delta_mz=delta_mz, ppm=ppm)
+    return rebin_operator.mzs, rebin_operator.apply(intensities, axis=axis)
+
+
+class RebinOperator(object):
+    """
+    maps spectra with a shared mz axis onto new mz bins
+    the output bin of every input point is computed once; spectra are then summed into the bins with bincount
+    (single spectrum) or a sparse matrix product (stack of spectra)
+    """
+    def __init__(self, mzs, delta_mz=0.1, ppm=None):
+        """
+        :param mzs:  numpy array of sorted input mz values
+        :param delta_mz:  float, new mz bin width (constant across mz axis)
+        :param ppm:  float, if given new bins have a constant relative width of ppm instead of delta_mz
+        """
+        mzs = np.asarray(mzs, dtype=float)
+        if ppm is None:
+            n_bins = int(np.round((mzs[-1] - mzs[0]) / delta_mz))
+            self.mzs = np.linspace(mzs[0], mzs[-1] + delta_mz, n_bins)
+        else:
+            if ppm <= 0 or mzs[0] <= 0:
+                raise ValueError("ppm binning needs ppm > 0 and positive mz values")
+            log_step = np.log1p(ppm * 1e-6)
+            n_bins = int(np.ceil(np.log(mzs[-1] / mzs[0]) / log_step)) + 2
+            self.mzs = mzs[0] * np.exp(log_step * np.arange(n_bins))
+        self.n_in = len(mzs)
+        self.mz_idx = np.digitize(mzs, self.mzs[0:-1])
+        self._matrix = None
 
+    def matrix(self):
+        """
+        sparse (n_bins x n_mzs) matrix that sums input points into their output bin
+        """
+        if self._matrix is None:
+            import scipy.sparse as sparse
+            self._matrix = sparse.csr_matrix((np.ones(self.n_in), (self.mz_idx, np.arange(self.n_in))),
+                                             shape=(len(self.mzs), self.n_in))
+        return self._matrix
 
-def fast_change(mzs, intensities, diff_thresh=0.01):
+    def apply(self, intensities, axis=-1):
+        """
+        :param intensities:  numpy array, one spectrum or a stack of spectra on the input mz axis
+        :param axis:  int mz axis of intensities
+        :return: numpy array of rebinned intensities
+        """
+        intensities = np.asarray(intensities, dtype=float)
+        if intensities.shape[axis] != self.n_in:
+            raise ValueError("intensities do not match the mz axis of the operator")
+        if intensities.ndim == 1:
+            return np.bincount(self.mz_idx, weights=intensities, minlength=len(self.mzs))
+        stack = np.moveaxis(intensities, axis, 0)
+        new_intensities = self.matrix().dot(stack.reshape(self.n_in, -1))
+        new_intensities = new_intensities.reshape((len(self.mzs),) + stack.shape[1:])
+        return np.moveaxis(new_intensities, 0, axis)
+
+
+def fast_change(mzs, intensities, diff_thresh=0.01, axis=-1, inplace=False):
     """
     remove high frequency noise from the data
     :param mzs:  numpy array numpy array of mz values
     :param counts:  numpy array numpy array of values to smooth
     :param diff_thresh:  float numeric change to remove
+    :param axis:  int m/z axis of counts
+    :param inplace:  bool overwrite counts with the result
     :return: mzs: numpy array
     :return: counts: numpy array
     """
     import numpy as np
-    import scipy.signal as signal
-    diff = np.concatenate((np.abs(np.diff(intensities)), [1]))
-    diff = signal.medfilt(diff)
+    import scipy.ndimage as ndimage
+    diff = np.abs(np.diff(intensities, axis=axis))
+    edge = list(diff.shape)
+    edge[axis] = 1
+    diff = np.concatenate((diff, np.ones(edge)), axis=axis)
+    diff = ndimage.median_filter(diff, size=_along_axis(diff.ndim, axis, 3), mode='constant')
+    if not inplace:
+        intensities = intensities.copy()
     intensities[diff < diff_thresh] = 0
     return mzs, intensities
 
 
-def median(mzs, intensities, w_size=3):
+def median(mzs, intensities, w_size=3, axis=-1, inplace=False):
     """
     apply median filter
     :param mzs:  numpy array numpy array of mz values
     :param counts:  numpy array numpy array of values to smooth
     :param w_size:  int window size
+    :param axis:  int m/z axis of counts
+    :param inplace:  bool overwrite counts with the result
     :return: mzs: numpy array
     :return: counts: numpy array
     """
-    import scipy.signal as signal
-    return mzs, signal.medfilt(intensities, kernel_size=w_size)
+    import scipy.ndimage as ndimage
+    smoothed = ndimage.median_filter(intensities, size=_along_axis(np.ndim(intensities), axis, w_size),
+                                     mode='constant')
+    return mzs, _output(intensities, smoothed, inplace)
+
+
+def window_bounds(mzs, w_ppm=None, w_mz=None):
+    """
+    index bounds of a window of constant ppm or mz width centred on each point of a sorted mz axis
+    :param mzs:  numpy array of sorted mz values
+    :param w_ppm:  float full window width in ppm of the central mz
+    :param w_mz:  float full window width in mz (used if w_ppm is not given)
+    :return: lo: numpy array, first index in each window
+    :return: hi: numpy array, one past the last index in each window
+    """
+    mzs = np.asarray(mzs, dtype=float)
+    if w_ppm is not None:
+        half_width = mzs * w_ppm * 1e-6 / 2.
+    elif w_mz is not None:
+        half_width = w_mz / 2.
+    else:
+        raise ValueError("one of w_ppm or w_mz must be given")
+    return np.searchsorted(mzs, mzs - half_width, side='left'), np.searchsorted(mzs, mzs + half_width, side='right')
+
+
+def moving_average(mzs, intensities, w_ppm=None, w_mz=None, n_smooth=1, bounds=None, axis=-1, inplace=False):
+    """
+    moving average with a window of constant width in ppm or mz, for non-uniform mz axes
+    window sums are differences of a cumulative sum, so the cost does not depend on the window size
+    :param mzs:  numpy array numpy array of sorted mz values
+    :param counts:  numpy array numpy array of values to smooth
+    :param w_ppm:  float full window width in ppm
+    :param w_mz:  float full window width in mz (used if w_ppm is not given)
+    :param n_smooth:  int number of times to apply smoothing
+    :param bounds:  tuple (lo, hi) from window_bounds, to reuse for spectra sharing an mz axis
+    :param axis:  int m/z axis of counts
+    :param inplace:  bool overwrite counts with the result
+    :return: mzs: numpy array
+    :return: counts: numpy array
+    """
+    if bounds is None:
+        bounds = window_bounds(mzs, w_ppm=w_ppm, w_mz=w_mz)
+    lo, hi = bounds
+    window_lengths = (hi - lo).reshape(_along_axis(np.ndim(intensities), axis, len(lo)))
+    smoothed = intensities
+    for n in range(0, n_smooth):
+        csum = np.cumsum(smoothed, axis=axis)
+        edge = list(csum.shape)
+        edge[axis] = 1
+        csum = np.concatenate((np.zeros(edge), csum), axis=axis)
+        smoothed = (np.take(csum, hi, axis=axis) - np.take(csum, lo, axis=axis)) / window_lengths
+    if smoothed is intensities:
+        smoothed = intensities.copy()
+    return mzs, _output(intensities, smoothed, inplace)
+
+
+def baseline_tophat(mzs, intensities, w_size=101, axis=-1, inplace=False):
+    """
+    baseline removal by top-hat filter: subtract the morphological opening (rolling minimum followed by rolling maximum)
+    the rolling extrema are computed with a monotonic deque (scipy.ndimage), O(n) for any window size
+    :param mzs:  numpy array numpy array of mz values
+    :param counts:  numpy array numpy array of values to correct
+    :param w_size:  int window size, should be wider than the widest peak
+    :param axis:  int m/z axis of counts
+    :param inplace:  bool overwrite counts with the result
+    :return: mzs: numpy array
+    :return: counts: numpy array
+    """
+    import scipy.ndimage as ndimage
+    baseline = ndimage.minimum_filter1d(intensities, w_size, axis=axis, mode='nearest')
+    ndimage.maximum_filter1d(baseline, w_size, axis=axis, mode='nearest', output=baseline)
+    if inplace:
+        intensities -= baseline
+        return mzs, intensities
+    return mzs, intensities - baseline
+
+
+def baseline_als(mzs, intensities, lam=1e5, p=0.01, n_iter=10, axis=-1, inplace=False):
+    """
+    baseline removal by asymmetric least squares (Eilers & Boelens, 2005)
+    each iteration solves the pentadiagonal system (W + lam D'D) z = W y with a banded cholesky solver, O(n)
+    :param mzs:  numpy array numpy array of mz values
+    :param counts:  numpy array numpy array of values to correct
+    :param lam:  float smoothness of the baseline
+    :param p:  float weight of points above the baseline (points below get 1 - p)
+    :param n_iter:  int number of reweighting iterations, at least 1
+    :param axis:  int m/z axis of counts
+    :param inplace:  bool overwrite counts with the result
+    :return: mzs: numpy array
+    :return: counts: numpy array
+    """
+    import scipy.linalg as linalg
+    stack = np.moveaxis(intensities, axis, -1)
+    n = stack.shape[-1]
+    if n < 3:
+        raise ValueError("baseline_als needs at least 3 points")
+    if n_iter < 1:
+        raise ValueError("baseline_als needs n_iter >= 1")
+    # upper banded form of lam * D'D, D the second difference operator
+    diff2 = np.array([1., -2., 1.])
+    penalty = np.zeros((3, n))
+    for k in range(3):
+        for a in range(3 - k):
+            penalty[2 - k, k + a:n - 2 + k + a] += lam * diff2[a] * diff2[a + k]
+    corrected = stack if inplace else np.empty(stack.shape)
+    for ii in np.ndindex(stack.shape[:-1]):
+        y = stack[ii]
+        w = np.ones(n)
+        ab = penalty.copy()
+        for it in range(0, n_iter):
+            ab[2] = penalty[2] + w
+            z = linalg.solveh_banded(ab, w * y, check_finite=False)
+            w = np.where(y > z, p, 1 - p)
+        corrected[ii] = y - z
+    return mzs, intensities if inplace else np.moveaxis(corrected, -1, axis)
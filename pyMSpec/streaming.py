@@ -0,0 +1,214 @@
+import numpy as np
+
+from pyMSpec import normalisation
+
+
+class _Buckets(object):
+    """
+    dense counts for a contiguous range of integer bucket keys, grows as needed
+    """
+    def __init__(self):
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def _grow(self, key_min, key_max):
+        if len(self.counts) == 0:
+            self.offset = key_min
+            self.counts = np.zeros(key_max - key_min + 1, dtype=np.int64)
+            return
+        new_offset = min(self.offset, key_min)
+        new_length = max(self.offset + len(self.counts), key_max + 1) - new_offset
+        if new_offset != self.offset or new_length != len(self.counts):
+            counts = np.zeros(new_length, dtype=np.int64)
+            counts[self.offset - new_offset:self.offset - new_offset + len(self.counts)] = self.counts
+            self.offset, self.counts = new_offset, counts
+
+    def add(self, keys):
+        if len(keys) == 0:
+            return
+        key_min, key_max = int(keys.min()), int(keys.max())
+        self._grow(key_min, key_max)
+        self.counts += np.bincount(keys - self.offset, minlength=len(self.counts))
+
+    def merge(self, other):
+        if len(other.counts) == 0:
+            return
+        self._grow(other.offset, other.offset + len(other.counts) - 1)
+        start = other.offset - self.offset
+        self.counts[start:start + len(other.counts)] += other.counts
+
+    def keys(self):
+        return np.arange(self.offset, self.offset + len(self.counts))
+
+
+class QuantileSketch(object):
+    """
+    mergeable quantile sketch with bounded relative error
+    non-zero values are counted in logarithmically spaced buckets, [gamma^(k-1), gamma^k) for bucket k, separately for
+    positive and negative values; zeros are counted exactly. quantiles are returned with a relative error of at most
+    accuracy, memory grows with log(max/min) of the values rather than with their number.
+    """
+    def __init__(self, accuracy=0.01):
+        if not 0 < accuracy < 1:
+            raise ValueError("accuracy must be between 0 and 1")
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.positive = _Buckets()
+        self.negative = _Buckets()
+        self.zeros = 0
+        self.count = 0
+
+    def update(self, values):
+        """
+        :param values: numpy array of values to add
+        """
+        values = np.ravel(np.asarray(values, dtype=float))
+        self.count += len(values)
+        self.zeros += int(np.count_nonzero(values == 0))
+        self.positive.add(self._key(values[values > 0]))
+        self.negative.add(self._key(-values[values < 0]))
+        return self
+
+    def merge(self, other):
+        """
+        add the counts of another sketch with the same accuracy
+        """
+        if other.accuracy != self.accuracy:
+            raise ValueError("can only merge sketches with the same accuracy")
+        self.count += other.count
+        self.zeros += other.zeros
+        self.positive.merge(other.positive)
+        self.negative.merge(other.negative)
+        return self
+
+    def _key(self, magnitudes):
+        return np.ceil(np.log(magnitudes) / self.log_gamma).astype(np.int64)
+
+    def _value(self, keys):
+        return 2 * self.gamma ** keys / (self.gamma + 1)
+
+    def histogram(self):
+        """
+        :return: values: numpy array of sorted bucket representatives
+        :return: counts: numpy array of the number of values in each bucket
+        """
+        values = np.concatenate((-self._value(self.negative.keys())[::-1], [0.], self._value(self.positive.keys())))
+        counts = np.concatenate((self.negative.counts[::-1], [self.zeros], self.positive.counts))
+        return values, counts
+
+    def quantile(self, q):
+        """
+        :param q: float between 0 and 1
+        :return: float approximate q-quantile of all values added so far
+        """
+        if self.count == 0:
+            raise ValueError("quantile of an empty sketch")
+        values, counts = self.histogram()
+        return _weighted_quantile(values, counts, q)
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def mad(self):
+        """
+        :return: float median absolute deviation from the median, computed from the bucket representatives
+        """
+        values, counts = self.histogram()
+        deviation = np.abs(values - self.median())
+        order = np.argsort(deviation)
+        return _weighted_quantile(deviation[order], counts[order], 0.5)
+
+
+def _weighted_quantile(sorted_values, counts, q):
+    rank = q * (np.sum(counts) - 1)
+    return float(sorted_values[np.searchsorted(np.cumsum(counts), rank, side='right')])
+
+
+class StreamingStatistics(object):
+    """
+    one pass normalisation statistics over a dataset
+    per spectrum the tic, rms and mad scale factors (exact, as computed by the normalisation module) are collected,
+    and all intensities are added to a QuantileSketch for dataset-wide median and mad.
+    each chunk must contain whole spectra.
+    """
+    factor_types = ("tic", "rms", "mad")
+
+    def __init__(self, accuracy=0.01):
+        self.factors = dict((type_str, []) for type_str in self.factor_types)
+        self.n_spectra = 0
+        self.sum = 0.
+        self.sum_squares = 0.
+        self.sketch = QuantileSketch(accuracy)
+
+    @property
+    def count(self):
+        return self.sketch.count
+
+    def update(self, counts, axis=-1):
+        """
+        :param counts: numpy array, one spectrum or a (n_spectra x n_bins) chunk of spectra
+        :param axis: int m/z axis of counts
+        """
+        counts = np.asarray(counts, dtype=float)
+        if counts.ndim == 1:
+            counts = counts[np.newaxis, :]
+            axis = -1
+        for type_str in self.factor_types:
+            factors = normalisation.apply_normalisation(None, counts, type_str, {'axis': axis, 'scale_only': True})
+            self.factors[type_str].append(np.ravel(factors))
+        self.n_spectra += counts.size // counts.shape[axis]
+        self.sum += float(np.sum(counts))
+        self.sum_squares += float(np.vdot(counts, counts))
+        self.sketch.update(counts)
+        return self
+
+    def update_from(self, data, chunksize=1000):
+        """
+        feed a (n_spectra x n_bins) array-like, e.g. a np.memmap, in chunks of chunksize spectra
+        """
+        for start in range(0, len(data), chunksize):
+            self.update(np.asarray(data[start:start + chunksize]))
+        return self
+
+    def merge(self, other):
+        """
+        append the statistics of another instance, e.g. from a worker process that saw the following spectra
+        """
+        for type_str in self.factor_types:
+            self.factors[type_str].extend(other.factors[type_str])
+        self.n_spectra += other.n_spectra
+        self.sum += other.sum
+        self.sum_squares += other.sum_squares
+        self.sketch.merge(other.sketch)
+        return self
+
+    def scale_factors(self, type_str="tic"):
+        """
+        :return: numpy array with the scale factor of every spectrum seen so far, in order
+        """
+        if type_str not in self.factor_types:
+            raise ValueError("{} not in {}".format(type_str, self.factor_types))
+        if len(self.factors[type_str]) > 1:
+            self.factors[type_str] = [np.concatenate(self.factors[type_str])]
+        return self.factors[type_str][0] if self.factors[type_str] else np.zeros(0)
+
+    def reference_factors(self, type_str="tic"):
+        """
+        scale factors relative to their median over the dataset, so normalised spectra keep the typical intensity
+        scale of the dataset
+        """
+        factors = self.scale_factors(type_str)
+        return factors / np.median(factors)
+
+    def mean(self):
+        return self.sum / self.count
+
+    def rms(self):
+        return np.sqrt(self.sum_squares / self.count)
+
+    def median(self):
+        return self.sketch.median()
+
+    def mad(self):
+        return self.sketch.mad()
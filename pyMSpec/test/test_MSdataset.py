@@ -0,0 +1,227 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from pyMSpec.MSdataset import MSdataset
+from pyMSpec.dataset_store import read_dataset, write_dataset
+
+
+def _identity(spectrum):
+    return spectrum
+
+
+def _normalise(spectrum):
+    return spectrum.normalise_spectrum('tic')
+
+
+def _first_half(spectrum):
+    mzs, ints = spectrum.get_spectrum()
+    spectrum.add_centroids(mzs[:len(mzs) // 2], ints[:len(mzs) // 2])
+    return spectrum
+
+
+class MSdatasetTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(2)
+        self.spectra = [(np.sort(rng.uniform(100, 1000, n)), rng.uniform(0, 1, n)) for n in (50, 1, 200, 30)]
+        self.dataset = MSdataset()
+        for mzs, ints in self.spectra:
+            self.dataset.add_spectrum(mzs, ints, mzs[::10], ints[::10])
+
+    def test_get_spectrum(self):
+        """Check that spectra are returned unchanged as views of the dataset arrays."""
+        self.assertEqual(len(self.spectra), len(self.dataset))
+        self.assertEqual([0, 1, 2, 3], self.dataset.index_list)
+        for ii, (mzs, ints) in enumerate(self.spectra):
+            spectrum = self.dataset.get_spectrum(ii)
+            assert_array_equal(mzs, spectrum.get_spectrum()[0])
+            assert_array_equal(ints, spectrum.get_spectrum()[1])
+            assert_array_equal(mzs[::10], spectrum.get_spectrum('centroids')[0])
+            profile_mzs, _ = self.dataset.get_arrays(ii)
+            self.assertTrue(np.shares_memory(profile_mzs, self.dataset._profile.mzs))
+            self.assertFalse(profile_mzs.flags.writeable)
+        self.assertRaises(IndexError, self.dataset.get_spectrum, 4)
+        assert_array_equal(self.spectra[-1][0], self.dataset.get_arrays(-1)[0])
+
+    def test_processing_does_not_change_dataset(self):
+        """Check that processing a returned spectrum leaves the dataset unchanged."""
+        spectrum = self.dataset.get_spectrum(0)
+        spectrum.normalise_spectrum('tic')
+        assert_array_equal(self.spectra[0][1], self.dataset.get_arrays(0)[1])
+
+    def test_views_survive_growth(self):
+        """Check that views handed out stay valid when the arrays are reallocated."""
+        mzs, ints = self.dataset.get_arrays(2)
+        for _ in range(100):
+            self.dataset.add_spectrum(np.arange(100.), np.ones(100))
+        assert_array_equal(self.spectra[2][0], mzs)
+        assert_array_equal(self.spectra[2][0], self.dataset.get_arrays(2)[0])
+
+    def test_reserve(self):
+        """Check that reserving space avoids reallocation."""
+        dataset = MSdataset(dtype=np.float32, n_spectra=10, n_peaks=100)
+        mz_array = dataset._profile.mzs
+        for _ in range(10):
+            dataset.add_spectrum(np.arange(10.), np.ones(10))
+        self.assertIs(mz_array, dataset._profile.mzs)
+        self.assertEqual(np.float32, dataset.get_arrays(0)[0].dtype)
+
+    def test_add_spectrum(self):
+        """Check indices and input validation of add_spectrum."""
+        self.dataset.add_spectrum([1.], [1.], index=10)
+        self.dataset.add_spectrum(centroids_mz=[1.], centroid_intensity=[1.])
+        self.dataset.add_spectrum([1.], [1.], index=np.int64(20))
+        self.dataset.add_spectrum([1.], [1.], index=[])
+        self.assertEqual([0, 1, 2, 3, 10, 11, 20, 21], self.dataset.index_list)
+        self.assertIs(int, type(self.dataset.index_list[-2]))
+        self.assertRaises(ValueError, self.dataset.add_spectrum)
+        self.assertRaises(IOError, self.dataset.add_spectrum, [1., 2.], [1.])
+
+
+class DataSummaryTest(unittest.TestCase):
+    def test_single_spectrum(self):
+        """Check that a dataset with a single spectrum can be summarised."""
+        dataset = MSdataset()
+        dataset.add_spectrum([100., 101.], [1., 2.])
+        summary = dataset.data_summary()
+        self.assertEqual(1, summary['n_spectra'])
+        self.assertEqual((100., 101.), (summary['mz_min'], summary['mz_max']))
+        self.assertTrue(summary['consistent_mz'])
+        self.assertTrue(dataset.consistent_mz)
+        self.assertIsNone(MSdataset().data_summary()['mz_min'])
+
+    def test_incremental(self):
+        """Check that the statistics follow add_spectrum."""
+        dataset = MSdataset()
+        axis = np.linspace(100, 200, 11)
+        for ii in range(5):
+            dataset.add_spectrum(axis, np.full(11, ii), [150.5], [ii])
+        summary = dataset.data_summary()
+        self.assertTrue(summary['consistent_mz'])
+        self.assertEqual(55, summary['n_peaks'])
+        self.assertEqual(5, summary['n_centroids'])
+        assert_array_equal([0., 11., 22., 33., 44.], dataset.tic())
+        assert_array_equal([0., 1., 2., 3., 4.], dataset.tic('centroids'))
+        dataset.add_spectrum(axis + 0.1, np.ones(11))
+        self.assertFalse(dataset.data_summary()['consistent_mz'])
+        self.assertAlmostEqual(200.1, dataset.mz_max)
+        dataset.add_spectrum([50.], [1.])
+        summary = dataset.data_summary()
+        self.assertEqual((1, 11), (summary['min_length'], summary['max_length']))
+        self.assertEqual(50., dataset.mz_min)
+        assert_array_equal([11] * 6 + [1], dataset.spectrum_lengths())
+        assert_array_equal([1] * 5 + [0, 0], dataset.spectrum_lengths('centroids'))
+        self.assertFalse(dataset.data_summary()['consistent_mz'])
+        # spectra with only centroids do not take part in the mz axis comparison
+        dataset = MSdataset()
+        dataset.add_spectrum(centroids_mz=[150.5], centroid_intensity=[1.])
+        for ii in range(3):
+            dataset.add_spectrum(axis, np.full(11, ii))
+            dataset.add_spectrum(centroids_mz=[150.5], centroid_intensity=[1.])
+        self.assertTrue(dataset.data_summary()['consistent_mz'])
+        self.assertTrue(dataset.map(_identity, chunksize=3).data_summary()['consistent_mz'])
+        dataset.add_spectrum(axis[:-1], np.ones(10))
+        self.assertFalse(dataset.data_summary()['consistent_mz'])
+
+    def test_bulk_and_file_backed(self):
+        """Check that mapped and file-backed datasets report the same statistics as one built by add_spectrum."""
+        rng = np.random.RandomState(1)
+        dataset = MSdataset()
+        for _ in range(20):
+            mzs = np.sort(rng.uniform(100, 200, rng.randint(0, 30)))
+            dataset.add_spectrum([1.], [1.], mzs, rng.uniform(0, 1, len(mzs)))
+        mapped = dataset.map(_identity, chunksize=6)
+        self.assertEqual(dataset.data_summary(), mapped.data_summary())
+        assert_array_equal(dataset.tic('centroids'), mapped.tic('centroids'))
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'dataset.pyms')
+            write_dataset(dataset, filename, chunk_size=7)
+            stored = read_dataset(filename)
+            self.assertEqual(dataset.data_summary(), stored.data_summary())
+            np.testing.assert_allclose(dataset.tic('centroids'), stored.tic('centroids'))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class MapTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(10)
+        self.dataset = MSdataset()
+        for ii in range(50):
+            mzs = np.sort(rng.uniform(100, 200, rng.randint(1, 60)))
+            self.dataset.add_spectrum(mzs, rng.uniform(0, 1, len(mzs)), index=ii + 100)
+        self.dataset.coordinates = np.arange(150).reshape(50, 3)
+
+    def check_normalised(self, result):
+        self.assertEqual(self.dataset.index_list, result.index_list)
+        assert_array_equal(self.dataset.coordinates, result.coordinates)
+        for ii in range(len(self.dataset)):
+            mzs, ints = self.dataset.get_arrays(ii)
+            assert_array_equal(mzs, result.get_arrays(ii)[0])
+            np.testing.assert_allclose(ints / ints.sum(), result.get_arrays(ii)[1])
+
+    def test_serial(self):
+        """Check that map in process applies the function to every spectrum in order."""
+        calls = []
+        result = self.dataset.map(_normalise, chunksize=7, progress=lambda done, total: calls.append((done, total)))
+        self.check_normalised(result)
+        self.assertEqual((7, 50), calls[0])
+        self.assertEqual((50, 50), calls[-1])
+        self.assertEqual(8, len(calls))
+
+    def test_processes(self):
+        """Check that map over worker processes gives ordered results, including changed lengths."""
+        self.check_normalised(self.dataset.map(_normalise, n_jobs=2, chunksize=6))
+        result = self.dataset.map(_first_half, n_jobs=3, chunksize=4)
+        for ii in range(len(self.dataset)):
+            mzs, _ = self.dataset.get_arrays(ii)
+            assert_array_equal(mzs[:len(mzs) // 2], result.get_arrays(ii, 'centroids')[0])
+
+    def test_file_backed(self):
+        """Check that workers can reopen a file-backed dataset."""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'dataset.pyms')
+            write_dataset(self.dataset, filename, chunk_size=8)
+            self.check_normalised(read_dataset(filename).map(_normalise, n_jobs=2, chunksize=5))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class IonImagesTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(9)
+        self.dataset = MSdataset()
+        for _ in range(30):
+            mzs = np.sort(rng.uniform(100, 110, rng.randint(0, 200)))
+            self.dataset.add_spectrum([1.], [1.], mzs, rng.uniform(0, 1, len(mzs)))
+        self.targets = rng.uniform(99, 111, 300)
+
+    def brute_force(self, ppm):
+        images = np.zeros((len(self.targets), len(self.dataset)))
+        for ii in range(len(self.dataset)):
+            mzs, ints = self.dataset.get_arrays(ii, 'centroids')
+            for t, target in enumerate(self.targets):
+                images[t, ii] = ints[np.abs(mzs - target) <= target * ppm * 1e-6].sum()
+        return images
+
+    def test_ion_images(self):
+        """Check that ion images match a per spectrum search."""
+        images = self.dataset.ion_images(self.targets, ppm=50)
+        self.assertEqual((300, 30), images.shape)
+        self.assertGreater(np.count_nonzero(images), 0)
+        np.testing.assert_allclose(self.brute_force(50), images)
+
+    def test_threads(self):
+        """Check that threaded blocks give the same images."""
+        np.testing.assert_allclose(self.dataset.ion_images(self.targets, ppm=20),
+                                   self.dataset.ion_images(self.targets, ppm=20, n_jobs=3, chunk_size=7))
+
+
+if __name__ == '__main__':
+    unittest.main()
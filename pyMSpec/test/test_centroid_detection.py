@@ -3,7 +3,8 @@ import itertools
 
 import numpy
 
-from ..centroid_detection import gradient
+from ..centroid_detection import gradient, estimate_noise, available_backends, get_backend, set_backend, \
+    unavailable_backends
 import common
 
 __author__ = 'Dominik Fay'
@@ -51,6 +52,39 @@ class CentroidDetectionTest(common.MSTestCase):
                 res_mzs, res_ints, res_idxs = gradient(mzs, ints, **kwargs)
                 self.check_postconditions(mzs, ints, kwargs, res_mzs, res_ints, res_idxs)
 
+    def test_gradient_noise_factor(self):
+        """Check that noise-aware peak picking only keeps peaks that stand out from the local noise."""
+        rng = numpy.random.RandomState(42)
+        mzs = numpy.linspace(100, 200, 10001)
+        ints = rng.uniform(0, 10, len(mzs))
+        peak_idx = [1000, 4000, 7000]
+        ints[peak_idx] = 1000.
+        all_mzs, all_ints, all_idxs = gradient(mzs, ints, weighted_bins=0, min_intensity=0)
+        res_mzs, res_ints, res_idxs = gradient(mzs, ints, weighted_bins=0, min_intensity=0, noise_factor=10)
+        self.assertGreater(len(all_idxs), len(peak_idx))
+        numpy.testing.assert_array_equal(res_idxs, peak_idx)
+        res_mzs, res_ints, res_idxs = gradient(mzs, ints, weighted_bins=0, min_intensity=0, noise_factor=10,
+                                               noise_method='percentile', noise_window=20.)
+        numpy.testing.assert_array_equal(res_idxs, peak_idx)
+        for percentile in (10., 90.):
+            noise = estimate_noise(mzs, ints, window_mz=20., method='percentile', percentile=percentile)
+            res_mzs, res_ints, res_idxs = gradient(mzs, ints, weighted_bins=0, min_intensity=0, noise_factor=1,
+                                                   noise_method='percentile', noise_window=20.,
+                                                   noise_percentile=percentile)
+            numpy.testing.assert_array_equal(res_idxs, all_idxs[all_ints > noise[all_idxs]])
+
+    def test_estimate_noise(self):
+        """Check that the noise estimate follows a change in noise level along the m/z axis."""
+        rng = numpy.random.RandomState(0)
+        mzs = numpy.linspace(100, 300, 20001)
+        ints = rng.normal(0, 1, len(mzs))
+        ints[mzs > 200] *= 10
+        noise = estimate_noise(mzs, ints, window_mz=10.)
+        self.assertEqual(noise.shape, mzs.shape)
+        self.assertAlmostEqual(numpy.median(noise[mzs < 180]), 1, delta=0.2)
+        self.assertAlmostEqual(numpy.median(noise[mzs > 220]), 10, delta=2)
+        self.assertRaises(ValueError, estimate_noise, mzs, ints, method='foo')
+
     def check_postconditions(self, mzs_in, ints_in, kwargs, mzs_out, ints_out, idx_list_out):
         th = kwargs.get('min_intensity', 0)
         max_out = kwargs.get('max_output', -1)
@@ -61,9 +95,8 @@ class CentroidDetectionTest(common.MSTestCase):
         # shorter or as long as input
         self.assertLessEqual(len(mzs_out), len(mzs_in))
         # length equal or less than max_out
-        # The two lines below are commented because the parameter max_output is broken. TODO: Uncomment them when fixed.
-        # if max_out >= 0:
-        #     self.assertLessEqual(len(mzs_out), max_out)
+        if max_out >= 0:
+            self.assertLessEqual(len(mzs_out), max_out)
         if len(ints_out) != 0:
             # print "%s -> %s" % (ints_in, ints_out)
             # above threshold
@@ -81,5 +114,46 @@ class CentroidDetectionTest(common.MSTestCase):
         numpy.testing.assert_array_equal(idx_list_out, sorted(idx_list_out))
 
 
+class CentroidBackendTest(common.MSTestCase):
+    def setUp(self):
+        super(CentroidBackendTest, self).setUp()
+        rng = numpy.random.RandomState(7)
+        mzs = numpy.linspace(100, 1000, 50000)
+        ints = numpy.convolve(rng.exponential(1, len(mzs)) ** 4, numpy.hanning(9), mode='same')
+        self.valid_spectrum_data.append((mzs, ints))
+
+    def test_backends_equivalent(self):
+        """Check that every available backend gives the same centroids as the pure Python reference."""
+        for mzs, ints in self.to_array_tuples(self.valid_spectrum_data):
+            for bins in [1, 2, 5]:
+                if len(mzs) <= bins * 2:
+                    continue
+                kwargs = {'min_intensity': 0, 'weighted_bins': bins, 'grad_type': 'diff'}
+                ref = gradient(mzs, ints, backend='python', **kwargs)
+                for backend in available_backends():
+                    res = gradient(mzs, ints, backend=backend, **kwargs)
+                    for ref_arr, res_arr in zip(ref, res):
+                        numpy.testing.assert_allclose(res_arr, ref_arr, rtol=1e-12, err_msg=backend)
+
+    def test_set_backend(self):
+        """Check that the globally active backend can be switched and reported."""
+        self.assertIn('python', available_backends())
+        self.assertIn('numpy', available_backends())
+        previous = set_backend('numpy')
+        try:
+            self.assertEqual(get_backend()[0], 'numpy')
+        finally:
+            set_backend(previous)
+        self.assertEqual(get_backend()[0], previous)
+
+    def test_unknown_backend(self):
+        """Check that requesting an unknown or unavailable backend raises a ValueError."""
+        self.assertRaises(ValueError, set_backend, 'foo')
+        mzs, ints = next(self.to_array_tuples(self.valid_spectrum_data[2:]))
+        self.assertRaises(ValueError, gradient, mzs, ints, backend='foo')
+        for backend in unavailable_backends:
+            self.assertRaises(ValueError, set_backend, backend)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from pyMSpec.MSdataset import MSdataset
+from pyMSpec.dataset_store import DatasetFile, read_dataset, write_dataset
+
+
+class DatasetStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'dataset.pyms')
+        rng = np.random.RandomState(6)
+        self.dataset = MSdataset()
+        self.spectra = []
+        for ii in range(23):
+            n = rng.randint(0, 40)
+            mzs = np.sort(rng.uniform(100 + 10 * ii, 200 + 10 * ii, n))
+            self.spectra.append((mzs, rng.uniform(0, 1, n)))
+            self.dataset.add_spectrum(mzs, self.spectra[-1][1], mzs[::3], self.spectra[-1][1][::3], index=ii * 3)
+        self.dataset.coordinates = np.array([[ii % 5, ii // 5, 0] for ii in range(23)])
+        write_dataset(self.dataset, self.filename, chunk_size=5, metadata={'instrument': 'orbitrap'})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        """Check that spectra, indices, coordinates and metadata are read back unchanged."""
+        stored = DatasetFile(self.filename)
+        self.assertEqual({'instrument': 'orbitrap'}, stored.metadata)
+        dataset = stored.to_dataset()
+        self.assertEqual(self.dataset.index_list, dataset.index_list)
+        assert_array_equal(self.dataset.coordinates, dataset.coordinates)
+        for ii in reversed(range(len(self.spectra))):
+            for source in ('profile', 'centroids'):
+                mzs, ints = self.dataset.get_arrays(ii, source)
+                stored_mzs, stored_ints = dataset.get_arrays(ii, source)
+                assert_array_equal(mzs, stored_mzs)
+                assert_array_equal(ints, stored_ints)
+        self.assertRaises(IOError, dataset.add_spectrum, [1.], [1.])
+        self.assertRaises(IndexError, stored.get_arrays, 23)
+
+    def test_slab(self):
+        """Check that an m/z slab query returns the same peaks as a brute force search."""
+        stored = DatasetFile(self.filename)
+        mzs, ints, spectra = stored.get_slab(150., 160., source='profile')
+        expected = [(mz, ii) for ii, (s_mzs, _) in enumerate(self.spectra) for mz in s_mzs if 150. <= mz <= 160.]
+        assert_array_equal([mz for mz, _ in expected], mzs)
+        assert_array_equal([ii for _, ii in expected], spectra)
+        self.assertEqual(0, len(stored.get_slab(1000., 1001.)[0]))
+
+    def test_slab_overlapping_spectra(self):
+        """Check that a slab only decompresses its mz bands when every spectrum covers the whole mz axis."""
+        dataset = MSdataset()
+        rng = np.random.RandomState(2)
+        spectra = []
+        for ii in range(12):
+            mzs = np.sort(rng.uniform(100, 1000, 200))
+            spectra.append((mzs, rng.uniform(0, 1, 200)))
+            dataset.add_spectrum(mzs, spectra[-1][1], mzs[::2], spectra[-1][1][::2])
+        spectra.append((np.array([500., 300., 700.]), np.array([1., 2., 3.])))
+        dataset.add_spectrum(*spectra[-1])
+        write_dataset(dataset, self.filename, chunk_size=4, mz_bands=16)
+        stored = DatasetFile(self.filename)
+        with mock.patch.object(stored, '_read_blob', wraps=stored._read_blob) as read_blob:
+            mzs, ints, found = stored.get_slab(400., 420., source='profile')
+        # one band per chunk, plus the unsorted spectrum that is stored as a single band
+        self.assertEqual(4, read_blob.call_count)
+        expected = [(mz, ii) for ii, (s_mzs, _) in enumerate(spectra) for mz in s_mzs if 400. <= mz <= 420.]
+        assert_array_equal([mz for mz, _ in expected], mzs)
+        assert_array_equal([ii for _, ii in expected], found)
+        mzs, _, found = stored.get_slab(200., 900., source='profile')
+        self.assertTrue(np.all(np.diff(found) >= 0))
+        for ii, (s_mzs, s_ints) in enumerate(spectra):
+            assert_array_equal(s_mzs[(s_mzs >= 200.) & (s_mzs <= 900.)], mzs[found == ii])
+            assert_array_equal(s_mzs, stored.get_arrays(ii)[0])
+            assert_array_equal(s_ints, stored.get_arrays(ii)[1])
+            assert_array_equal(dataset.get_arrays(ii, 'centroids')[0], stored.get_arrays(ii, 'centroids')[0])
+
+    def test_compression(self):
+        """Check that smooth data compresses below its raw size."""
+        dataset = MSdataset()
+        mzs = np.linspace(100, 1000, 10000)
+        for _ in range(10):
+            dataset.add_spectrum(mzs, np.round(np.sin(mzs), 2))
+        write_dataset(dataset, self.filename)
+        self.assertLess(os.path.getsize(self.filename), 10 * 2 * mzs.nbytes / 4)
+        assert_array_equal(mzs, read_dataset(self.filename).get_arrays(3)[0])
+
+    def test_parallel_readers(self):
+        """Check that several threads can read from one file at the same time."""
+        stored = DatasetFile(self.filename, cache_chunks=1)
+        errors = []
+
+        def read(order):
+            for ii in order:
+                if not np.array_equal(stored.get_arrays(ii)[0], self.spectra[ii][0]):
+                    errors.append(ii)
+
+        rng = np.random.RandomState(0)
+        threads = [threading.Thread(target=read, args=(rng.permutation(23),)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+
+    def test_bad_file(self):
+        """Check that opening a file with the wrong magic raises an IOError."""
+        with open(self.filename, 'wb') as f:
+            f.write(b'not a dataset file at all')
+        self.assertRaises(IOError, DatasetFile, self.filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from pyMSpec.imzml import ImzMLStore, read_imzml
+
+_HEADER = """<?xml version="1.0" encoding="ISO-8859-1"?>
+<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1">
+  <fileDescription>
+    <fileContent>
+      <cvParam cvRef="MS" accession="{spectrum_type}" name="spectrum type"/>
+      <cvParam cvRef="IMS" accession="{mode}" name="mode"/>
+    </fileContent>
+  </fileDescription>
+  <referenceableParamGroupList count="2">
+    <referenceableParamGroup id="mzArray">
+      <cvParam cvRef="MS" accession="MS:1000514" name="m/z array"/>
+      <cvParam cvRef="MS" accession="MS:1000576" name="no compression"/>
+      <cvParam cvRef="MS" accession="MS:1000523" name="64-bit float"/>
+    </referenceableParamGroup>
+    <referenceableParamGroup id="intensityArray">
+      <cvParam cvRef="MS" accession="MS:1000515" name="intensity array"/>
+      <cvParam cvRef="MS" accession="MS:1000576" name="no compression"/>
+      <cvParam cvRef="MS" accession="MS:1000521" name="32-bit float"/>
+    </referenceableParamGroup>
+  </referenceableParamGroupList>
+  <run id="test">
+    <spectrumList count="{count}">
+"""
+_SPECTRUM = """      <spectrum id="Scan={index}" index="{index}" defaultArrayLength="0">
+        <scanList count="1">
+          <scan>
+            <cvParam cvRef="IMS" accession="IMS:1000050" name="position x" value="{x}"/>
+            <cvParam cvRef="IMS" accession="IMS:1000051" name="position y" value="{y}"/>
+          </scan>
+        </scanList>
+        <binaryDataArrayList count="2">
+          <binaryDataArray encodedLength="0">
+            <referenceableParamGroupRef ref="mzArray"/>
+            <cvParam cvRef="IMS" accession="IMS:1000103" name="external array length" value="{length}"/>
+            <cvParam cvRef="IMS" accession="IMS:1000102" name="external offset" value="{mz_offset}"/>
+            <binary/>
+          </binaryDataArray>
+          <binaryDataArray encodedLength="0">
+            <referenceableParamGroupRef ref="intensityArray"/>
+            <cvParam cvRef="IMS" accession="IMS:1000103" name="external array length" value="{length}"/>
+            <cvParam cvRef="IMS" accession="IMS:1000102" name="external offset" value="{intensity_offset}"/>
+            <binary/>
+          </binaryDataArray>
+        </binaryDataArrayList>
+      </spectrum>
+"""
+_FOOTER = """    </spectrumList>
+  </run>
+</mzML>
+"""
+
+
+def write_imzml(filename, spectra, coordinates, continuous=False, centroided=False):
+    with open(os.path.splitext(filename)[0] + '.ibd', 'wb') as ibd, open(filename, 'w') as imzml:
+        ibd.write(b'\0' * 16)
+        imzml.write(_HEADER.format(spectrum_type='MS:1000127' if centroided else 'MS:1000128',
+                                   mode='IMS:1000030' if continuous else 'IMS:1000031', count=len(spectra)))
+        mz_offset = None
+        for index, ((mzs, ints), (x, y)) in enumerate(zip(spectra, coordinates)):
+            if mz_offset is None or not continuous:
+                mz_offset = ibd.tell()
+                ibd.write(np.asarray(mzs, dtype='<f8').tobytes())
+            intensity_offset = ibd.tell()
+            ibd.write(np.asarray(ints, dtype='<f4').tobytes())
+            imzml.write(_SPECTRUM.format(index=index, x=x, y=y, length=len(mzs), mz_offset=mz_offset,
+                                         intensity_offset=intensity_offset))
+        imzml.write(_FOOTER)
+
+
+class ImzMLTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'test.imzML')
+        rng = np.random.RandomState(4)
+        self.coordinates = [(1, 1), (2, 1), (1, 2), (2, 2)]
+        self.spectra = [(np.sort(rng.uniform(100, 1000, n)), rng.uniform(0, 1, n)) for n in (20, 5, 0, 13)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_processed(self):
+        """Check that processed mode spectra and coordinates are read back."""
+        write_imzml(self.filename, self.spectra, self.coordinates)
+        dataset = read_imzml(self.filename)
+        self.assertEqual(len(self.spectra), len(dataset))
+        self.assertIsInstance(dataset._profile, ImzMLStore)
+        self.assertEqual('processed', dataset._profile.mode)
+        assert_array_equal([[x, y, 0] for x, y in self.coordinates], dataset.coordinates)
+        for ii, (mzs, ints) in enumerate(self.spectra):
+            spectrum_mzs, spectrum_ints = dataset.get_spectrum(ii).get_spectrum()
+            assert_array_equal(mzs, spectrum_mzs)
+            np.testing.assert_array_almost_equal(ints, spectrum_ints)
+            self.assertEqual(np.float32, spectrum_ints.dtype)
+            self.assertEqual(0, len(dataset.get_arrays(ii, 'centroids')[0]))
+        self.assertRaises(IOError, dataset.add_spectrum, [1.], [1.])
+        store = pickle.loads(pickle.dumps(dataset._profile))
+        assert_array_equal(self.spectra[3][0], store.get(3)[0])
+        dataset.close()
+
+    def test_continuous_centroided(self):
+        """Check that continuous mode spectra share one mz array and centroided data fills the centroids."""
+        mzs = np.linspace(100, 200, 50)
+        spectra = [(mzs, np.full(50, i, dtype=float)) for i in range(4)]
+        write_imzml(self.filename, spectra, self.coordinates, continuous=True, centroided=True)
+        dataset = read_imzml(self.filename)
+        self.assertEqual('continuous', dataset._centroids.mode)
+        first_mzs, _ = dataset.get_arrays(0, 'centroids')
+        for ii in range(4):
+            spectrum_mzs, spectrum_ints = dataset.get_arrays(ii, 'centroids')
+            assert_array_equal(mzs, spectrum_mzs)
+            assert_array_equal(np.full(50, ii), spectrum_ints)
+            self.assertTrue(np.shares_memory(first_mzs, spectrum_mzs))
+            self.assertEqual(0, len(dataset.get_arrays(ii)[0]))
+        # the empty profile store is not appended to before the read-only centroids refuse the spectrum
+        self.assertRaises(IOError, dataset.add_spectrum, [1.], [1.], [1.], [1.])
+        self.assertEqual(4, len(dataset))
+        self.assertEqual([0, 1, 2, 3], dataset.index_list)
+        self.assertEqual(4, dataset._profile.n_spectra)
+        self.assertEqual(4, dataset._centroids.n_spectra)
+        self.assertEqual(0, len(dataset.get_arrays(3)[0]))
+        self.assertRaises(IndexError, dataset.get_arrays, 4)
+        self.assertEqual(4, dataset.data_summary()['n_spectra'])
+
+    def test_truncated_ibd(self):
+        """Check that an .ibd shorter than the offsets require raises an IOError."""
+        write_imzml(self.filename, self.spectra, self.coordinates)
+        ibd_filename = os.path.join(self.tmp_dir, 'test.ibd')
+        with open(ibd_filename, 'r+b') as f:
+            f.truncate(100)
+        self.assertRaises(IOError, read_imzml, self.filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,9 @@ Created on 27.08.2015
 
 @author: Dominik Fay
 """
+import os
+import shutil
+import tempfile
 import unittest
 
 import numpy
@@ -41,7 +44,7 @@ class MassSpectrumTest(unittest.TestCase):
         self.assertFalse(ints_list is ints_array)
 
     def test_no_copy_if_array(self):
-        """Check that get_spectrum does not create a new numpy array if the spectrum has been set as array."""
+        """Check that get_spectrum returns read-only views of the arrays if the spectrum has been set as array."""
         ms = mass_spectrum.MassSpectrum()
 
         mzs_array1 = numpy.array([1, 2, 3])
@@ -49,8 +52,36 @@ class MassSpectrumTest(unittest.TestCase):
         ms.add_spectrum(mzs_array1, ints_array1)
         mzs_array2, ints_array2 = ms.get_spectrum()
 
-        self.assertTrue(mzs_array1 is mzs_array2)
-        self.assertTrue(ints_array1 is ints_array2)
+        self.assertTrue(numpy.shares_memory(mzs_array1, mzs_array2))
+        self.assertTrue(numpy.shares_memory(ints_array1, ints_array2))
+        self.assertFalse(mzs_array2.flags.writeable)
+        self.assertFalse(ints_array2.flags.writeable)
+
+    def test_dtype(self):
+        """Check that spectra are converted to the dtype of the spectrum (and only copied if necessary)."""
+        mzs = numpy.array([1., 2., 3.])
+        ints = numpy.array([2., 4., 6.])
+        ms = mass_spectrum.MassSpectrum(profile_spec=(mzs, ints), centroid_spec=([2], [12]), dtype=numpy.float32)
+        for source in ['profile', 'centroids']:
+            for arr in ms.get_spectrum(source=source):
+                self.assertEqual(arr.dtype, numpy.float32)
+        ms = mass_spectrum.MassSpectrum(profile_spec=(mzs, ints), dtype=numpy.float64)
+        self.assertTrue(numpy.shares_memory(ms.get_spectrum()[0], mzs))
+
+    def test_is_sorted(self):
+        """Check that the sortedness of the m/z values is recorded when a spectrum is added."""
+        ms = mass_spectrum.MassSpectrum()
+        self.assertTrue(ms.is_sorted())
+        ms.add_spectrum([1, 2, 2, 3], [1, 1, 1, 1])
+        ms.add_centroids([3, 1], [1, 1])
+        self.assertTrue(ms.is_sorted('profile'))
+        self.assertFalse(ms.is_sorted('centroids'))
+        self.assertRaises(IOError, ms.is_sorted, 'asdf')
+
+    def test_slots(self):
+        """Check that spectra do not carry a per-instance attribute dict."""
+        ms = mass_spectrum.MassSpectrum()
+        self.assertFalse(hasattr(ms, '__dict__'))
 
     def test_use_centroid_if_given(self):
         """Check that get_spectrum returns the centroids if they have been set."""
@@ -65,10 +96,10 @@ class MassSpectrumTest(unittest.TestCase):
         mzs_profile2, ints_profile2 = ms.get_spectrum(source='profile')
         mzs_centroid2, ints_centroid2 = ms.get_spectrum(source='centroids')
 
-        self.assertTrue(mzs_profile1 is mzs_profile2)
-        self.assertTrue(ints_profile1 is ints_profile2)
-        self.assertTrue(mzs_centroid1 is mzs_centroid2)
-        self.assertTrue(ints_centroid1 is ints_centroid2)
+        self.assertTrue(numpy.shares_memory(mzs_profile1, mzs_profile2))
+        self.assertTrue(numpy.shares_memory(ints_profile1, ints_profile2))
+        self.assertTrue(numpy.shares_memory(mzs_centroid1, mzs_centroid2))
+        self.assertTrue(numpy.shares_memory(ints_centroid1, ints_centroid2))
 
     def test_IOError_if_unknown_kwarg(self):
         """Check that get_spectrum raises an IOError when an unknown value of the kwarg 'source' is passed."""
@@ -89,5 +120,181 @@ class MassSpectrumTest(unittest.TestCase):
             self.assertRaises(IOError, ms.add_centroids, *case)
 
 
+class MassSpectrumQueryTest(unittest.TestCase):
+    def setUp(self):
+        self.ms = mass_spectrum.MassSpectrum()
+        self.ms.add_centroids([100., 200., 200.001, 300., 400.], [1., 2., 3., 4., 5.])
+
+    def test_slice(self):
+        """Check that slice returns the peaks within the inclusive m/z bounds."""
+        mzs, ints = self.ms.slice(200., 300.)
+        assert_array_equal([200., 200.001, 300.], mzs)
+        assert_array_equal([2., 3., 4.], ints)
+        self.assertEqual(len(self.ms.slice(500., 600.)[0]), 0)
+        self.assertFalse(mzs.flags.writeable)
+
+    def test_query(self):
+        """Check that query returns the nearest peak within the tolerance for each target."""
+        targets = [50., 100.0001, 200.0009, 250., 400.001, 400.01]
+        idx, ints = self.ms.query(targets, ppm=5)
+        assert_array_equal([-1, 0, 2, -1, 4, -1], idx)
+        assert_array_equal([0., 1., 3., 0., 5., 0.], ints)
+        idx, ints = mass_spectrum.MassSpectrum().query(targets)
+        assert_array_equal([-1] * len(targets), idx)
+
+    def test_query_brute_force(self):
+        """Check query against a brute force search on random data."""
+        rng = numpy.random.RandomState(8)
+        mzs = numpy.sort(rng.uniform(100, 1000, 5000))
+        ms = mass_spectrum.MassSpectrum(centroid_spec=(mzs, rng.uniform(0, 1, len(mzs))))
+        targets = rng.uniform(100, 1000, 1000)
+        idx, ints = ms.query(targets, ppm=10)
+        for target, i in zip(targets, idx):
+            nearest = numpy.argmin(numpy.abs(mzs - target))
+            if abs(mzs[nearest] - target) <= target * 10e-6:
+                self.assertEqual(i, nearest)
+            else:
+                self.assertEqual(i, -1)
+
+    def test_unsorted(self):
+        """Check that queries on unsorted spectra raise a ValueError."""
+        ms = mass_spectrum.MassSpectrum(centroid_spec=([3., 1.], [1., 1.]))
+        self.assertRaises(ValueError, ms.query, [1.])
+        self.assertRaises(ValueError, ms.slice, 0., 2.)
+
+
+class MassSpectrumSerialisationTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'spectrum.bin')
+        rng = numpy.random.RandomState(3)
+        self.mzs = numpy.sort(rng.uniform(100, 1000, 1000))
+        self.ints = rng.uniform(0, 1, 1000)
+        self.ms = mass_spectrum.MassSpectrum(profile_spec=(self.mzs, self.ints),
+                                             centroid_spec=(self.mzs[::10], self.ints[::10]))
+        self.ms.normalise_spectrum('tic')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        """Check that a saved spectrum loads with the same data, processing history and sortedness."""
+        self.ms.save(self.filename)
+        for mmap in (True, False):
+            loaded = mass_spectrum.MassSpectrum.load(self.filename, mmap=mmap)
+            for source in ('profile', 'centroids'):
+                assert_array_equal(self.ms.get_spectrum(source)[0], loaded.get_spectrum(source)[0])
+                assert_array_equal(self.ms.get_spectrum(source)[1], loaded.get_spectrum(source)[1])
+                self.assertTrue(loaded.is_sorted(source))
+            self.assertEqual([{'kind': 'normalise', 'method': 'tic', 'args': {}}], loaded.get_processing())
+        self.assertIsInstance(mass_spectrum.MassSpectrum.load(self.filename)._mzs, numpy.memmap)
+
+    def test_dtype_and_empty(self):
+        """Check that dtype and empty arrays survive a round trip."""
+        ms = mass_spectrum.MassSpectrum(profile_spec=([1., 2.], [3., 4.]), dtype=numpy.float32)
+        ms.save(self.filename)
+        loaded = mass_spectrum.MassSpectrum.load(self.filename)
+        self.assertEqual(numpy.float32, loaded.get_spectrum()[1].dtype)
+        self.assertEqual(numpy.float32, numpy.dtype(loaded.dtype))
+        self.assertEqual(0, len(loaded.get_spectrum('centroids')[0]))
+
+    def test_delta_encoding(self):
+        """Check that delta encoded mzs are within half the resolution and the file is smaller."""
+        self.ms.save(self.filename)
+        raw_size = os.path.getsize(self.filename)
+        self.ms.save(self.filename, mz_resolution=1e-4)
+        self.assertLess(os.path.getsize(self.filename), raw_size)
+        loaded = mass_spectrum.MassSpectrum.load(self.filename)
+        self.assertLessEqual(numpy.max(numpy.abs(loaded.get_spectrum()[0] - self.mzs)), 0.5e-4 + 1e-9)
+        assert_array_equal(self.ms.get_spectrum()[1], loaded.get_spectrum()[1])
+
+    def test_bad_file(self):
+        """Check that loading a file with the wrong magic raises an IOError."""
+        with open(self.filename, 'wb') as f:
+            f.write(b'not a spectrum')
+        self.assertRaises(IOError, mass_spectrum.MassSpectrum.load, self.filename)
+
+
+class LazyMassSpectrumTest(unittest.TestCase):
+    def make_spectrum(self, lazy):
+        mzs = numpy.linspace(100, 101, 101)
+        ints = numpy.exp(-0.5 * ((mzs - 100.5) / 0.05) ** 2) + 0.1
+        return mass_spectrum.MassSpectrum(profile_spec=(mzs, ints), centroid_spec=([100.2, 100.5], [3., 5.]),
+                                          lazy=lazy)
+
+    def test_same_result_as_eager(self):
+        """Check that lazy processing gives the same spectra as eager processing."""
+        eager = self.make_spectrum(lazy=False)
+        lazy = self.make_spectrum(lazy=True)
+        for ms in [eager, lazy]:
+            ms.smooth_spectrum("sg_smooth", {'w_size': 7}).normalise_spectrum("tic")
+        for source in ['profile', 'centroids']:
+            for arr_eager, arr_lazy in zip(eager.get_spectrum(source=source), lazy.get_spectrum(source=source)):
+                numpy.testing.assert_array_almost_equal(arr_eager, arr_lazy)
+        self.assertEqual([step['method'] for step in lazy.get_processing()], ["sg_smooth", "tic"])
+
+    def test_only_requested_source(self):
+        """Check that only the requested source is processed and that the result is cached."""
+        ms = self.make_spectrum(lazy=True)
+        profile_ints = ms._intensities
+        ms.smooth_spectrum("sg_smooth", {'w_size': 7}).normalise_spectrum("tic")
+        self.assertTrue(ms._intensities is profile_ints)
+        mzs, ints = ms.get_spectrum(source='centroids')
+        assert_array_equal([0.375, 0.625], ints)
+        self.assertTrue(ms._intensities is profile_ints)
+        self.assertTrue(ms.get_spectrum(source='centroids')[1].base is ints.base)
+        ms.normalise_spectrum("sqrt")
+        numpy.testing.assert_array_almost_equal(numpy.sqrt([0.375, 0.625]), ms.get_spectrum(source='centroids')[1])
+
+    def test_add_after_processing(self):
+        """Check that spectra added after an operation was recorded are not processed again."""
+        ms = self.make_spectrum(lazy=True)
+        ms.normalise_spectrum("tic")
+        ms.add_centroids([1., 2.], [2., 2.])
+        assert_array_equal([2., 2.], ms.get_spectrum(source='centroids')[1])
+
+
+class MSnSpectrumTest(unittest.TestCase):
+    def test_init(self):
+        """Check that an MSn spectrum holds data and records its transitions."""
+        ms = mass_spectrum.MSn_spectrum(precursor_mz=500.2, profile_spec=([1., 2.], [3., 4.]))
+        assert_array_equal([1., 2.], ms.get_spectrum()[0])
+        ms.add_transition([(500.1, 500.3)])
+        self.assertEqual([(500.1, 500.3)], ms.ms_transitions)
+        self.assertEqual(2, ms.ms_level)
+        self.assertEqual(500.2, ms.precursor_mz)
+        self.assertRaises(AttributeError, setattr, ms, 'transitions', [])
+
+    def test_library_query(self):
+        """Check that the library returns the spectra within the precursor tolerance."""
+        precursors = [300., 500.001, 200., 500., 499.99, 500.004]
+        library = mass_spectrum.MSnLibrary([mass_spectrum.MSn_spectrum(precursor_mz=mz) for mz in precursors])
+        assert_array_equal([3, 1, 5], library.query_indices(500., ppm=10))
+        self.assertEqual([500., 500.001, 500.004], [s.precursor_mz for s in library.query(500., ppm=10)])
+        self.assertEqual(0, len(library.query(100.)))
+        library.add(mass_spectrum.MSn_spectrum(precursor_mz=100.))
+        self.assertEqual(1, len(library.query(100.)))
+        self.assertRaises(IOError, library.add, mass_spectrum.MSn_spectrum())
+
+    def test_save_load(self):
+        """Check that precursor mz, MS level and transitions survive a save/load round trip."""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'spectrum.bin')
+            ms = mass_spectrum.MSn_spectrum(precursor_mz=numpy.float64(500.2), centroid_spec=([1., 2.], [3., 4.]))
+            ms.add_transition([(500.1, 500.3)])
+            ms.save(filename)
+            loaded = mass_spectrum.MassSpectrum.load(filename)
+            self.assertIsInstance(loaded, mass_spectrum.MSn_spectrum)
+            self.assertEqual(500.2, loaded.precursor_mz)
+            self.assertEqual(2, loaded.ms_level)
+            self.assertEqual([(500.1, 500.3)], loaded.ms_transitions)
+            assert_array_equal([3., 4.], loaded.get_spectrum('centroids')[1])
+            mass_spectrum.MassSpectrum(profile_spec=([1., 2.], [3., 4.])).save(filename)
+            self.assertNotIsInstance(mass_spectrum.MassSpectrum.load(filename), mass_spectrum.MSn_spectrum)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -184,6 +184,129 @@ class normalisation_TestFunctions(unittest.TestCase):
             np.testing.assert_array_almost_equal(counts_, vals)
 
 
+class normalisation_TestStacks(unittest.TestCase):
+    methods = [("none", {}), ("tic", {}), ("rms", {}), ("mad", {}), ("sqrt", {}), ("tic_range", {'range': [2, 6]})]
+
+    def setUp(self):
+        self.mzs = np.arange(10, dtype=float)
+        self.stack = np.random.RandomState(1).uniform(0, 10, (5, 10))
+        self.stack[1] = 0
+        self.stack[2] = 3
+
+    def test_stack_matches_rows(self):
+        for type_str, norm_args in self.methods:
+            stack_ = normalisation.apply_normalisation(self.mzs, self.stack, type_str, norm_args)
+            stack_t = normalisation.apply_normalisation(self.mzs, self.stack.T, type_str, dict(norm_args, axis=0))
+            for row, row_, row_t in zip(self.stack, stack_, stack_t.T):
+                expected = normalisation.apply_normalisation(self.mzs, row, type_str, norm_args)
+                np.testing.assert_array_almost_equal(row_, expected, err_msg=type_str)
+                np.testing.assert_array_almost_equal(row_t, expected, err_msg=type_str)
+
+    def test_inplace(self):
+        for type_str, norm_args in self.methods[1:]:
+            expected = normalisation.apply_normalisation(self.mzs, self.stack, type_str, norm_args)
+            stack = self.stack.copy()
+            stack_ = normalisation.apply_normalisation(self.mzs, stack, type_str, dict(norm_args, inplace=True))
+            self.assertTrue(stack_ is stack)
+            np.testing.assert_array_almost_equal(stack, expected, err_msg=type_str)
+
+    def test_scale_only(self):
+        scale = normalisation.apply_normalisation(self.mzs, self.stack, "tic", {'scale_only': True})
+        np.testing.assert_array_almost_equal(scale, [np.sum(self.stack[0]), 1, 30] + list(np.sum(self.stack[3:], 1)))
+        scale = normalisation.apply_normalisation(self.mzs, self.stack[0], "rms", {'scale_only': True})
+        self.assertAlmostEqual(scale, np.sqrt(np.mean(self.stack[0] ** 2)))
+        scale = normalisation.apply_normalisation(self.mzs, self.stack, "mad", {'scale_only': True})
+        self.assertEqual(scale[2], 0)
+        self.assertRaises(ValueError, normalisation.apply_normalisation, self.mzs, self.stack, "sqrt",
+                          {'scale_only': True})
+
+    def test_zero_rows(self):
+        for type_str, norm_args in self.methods:
+            stack_ = normalisation.apply_normalisation(self.mzs, self.stack, type_str, norm_args)
+            np.testing.assert_array_equal(stack_[1], 0)
+
+
+class normalisation_TestTicRange(unittest.TestCase):
+    def setUp(self):
+        self.mzs = np.linspace(100, 200, 1001)
+        self.stack = np.random.RandomState(2).uniform(0, 10, (3, len(self.mzs)))
+
+    def test_single_range(self):
+        mask = np.all([self.mzs > 120, self.mzs < 150], axis=0)
+        expected = self.stack[0] / np.sum(self.stack[0][mask])
+        counts_ = normalisation.tic_range(self.mzs, self.stack[0], range=(120, 150))
+        np.testing.assert_array_almost_equal(counts_, expected)
+
+    def test_multiple_ranges(self):
+        mask = (self.mzs > 110) & (self.mzs < 130) | (self.mzs > 125) & (self.mzs < 160) | (self.mzs > 180)
+        mask &= ~((self.mzs >= 140) & (self.mzs <= 145))
+        bounds = normalisation.range_bounds(self.mzs, [(110, 130), (125, 160), (180, 1000)], exclude=(140, 145))
+        scale = normalisation.tic_range(self.mzs, self.stack, bounds=bounds, scale_only=True)
+        np.testing.assert_array_almost_equal(scale, np.sum(self.stack[:, mask], axis=1))
+
+    def test_exclude_only(self):
+        mask = ~((self.mzs >= 150) & (self.mzs <= 151))
+        scale = normalisation.tic_range(self.mzs, self.stack, exclude=[150, 151], scale_only=True)
+        np.testing.assert_array_almost_equal(scale, np.sum(self.stack[:, mask], axis=1))
+
+    def test_stack_scale_only(self):
+        import tracemalloc
+        bounds = normalisation.range_bounds(self.mzs, [(110, 130), (150, 190)], exclude=(160, 161))
+        stack = np.random.RandomState(3).uniform(0, 10, (200, len(self.mzs)))
+        expected = np.sum(stack[:, np.isin(np.arange(len(self.mzs)), np.concatenate(
+            [np.arange(a, b) for a, b in bounds]))], axis=1)
+        tracemalloc.start()
+        scale = normalisation.tic_range(self.mzs, stack, bounds=bounds, scale_only=True)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        np.testing.assert_array_almost_equal(scale, expected)
+        # no copy of the 1.6 MB stack
+        self.assertLess(peak, stack.nbytes / 4)
+        scale_t = normalisation.tic_range(self.mzs, stack.T, bounds=bounds, axis=0, scale_only=True)
+        np.testing.assert_array_almost_equal(scale_t, expected)
+
+
+class normalisation_TestCsr(unittest.TestCase):
+    methods = [("none", {}), ("tic", {}), ("rms", {}), ("mad", {}), ("sqrt", {}),
+               ("tic_range", {'range': [(120, 150), (170, 190)], 'exclude': (130, 135)})]
+
+    def make_stacks(self):
+        import scipy.sparse
+        for density, n_cols in [(0.05, 40), (0.5, 41), (0.9, 40)]:
+            stack = scipy.sparse.random(30, n_cols, density=density, random_state=n_cols, format='csr')
+            stack.data -= 0.2
+            dense = stack.toarray()
+            dense[3] = 0
+            dense[4] = 2.
+            yield np.linspace(100, 200, n_cols), scipy.sparse.csr_matrix(dense), dense
+
+    def test_matches_dense(self):
+        for mzs, stack, dense in self.make_stacks():
+            for type_str, norm_args in self.methods:
+                expected = normalisation.apply_normalisation(mzs, dense, type_str, norm_args)
+                data_ = normalisation.apply_normalisation_csr(mzs, stack.data, stack.indices, stack.indptr, type_str,
+                                                              norm_args)
+                stack_ = stack.copy()
+                stack_.data = data_
+                np.testing.assert_array_almost_equal(stack_.toarray(), expected, err_msg=type_str)
+
+    def test_scale_only(self):
+        for mzs, stack, dense in self.make_stacks():
+            for type_str, norm_args in self.methods[:4]:
+                expected = normalisation.apply_normalisation(mzs, dense, type_str, dict(norm_args, scale_only=True))
+                scale = normalisation.apply_normalisation_csr(mzs, stack.data, stack.indices, stack.indptr, type_str,
+                                                              dict(norm_args, scale_only=True))
+                np.testing.assert_array_almost_equal(scale, expected, err_msg=type_str)
+
+    def test_inplace(self):
+        mzs, stack, dense = next(self.make_stacks())
+        data = stack.data.copy()
+        data_ = normalisation.apply_normalisation_csr(mzs, data, stack.indices, stack.indptr, "tic", {'inplace': True})
+        self.assertTrue(data_ is data)
+        self.assertRaises(ValueError, normalisation.apply_normalisation_csr, mzs, data, stack.indices, stack.indptr,
+                          "foo")
+
+
             # def test_apply_normalisation(counts,type_str=""):
             #    normToApply = {"none": none,
             #                 "tic":tic,
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from pyMSpec.MSdataset import MSdataset
+from pyMSpec.peak_index import PeakIndex
+
+
+class PeakIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(12)
+        self.dataset = MSdataset()
+        for _ in range(40):
+            mzs = np.sort(np.round(rng.uniform(100, 120, rng.randint(1, 100)), 3))
+            self.dataset.add_spectrum(centroids_mz=mzs, centroid_intensity=rng.uniform(0, 1, len(mzs)))
+        self.targets = rng.uniform(100, 120, 200)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_sorted(self):
+        """Check that the index holds every peak sorted by m/z with its pixel."""
+        index = PeakIndex.build(self.dataset)
+        mzs, ints, pixels = self.dataset.get_peaks()
+        self.assertEqual(len(mzs), len(index))
+        self.assertTrue(np.all(np.diff(index.mzs) >= 0))
+        assert_array_equal(np.sort(mzs), index.mzs)
+        for mz, intensity, pixel in zip(index.mzs[::37], index.intensities[::37], index.pixels[::37]):
+            spectrum_mzs, spectrum_ints = self.dataset.get_arrays(pixel, 'centroids')
+            self.assertIn(intensity, spectrum_ints[spectrum_mzs == mz])
+
+    def test_query(self):
+        """Check that a window query returns exactly the peaks within the window."""
+        index = PeakIndex.build(self.dataset)
+        mzs, ints, pixels = index.query(105., 106.)
+        all_mzs = self.dataset.get_peaks()[0]
+        self.assertEqual(np.count_nonzero((all_mzs >= 105.) & (all_mzs <= 106.)), len(mzs))
+        self.assertTrue(np.all((mzs >= 105.) & (mzs <= 106.)))
+        np.testing.assert_allclose(self.dataset.ion_images(self.targets, ppm=20), index.ion_images(self.targets, 20))
+
+    def test_dataset_ion_images(self):
+        """Check that MSdataset.ion_images uses a set index until spectra are added."""
+        expected = self.dataset.ion_images(self.targets, ppm=20)
+        index = PeakIndex.build(self.dataset, directory=os.path.join(self.tmp_dir, 'index'))
+        self.dataset.set_peak_index(index)
+        with mock.patch.object(index, 'ion_images', wraps=index.ion_images) as ion_images:
+            np.testing.assert_allclose(expected, self.dataset.ion_images(self.targets, ppm=20))
+            self.assertEqual(1, ion_images.call_count)
+            self.dataset.add_spectrum(centroids_mz=[110.], centroid_intensity=[5.])
+            images = self.dataset.ion_images([110.], ppm=20)
+            self.assertEqual(1, ion_images.call_count)
+        self.assertEqual((1, 41), images.shape)
+        self.assertEqual(5., images[0, 40])
+        self.assertRaises(ValueError, self.dataset.set_peak_index, index)
+
+    def test_external_sort(self):
+        """Check that the external bucket sort gives the same index as the in-memory sort, persisted."""
+        directory = os.path.join(self.tmp_dir, 'index')
+        in_memory = PeakIndex.build(self.dataset)
+        external = PeakIndex.build(self.dataset, directory=directory, max_peaks=300, n_jobs=2)
+        self.assertIsInstance(external.mzs, np.memmap)
+        assert_array_equal(in_memory.mzs, external.mzs)
+        assert_array_equal(in_memory.intensities, external.intensities)
+        assert_array_equal(in_memory.pixels, external.pixels)
+        self.assertEqual(['index.json', 'intensities.npy', 'mzs.npy', 'pixels.npy'], sorted(os.listdir(directory)))
+        loaded = PeakIndex.load(directory, mmap=False)
+        self.assertEqual(40, loaded.n_pixels)
+        self.assertRaises(ValueError, PeakIndex.build, self.dataset, max_peaks=300)
+
+
+if __name__ == '__main__':
+    unittest.main()
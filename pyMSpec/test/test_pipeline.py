@@ -0,0 +1,91 @@
+import unittest
+
+import numpy as np
+
+from pyMSpec import smoothing, normalisation
+from pyMSpec.centroid_detection import gradient
+from pyMSpec.MSdataset import MSdataset
+from pyMSpec.mass_spectrum import MassSpectrum
+from pyMSpec.pipeline import Pipeline
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(11)
+        self.mzs = np.linspace(100, 120, 2001)
+        self.stack = rng.uniform(0, 1, (4, len(self.mzs)))
+        for mz in [105, 110, 115]:
+            self.stack += rng.uniform(10, 100, (4, 1)) * np.exp(-0.5 * ((self.mzs - mz) / 0.02) ** 2)
+        self.pipeline = Pipeline().smooth("sg_smooth", w_size=5).normalise("tic").centroid("gradient",
+                                                                                           weighted_bins=2)
+
+    def test_matches_sequential_calls(self):
+        intensities = self.stack[0].copy()
+        mzs, ints = smoothing.apply_smoothing(self.mzs, intensities, "sg_smooth", {'w_size': 5})
+        ints = normalisation.apply_normalisation(mzs, ints, "tic")
+        c_mzs, c_ints, _ = gradient(mzs, ints, weighted_bins=2)
+        mzs_, ints_, c_mzs_, c_ints_ = self.pipeline.apply(self.mzs, intensities)
+        np.testing.assert_array_almost_equal(ints_, ints)
+        np.testing.assert_array_almost_equal(c_mzs_, c_mzs)
+        np.testing.assert_array_almost_equal(c_ints_, c_ints)
+        np.testing.assert_array_equal(intensities, self.stack[0])
+
+    def test_stack(self):
+        pipeline = Pipeline([("smooth", "sg_smooth", {'w_size': 5}), ("normalise", "tic", {})])
+        mzs_, stack_, c_mzs, c_ints = pipeline.apply(self.mzs, self.stack)
+        self.assertIsNone(c_mzs)
+        for row, row_ in zip(self.stack, stack_):
+            np.testing.assert_array_almost_equal(pipeline.apply(self.mzs, row)[1], row_)
+        self.assertRaises(ValueError, self.pipeline.apply, self.mzs, self.stack)
+
+    def test_run(self):
+        ms = MassSpectrum()
+        ms.add_spectrum(self.mzs, self.stack[1])
+        self.pipeline.run(ms)
+        c_mzs, c_ints = ms.get_spectrum(source='centroids')
+        np.testing.assert_allclose(np.sort(c_mzs[np.argsort(c_ints)[-3:]]), [105, 110, 115], atol=0.01)
+        self.assertAlmostEqual(np.sum(ms.get_spectrum()[1]), 1)
+        self.assertEqual(ms.get_processing(), self.pipeline.provenance())
+        self.assertEqual(ms.get_processing()[2], {"kind": "centroid", "method": "gradient",
+                                                  "args": {'weighted_bins': 2}})
+
+    def test_run_profile_and_centroids(self):
+        pipeline = Pipeline().smooth("sg_smooth", w_size=5).normalise("tic")
+        ms = MassSpectrum(profile_spec=(self.mzs, self.stack[2]), centroid_spec=([105., 110.], [4., 4.]))
+        expected = MassSpectrum(profile_spec=(self.mzs, self.stack[2]), centroid_spec=([105., 110.], [4., 4.]))
+        expected.smooth_spectrum("sg_smooth", {'w_size': 5}).normalise_spectrum("tic")
+        pipeline.run(ms)
+        np.testing.assert_array_almost_equal(ms.get_spectrum(source='centroids')[1], [0.5, 0.5])
+        for source in ('profile', 'centroids'):
+            for values, expected_values in zip(ms.get_spectrum(source), expected.get_spectrum(source)):
+                np.testing.assert_array_almost_equal(values, expected_values)
+        self.assertEqual(ms.get_processing(), expected.get_processing())
+
+    def test_run_dataset(self):
+        dataset = MSdataset()
+        for ii, row in enumerate(self.stack):
+            dataset.add_spectrum(self.mzs, row, index=ii * 2)
+        processed = self.pipeline.run_dataset(dataset)
+        self.assertEqual(processed.index_list, [0, 2, 4, 6])
+        for ii, row in enumerate(self.stack):
+            _, ints, c_mzs, c_ints = self.pipeline.apply(self.mzs, row)
+            np.testing.assert_array_almost_equal(processed.get_arrays(ii)[1], ints)
+            np.testing.assert_array_almost_equal(processed.get_arrays(ii, 'centroids')[0], c_mzs)
+            np.testing.assert_array_equal(dataset.get_arrays(ii)[1], row)
+
+    def test_cache_key(self):
+        same = Pipeline(self.pipeline.steps)
+        other = Pipeline().smooth("sg_smooth", w_size=7).normalise("tic").centroid("gradient", weighted_bins=2)
+        self.assertEqual(same.cache_key(), self.pipeline.cache_key())
+        self.assertNotEqual(other.cache_key(), self.pipeline.cache_key())
+        self.assertEqual(self.pipeline.provenance()[0], {"kind": "smooth", "method": "sg_smooth",
+                                                         "args": {'w_size': 5}})
+
+    def test_invalid_steps(self):
+        self.assertRaises(ValueError, Pipeline().add_step, "foo", "tic")
+        self.assertRaises(ValueError, Pipeline().centroid, "foo")
+        self.assertRaises(ValueError, self.pipeline.centroid)
+
+
+if __name__ == "__main__":
+    unittest.main()
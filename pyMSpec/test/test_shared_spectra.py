@@ -0,0 +1,89 @@
+import pickle
+import unittest
+from multiprocessing import Pool
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from pyMSpec.mass_spectrum import MassSpectrum
+from pyMSpec.shared_spectra import SharedSpectra
+
+
+def _tic(args):
+    shared, index = args
+    mzs, intensities = shared.get_spectrum(index).get_spectrum('centroids')
+    return float(np.sum(intensities))
+
+
+class SharedSpectraTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(5)
+        self.spectra = []
+        for n in (10, 0, 25, 3):
+            self.spectra.append((np.sort(rng.uniform(100, 1000, n)), rng.uniform(0, 1, n)))
+        self.shared = SharedSpectra.create([MassSpectrum(centroid_spec=s) for s in self.spectra])
+
+    def tearDown(self):
+        self.shared.close()
+        self.shared.unlink()
+
+    def test_views(self):
+        """Check that spectra are returned unchanged as read-only views of the shared block."""
+        self.assertEqual(len(self.spectra), len(self.shared))
+        for i, (mzs, ints) in enumerate(self.spectra):
+            shared_mzs, shared_ints = self.shared.get_arrays(i)
+            assert_array_equal(mzs, shared_mzs)
+            assert_array_equal(ints, shared_ints)
+            self.assertFalse(shared_mzs.flags.writeable)
+            self.assertTrue(np.shares_memory(shared_mzs, self.shared.mzs) or len(mzs) == 0)
+        del shared_mzs, shared_ints
+
+    def test_attach(self):
+        """Check that a block can be attached by name and that pickling only transfers the name."""
+        attached = SharedSpectra(self.shared.name)
+        assert_array_equal(self.spectra[2][0], attached.get_arrays(2)[0])
+        self.assertRaises(IOError, attached.unlink)
+        attached.close()
+        data = pickle.dumps(self.shared)
+        self.assertLess(len(data), 200)
+        unpickled = pickle.loads(data)
+        assert_array_equal(self.spectra[0][1], unpickled.get_arrays(0)[1])
+        unpickled.close()
+
+    def test_from_arrays(self):
+        """Check that a block built from concatenated arrays and offsets holds the same spectra."""
+        offsets = np.concatenate([[0], np.cumsum([len(mzs) for mzs, _ in self.spectra])])
+        shared = SharedSpectra.from_arrays(np.concatenate([s[0] for s in self.spectra]),
+                                           np.concatenate([s[1] for s in self.spectra]).astype(np.float32), offsets)
+        try:
+            for i, (mzs, ints) in enumerate(self.spectra):
+                assert_array_equal(mzs, shared.get_arrays(i)[0])
+                assert_array_equal(ints.astype(np.float32), shared.get_arrays(i)[1])
+            self.assertEqual(np.float32, shared.intensity_dtype)
+        finally:
+            shared.close()
+            shared.unlink()
+
+    def test_dtype(self):
+        """Check that intensities can be stored with a smaller dtype."""
+        shared = SharedSpectra.create(self.spectra, intensity_dtype=np.float32)
+        try:
+            self.assertEqual(np.float32, shared.get_arrays(0)[1].dtype)
+            self.assertEqual(np.float64, shared.get_arrays(0)[0].dtype)
+        finally:
+            shared.close()
+            shared.unlink()
+
+    def test_pool(self):
+        """Check that worker processes can read spectra from the shared block."""
+        pool = Pool(2)
+        try:
+            tics = pool.map(_tic, [(self.shared, i) for i in range(len(self.shared))])
+        finally:
+            pool.close()
+            pool.join()
+        np.testing.assert_allclose([np.sum(ints) for _, ints in self.spectra], tics)
+
+
+if __name__ == '__main__':
+    unittest.main()
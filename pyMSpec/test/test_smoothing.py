@@ -0,0 +1,148 @@
+import unittest
+
+import numpy as np
+import scipy.signal as signal
+
+import pyMSpec.smoothing as smoothing
+
+
+class smoothing_TestStacks(unittest.TestCase):
+    methods = [("none", {}),
+               ("sg_smooth", {'n_smooth': 2, 'w_size': 5}),
+               ("median", {'w_size': 5}),
+               ("fast_change", {'diff_thresh': 0.5}),
+               ("rebin", {'delta_mz': 0.5}),
+               ("apodization", {'w_size': 10}),
+               ("moving_average", {'w_ppm': 2000, 'n_smooth': 2}),
+               ("baseline_tophat", {'w_size': 21}),
+               ("baseline_als", {'lam': 1e3})]
+
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.mzs = np.linspace(100, 110, 201)
+        self.stack = rng.uniform(0, 10, (6, len(self.mzs)))
+
+    def test_stack_matches_rows(self):
+        for type_str, method_args in self.methods:
+            mzs_, stack_ = smoothing.apply_smoothing(self.mzs, self.stack, type_str, method_args)
+            for row, row_ in zip(self.stack, stack_):
+                mzs_row, row_smoothed = smoothing.apply_smoothing(self.mzs, row, type_str, method_args)
+                np.testing.assert_array_almost_equal(mzs_, mzs_row)
+                np.testing.assert_array_almost_equal(row_, row_smoothed, err_msg=type_str)
+
+    def test_axis(self):
+        for type_str, method_args in self.methods:
+            args = dict(method_args, axis=0)
+            mzs_, stack_t = smoothing.apply_smoothing(self.mzs, self.stack.T, type_str, args)
+            mzs_, stack_ = smoothing.apply_smoothing(self.mzs, self.stack, type_str, method_args)
+            np.testing.assert_array_almost_equal(stack_t.T, stack_, err_msg=type_str)
+
+    def test_inplace(self):
+        for type_str, method_args in self.methods:
+            if type_str == "rebin":
+                continue
+            expected = smoothing.apply_smoothing(self.mzs, self.stack, type_str, method_args)[1]
+            stack = self.stack.copy()
+            mzs_, stack_ = smoothing.apply_smoothing(self.mzs, stack, type_str, dict(method_args, inplace=True))
+            self.assertTrue(stack_ is stack)
+            np.testing.assert_array_almost_equal(stack, expected, err_msg=type_str)
+
+    def test_input_unchanged(self):
+        for type_str, method_args in self.methods:
+            stack = self.stack.copy()
+            smoothing.apply_smoothing(self.mzs, stack, type_str, method_args)
+            np.testing.assert_array_equal(stack, self.stack, err_msg=type_str)
+
+    def test_median(self):
+        mzs_, counts_ = smoothing.median(self.mzs, self.stack[0], w_size=5)
+        np.testing.assert_array_almost_equal(counts_, signal.medfilt(self.stack[0], kernel_size=5))
+
+    def test_sg_smooth_fused(self):
+        counts = self.stack[0]
+        for n_smooth in [1, 2, 5]:
+            expected = counts
+            for n in range(n_smooth):
+                expected = signal.savgol_filter(expected, 7, 2, mode='mirror')
+            expected[expected < 0] = 0
+            mzs_, counts_ = smoothing.sg_smooth(self.mzs, counts, n_smooth=n_smooth, w_size=7, mode='mirror')
+            np.testing.assert_array_almost_equal(counts_, expected)
+
+    def test_sg_smooth_default(self):
+        # the default keeps savgol_filter's interp edges
+        counts = self.stack[0]
+        for n_smooth in [1, 2]:
+            expected = counts
+            for n in range(n_smooth):
+                expected = signal.savgol_filter(expected, 7, 2)
+            expected[expected < 0] = 0
+            mzs_, counts_ = smoothing.sg_smooth(self.mzs, counts, n_smooth=n_smooth, w_size=7)
+            np.testing.assert_array_equal(counts_, expected)
+
+    def test_apodization_window(self):
+        win = smoothing._slepian_window(10, 0.3)
+        self.assertAlmostEqual(np.sum(win), 1)
+        np.testing.assert_array_almost_equal(win, win[::-1])
+        self.assertTrue(np.all(win > 0))
+        self.assertTrue(smoothing._cached_filter(('slepian', 10, 0.3), smoothing._slepian_window) is
+                        smoothing._cached_filter(('slepian', 10, 0.3), smoothing._slepian_window))
+
+    def test_rebin_operator(self):
+        rebin_operator = smoothing.RebinOperator(self.mzs, delta_mz=0.5)
+        mzs_, counts_ = smoothing.rebin(self.mzs, self.stack[2], delta_mz=0.5)
+        np.testing.assert_array_almost_equal(rebin_operator.mzs, mzs_)
+        np.testing.assert_array_almost_equal(rebin_operator.apply(self.stack[2]), counts_)
+        stack_ = rebin_operator.apply(self.stack)
+        self.assertEqual(stack_.shape, (len(self.stack), len(mzs_)))
+        np.testing.assert_array_almost_equal(stack_.sum(axis=1), self.stack.sum(axis=1))
+        self.assertRaises(ValueError, rebin_operator.apply, self.stack[:, :-1])
+
+    def test_rebin_ppm(self):
+        mzs = np.linspace(100, 1000, 5000)
+        counts = np.ones(len(mzs))
+        rebin_operator = smoothing.RebinOperator(mzs, ppm=500)
+        widths = np.diff(rebin_operator.mzs) / rebin_operator.mzs[:-1]
+        np.testing.assert_array_almost_equal(widths, 500e-6)
+        self.assertGreater(rebin_operator.mzs[-1], mzs[-1])
+        self.assertAlmostEqual(rebin_operator.apply(counts).sum(), len(mzs))
+        mzs_, counts_ = smoothing.apply_smoothing(mzs, counts, "rebin", {'ppm': 500})
+        np.testing.assert_array_almost_equal(mzs_, rebin_operator.mzs)
+
+    def test_moving_average_ppm(self):
+        mzs = np.sort(np.random.RandomState(5).uniform(100, 1000, 3000))
+        counts = np.random.RandomState(6).uniform(0, 1, len(mzs))
+        expected = np.array([counts[np.abs(mzs - mz) <= mz * 500e-6].mean() for mz in mzs])
+        mzs_, counts_ = smoothing.moving_average(mzs, counts, w_ppm=1000)
+        np.testing.assert_array_almost_equal(counts_, expected)
+        expected = np.array([counts[np.abs(mzs - mz) <= 0.5].mean() for mz in mzs])
+        bounds = smoothing.window_bounds(mzs, w_mz=1.)
+        mzs_, counts_ = smoothing.moving_average(mzs, counts, bounds=bounds)
+        np.testing.assert_array_almost_equal(counts_, expected)
+        self.assertRaises(ValueError, smoothing.window_bounds, mzs)
+
+    def test_baseline(self):
+        mzs = np.linspace(100, 200, 2001)
+        baseline = 50 + 0.5 * (mzs - 100)
+        peaks = np.zeros(len(mzs))
+        for mz in [120, 150, 180]:
+            peaks += 100 * np.exp(-0.5 * ((mzs - mz) / 0.1) ** 2)
+        for type_str, method_args in [("baseline_tophat", {'w_size': 51}),
+                                      ("baseline_als", {'lam': 1e6, 'p': 0.001})]:
+            mzs_, counts_ = smoothing.apply_smoothing(mzs, peaks + baseline, type_str, method_args)
+            np.testing.assert_allclose(counts_, peaks, atol=2, err_msg=type_str)
+        self.assertRaises(ValueError, smoothing.baseline_als, mzs, peaks + baseline, n_iter=0)
+
+    def test_fast_change(self):
+        counts = self.stack[0]
+        diff = signal.medfilt(np.concatenate((np.abs(np.diff(counts)), [1])))
+        expected = counts.copy()
+        expected[diff < 3] = 0
+        mzs_, counts_ = smoothing.fast_change(self.mzs, counts, diff_thresh=3)
+        np.testing.assert_array_equal(counts_, expected)
+
+    def test_length_mismatch(self):
+        self.assertRaises(AssertionError, smoothing.apply_smoothing, self.mzs[:-1], self.stack, "median")
+        self.assertRaises(ValueError, smoothing.apply_smoothing, self.mzs, self.stack, "foo")
+
+
+if __name__ == "__main__":
+    unittest.main()
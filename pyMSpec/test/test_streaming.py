@@ -0,0 +1,82 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from pyMSpec import normalisation
+from pyMSpec.streaming import QuantileSketch, StreamingStatistics
+
+
+class QuantileSketchTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(4)
+        self.values = np.concatenate((rng.lognormal(3, 2, 20000), -rng.lognormal(0, 1, 5000), np.zeros(3000)))
+
+    def test_relative_accuracy(self):
+        sketch = QuantileSketch(accuracy=0.01).update(self.values)
+        self.assertEqual(sketch.count, len(self.values))
+        for q in [0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99]:
+            expected = np.quantile(self.values, q, method='lower')
+            self.assertLessEqual(abs(sketch.quantile(q) - expected), 0.011 * abs(expected) + 1e-12, msg=q)
+
+    def test_mad(self):
+        sketch = QuantileSketch(accuracy=0.005).update(self.values)
+        expected = np.median(np.abs(self.values - np.median(self.values)))
+        self.assertAlmostEqual(sketch.mad(), expected, delta=0.02 * expected)
+
+    def test_merge(self):
+        whole = QuantileSketch().update(self.values)
+        parts = [pickle.loads(pickle.dumps(QuantileSketch().update(part))) for part in np.array_split(self.values, 7)]
+        merged = parts[0]
+        for part in parts[1:]:
+            merged.merge(part)
+        self.assertEqual(merged.count, whole.count)
+        for q in [0.1, 0.5, 0.9]:
+            self.assertEqual(merged.quantile(q), whole.quantile(q))
+        self.assertRaises(ValueError, merged.merge, QuantileSketch(accuracy=0.1))
+
+    def test_empty(self):
+        self.assertRaises(ValueError, QuantileSketch().quantile, 0.5)
+        self.assertRaises(ValueError, QuantileSketch, 0)
+
+
+class StreamingStatisticsTest(unittest.TestCase):
+    def setUp(self):
+        self.data = np.random.RandomState(9).exponential(5, (230, 400))
+        self.data[17] = 0
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_memmap_chunks(self):
+        fn = os.path.join(self.tmp_dir, 'data.npy')
+        np.save(fn, self.data)
+        stats = StreamingStatistics().update_from(np.load(fn, mmap_mode='r'), chunksize=32)
+        self.assertEqual(stats.n_spectra, len(self.data))
+        for type_str in StreamingStatistics.factor_types:
+            expected = normalisation.apply_normalisation(None, self.data, type_str, {'scale_only': True})
+            np.testing.assert_array_almost_equal(stats.scale_factors(type_str), expected)
+        self.assertAlmostEqual(stats.mean(), np.mean(self.data))
+        self.assertAlmostEqual(stats.rms(), np.sqrt(np.mean(self.data ** 2)))
+        self.assertAlmostEqual(stats.median(), np.median(self.data), delta=0.02 * np.median(self.data))
+        self.assertAlmostEqual(np.median(stats.reference_factors("tic")), 1)
+
+    def test_merge(self):
+        whole = StreamingStatistics().update(self.data)
+        merged = StreamingStatistics().update(self.data[:100]).merge(
+            StreamingStatistics().update(self.data[100:200])).merge(StreamingStatistics().update(self.data[200:]))
+        np.testing.assert_array_almost_equal(merged.scale_factors("mad"), whole.scale_factors("mad"))
+        self.assertAlmostEqual(merged.sum, whole.sum)
+        self.assertEqual(merged.median(), whole.median())
+
+    def test_single_spectrum(self):
+        stats = StreamingStatistics().update(self.data[0]).update(self.data[1:3].T, axis=0)
+        np.testing.assert_array_almost_equal(stats.scale_factors("tic"), np.sum(self.data[:3], axis=1))
+
+
+if __name__ == "__main__":
+    unittest.main()